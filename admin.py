@@ -4,7 +4,7 @@ from django.contrib import admin
 from dal import autocomplete
 
 from .models import (Supplier, Tax, ProductType, Product, Item, Fee, Discount, TaxCharge, Gratuity, PaymentMethodType,
-                     PaymentMethod, Payment, Receipt)
+                     PaymentMethod, Payment, Receipt, defer_totals)
 
 
 class ItemAdminForm(forms.ModelForm):
@@ -32,6 +32,14 @@ class ItemTabularAdmin(admin.TabularInline):
     model = Item
     extra = 1
 
+    def get_queryset(self, request):
+        return super(ItemTabularAdmin, self).get_queryset(request).select_related("product")
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == "product":
+            kwargs["queryset"] = Product.objects.prefetch_related("types")
+        return super(ItemTabularAdmin, self).formfield_for_foreignkey(db_field, request, **kwargs)
+
 
 class FeeTabularAdmin(admin.TabularInline):
     model = Fee
@@ -47,6 +55,9 @@ class TaxChargeTabularAdmin(admin.TabularInline):
     model = TaxCharge
     extra = 1
 
+    def get_queryset(self, request):
+        return super(TaxChargeTabularAdmin, self).get_queryset(request).select_related("tax").with_rates()
+
 
 class GratuityTabularAdmin(admin.TabularInline):
     model = Gratuity
@@ -56,6 +67,25 @@ class GratuityTabularAdmin(admin.TabularInline):
 class PaymentTabularAdmin(admin.TabularInline):
     model = Payment
     extra = 0
+    readonly_fields = ("reconciled",)
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == "payment_method":
+            kwargs["queryset"] = PaymentMethod.objects.select_related("type")
+        return super(PaymentTabularAdmin, self).formfield_for_foreignkey(db_field, request, **kwargs)
+
+
+class PaymentStatusListFilter(admin.SimpleListFilter):
+    title = "payment status"
+    parameter_name = "payment_status"
+
+    def lookups(self, request, model_admin):
+        return [(status, status) for (status, condition) in Receipt.payment_statuses]
+
+    def queryset(self, request, queryset):
+        if self.value() in dict(Receipt.payment_statuses):
+            return queryset.payment_status(self.value())
+        return queryset
 
 
 class ReceiptAdmin(admin.ModelAdmin):
@@ -71,13 +101,40 @@ class ReceiptAdmin(admin.ModelAdmin):
     date_hierarchy = "date"
     list_display = ("when", "supplier", "subtotal_usd", "tax_usd", "discount_usd", "tip_usd", "total_usd", "status")
     list_display_links = ("when", "supplier")
-    list_filter = ("date", "supplier__state", "supplier__city", "supplier__name",)
+    list_filter = (PaymentStatusListFilter, "date", "supplier__state", "supplier__city", "supplier__name",)
+    list_select_related = ("supplier",)
+
+    def get_queryset(self, request):
+        return super(ReceiptAdmin, self).get_queryset(request).with_balance()
+
+    def save_related(self, request, form, formsets, change):
+        with defer_totals():
+            super(ReceiptAdmin, self).save_related(request, form, formsets, change)
+
+
+class SupplierAdmin(admin.ModelAdmin):
+    list_display = ("__str__", "visits", "spend_usd", "average_basket_usd", "last_visit", "top_product")
+    list_select_related = ("stats__top_product",)
+    readonly_fields = ("visits", "spend_usd", "average_basket_usd", "last_visit", "top_products_list")
+
+    def top_products_list(self, obj):
+        return ", ".join("%s (%i)" % (product.name, product.purchases_here) for product in obj.top_products())
+    top_products_list.short_description = "Top products"
+
+
+class ProductAdmin(admin.ModelAdmin):
+    def get_queryset(self, request):
+        return super(ProductAdmin, self).get_queryset(request).prefetch_related("types")
+
+
+class PaymentMethodAdmin(admin.ModelAdmin):
+    list_select_related = ("type",)
 
 
-admin.site.register(Supplier)
+admin.site.register(Supplier, SupplierAdmin)
 admin.site.register(Tax)
 admin.site.register(ProductType)
-admin.site.register(Product)
+admin.site.register(Product, ProductAdmin)
 admin.site.register(PaymentMethodType)
-admin.site.register(PaymentMethod)
+admin.site.register(PaymentMethod, PaymentMethodAdmin)
 admin.site.register(Receipt, ReceiptAdmin)
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class MizerConfig(AppConfig):
+    name = "mizer"
+    verbose_name = "Mizer"
+
+    def ready(self):
+        from . import signals  # noqa: connects the receipt totals hooks
@@ -0,0 +1,92 @@
+from datetime import date
+from time import time
+
+from django.contrib.admin import site
+from django.contrib.admin.templatetags.admin_list import results
+from django.contrib.auth.models import User
+from django.test import RequestFactory
+
+from .admin import ReceiptAdmin
+from .cache import autocomplete_cache, page_cache
+from .instrumentation import QueryRecorder
+from .models import Receipt
+from .views import DashboardView, ProductAutocompleteView, SupplierAutocompleteView, YearListView
+
+
+class Benchmarks(object):
+    """Wall time and query count of the views and model methods hit on every page load
+
+    Views are measured up to their template context, since the page templates belong to the project;
+    the admin changelist is measured down to its rendered rows. Autocomplete views are measured with
+    an empty (cold) and a populated (warm) cache, the year and dashboard views with an empty page cache.
+    """
+    page_size = 100
+
+    def __init__(self, repeat=3):
+        self.repeat = repeat
+        self.user = User(username="benchmark", is_superuser=True, is_staff=True, is_active=True)
+        self.factory = RequestFactory()
+
+    def request(self, path="/", **params):
+        request = self.factory.get(path, params)
+        request.user = self.user
+        return request
+
+    def receipt_admin_changelist(self):
+        response = ReceiptAdmin(Receipt, site).changelist_view(self.request("/admin/mizer/receipt/"))
+        return len(list(results(response.context_data["cl"])))
+
+    def year_list_view(self):
+        latest = Receipt.objects.order_by("-date").values_list("date", flat=True).first()
+        if latest:
+            page_cache.bump("year:%i" % latest.year)
+        view = YearListView(kwargs={"year": str(latest.year if latest else "")}, request=self.request())
+        view.object_list = view.get_queryset()
+        context = view.get_context_data()
+        return len(["%s" % receipt for receipt in context["receipts"]])
+
+    def dashboard_view(self):
+        today = date.today()
+        for year in (today.year - 1, today.year):
+            page_cache.bump("year:%i" % year)
+        return len(DashboardView(request=self.request()).get_context_data()["months"])
+
+    def supplier_autocomplete_cold(self):
+        autocomplete_cache.bump("supplier")
+        return len(SupplierAutocompleteView.as_view()(self.request(q="mar")).content)
+
+    def supplier_autocomplete_warm(self):
+        return len(SupplierAutocompleteView.as_view()(self.request(q="mar")).content)
+
+    def product_autocomplete_cold(self):
+        autocomplete_cache.bump("product")
+        return len(ProductAutocompleteView.as_view()(self.request(q="fresh mi")).content)
+
+    def product_autocomplete_warm(self):
+        return len(ProductAutocompleteView.as_view()(self.request(q="fresh mi")).content)
+
+    def receipt_str(self):
+        return len(["%s" % receipt for receipt in Receipt.objects.select_related("supplier")[:self.page_size]])
+
+    def receipt_status(self):
+        return len([receipt.status() for receipt in Receipt.objects.all()[:self.page_size]])
+
+    names = ("receipt_admin_changelist", "year_list_view", "dashboard_view", "supplier_autocomplete_cold",
+             "supplier_autocomplete_warm", "product_autocomplete_cold", "product_autocomplete_warm",
+             "receipt_str", "receipt_status")
+
+    def measure(self, name):
+        """Run a benchmark ``repeat`` times; returns its query counts and fastest and median seconds"""
+        timings = []
+        for run in range(self.repeat):
+            with QueryRecorder() as recorder:
+                started = time()
+                getattr(self, name)()
+                timings.append(time() - started)
+        timings.sort()
+        return {"benchmark": name, "queries": recorder.count, "sql_seconds": recorder.sql_time,
+                "duplicate_queries": sum(count - 1 for (signature, count) in recorder.duplicates()),
+                "min_seconds": timings[0], "median_seconds": timings[len(timings) // 2]}
+
+    def run(self, names=None):
+        return [self.measure(name) for name in (names or self.names)]
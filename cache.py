@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from hashlib import md5
+from threading import Lock
+from time import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class VersionedCache(object):
+    """Cache of rendered responses invalidated a group at a time by bumping a version counter
+
+    Version counters and entries live in the Django cache named by the ``MIZER_<NAME>_CACHE`` setting
+    (``"default"`` unless set), so local memory or file based storage is a matter of ``CACHES``
+    configuration. The most recently used ``MIZER_<NAME>_CACHE_SIZE`` entries are also kept in process
+    memory. Entries are rarely deleted; a bumped version simply stops them from being found.
+    """
+
+    def __init__(self, name, size=500, timeout=3600):
+        self.name = name
+        self.setting = "MIZER_%s_CACHE" % name.upper()
+        self.default_size = size
+        self.default_timeout = timeout
+        self.lock = Lock()
+        self.recent = OrderedDict()
+
+    @property
+    def backend(self):
+        return caches[getattr(settings, self.setting, "default")]
+
+    @property
+    def size(self):
+        return getattr(settings, "%s_SIZE" % self.setting, self.default_size)
+
+    @property
+    def timeout(self):
+        return getattr(settings, "%s_TIMEOUT" % self.setting, self.default_timeout)
+
+    def version_key(self, group):
+        return "mizer:%s:%s:version" % (self.name, group)
+
+    def version(self, group):
+        key = self.version_key(group)
+        version = self.backend.get(key)
+        if version is None:
+            # start from the clock, not 1, so an evicted counter can never resurrect old entries
+            self.backend.add(key, int(time() * 1000), None)
+            version = self.backend.get(key)
+        return version
+
+    def bump(self, group):
+        """Invalidate every entry of a group"""
+        try:
+            self.backend.incr(self.version_key(group))
+        except ValueError:
+            self.version(group)
+
+    def key(self, group, *parts):
+        digest = md5("\0".join("%s" % part for part in parts).encode("utf-8")).hexdigest()
+        return "mizer:%s:%s:%s:%s" % (self.name, group, self.version(group), digest)
+
+    def get(self, key):
+        with self.lock:
+            value = self.recent.pop(key, None)
+            if value is not None:
+                self.recent[key] = value  # most recently used last
+                return value
+        value = self.backend.get(key)
+        if value is not None:
+            self.remember(key, value)
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value, self.timeout)
+        self.remember(key, value)
+
+    def delete(self, key):
+        """Forget one entry, here and in the Django cache"""
+        with self.lock:
+            self.recent.pop(key, None)
+        self.backend.delete(key)
+
+    def remember(self, key, value):
+        with self.lock:
+            self.recent.pop(key, None)
+            self.recent[key] = value
+            while len(self.recent) > self.size:
+                self.recent.popitem(last=False)
+
+    def clear(self, *groups):
+        """Forget the in-process entries and start the given groups over"""
+        with self.lock:
+            self.recent.clear()
+        self.backend.delete_many([self.version_key(group) for group in groups])
+
+
+autocomplete_cache = VersionedCache("autocomplete")
+report_cache = VersionedCache("report", size=100, timeout=86400)
+# whether the thumbnails of a stored image name have been written, in group "ready"; set by thumbnails.py, only
+# ever True, and deleted by storage.py with the thumbnails
+thumbnail_cache = VersionedCache("thumbnail", size=5000, timeout=None)
+# year and dashboard page contexts, in groups "year:<year>" bumped by every change to the receipts of that year
+page_cache = VersionedCache("page", size=50, timeout=7 * 86400)
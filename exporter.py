@@ -0,0 +1,121 @@
+import csv
+import json
+
+from .models import Receipt
+
+
+CSV_COLUMNS = ("receipt", "date", "time", "supplier", "city", "state", "kind", "name", "code", "category", "quantity",
+               "amount")
+
+
+class Echo(object):
+    """File-like object handing back whatever is written to it, for streaming ``csv.writer`` output"""
+    def write(self, value):
+        return value
+
+
+def filter_receipts(queryset=None, start=None, end=None, supplier=None, product_type=None):
+    """Receipts dated from ``start`` through ``end``, from a supplier, with an item of a product type"""
+    queryset = Receipt.objects.all() if queryset is None else queryset
+    if start:
+        queryset = queryset.filter(date__gte=start)
+    if end:
+        queryset = queryset.filter(date__lte=end)
+    if supplier:
+        queryset = queryset.filter(supplier=supplier)
+    if product_type:
+        queryset = queryset.filter(pk__in=Receipt.objects.filter(items__product__types=product_type).values("pk"))
+    return queryset
+
+
+class ReceiptExporter(object):
+    """Stream receipts with all their components in the formats read by ``import_receipts``
+
+    Receipts are read in primary key order, ``chunk_size`` at a time, each chunk with its components
+    prefetched, so memory use depends on the chunk size and not on the number of receipts exported.
+    """
+    prefetch = ("items__product__types", "fees", "discounts", "taxes__tax", "gratuities",
+                "payments__payment_method__type")
+
+    def __init__(self, queryset, chunk_size=500):
+        self.queryset = queryset
+        self.chunk_size = chunk_size
+
+    def chunks(self):
+        last_pk = 0
+        while True:
+            chunk = list(self.queryset
+                         .filter(pk__gt=last_pk)
+                         .order_by("pk")
+                         .select_related("supplier")
+                         .prefetch_related(*self.prefetch)[:self.chunk_size])
+            if chunk:
+                yield chunk
+            if len(chunk) < self.chunk_size:
+                return
+            last_pk = chunk[-1].pk
+
+    def receipts(self):
+        """Yield every receipt as an ``importer.ReceiptImporter`` dict, plus its id and totals"""
+        for chunk in self.chunks():
+            for receipt in chunk:
+                yield self.as_dict(receipt)
+
+    @staticmethod
+    def as_dict(receipt):
+        supplier = receipt.supplier
+        return {
+            "id": receipt.pk,
+            "date": receipt.date.isoformat(),
+            "time": receipt.time.strftime("%H:%M:%S") if receipt.time else None,
+            "supplier": {"name": supplier.name, "street": supplier.street, "city": supplier.city,
+                         "state": supplier.state, "postal_code": supplier.postal_code, "phone": supplier.phone,
+                         "website": supplier.website},
+            "items": [{"product": {"name": item.product.name, "code": item.product.code,
+                                   "types": [product_type.name for product_type in item.product.types.all()]},
+                       "quantity": "%s" % item.quantity, "unit_price": "%s" % item.unit_price}
+                      for item in receipt.items.all()],
+            "fees": [{"name": fee.name, "quantity": fee.quantity, "amount": "%s" % fee.amount}
+                     for fee in receipt.fees.all()],
+            "discounts": [{"name": discount.name, "amount": "%s" % discount.amount}
+                          for discount in receipt.discounts.all()],
+            "taxes": [{"tax": charge.tax.name, "amount": "%s" % charge.amount} for charge in receipt.taxes.all()],
+            "gratuities": [{"to": tip.to, "amount": "%s" % tip.amount} for tip in receipt.gratuities.all()],
+            "payments": [{"payment_method": {"bank": payment.payment_method.bank,
+                                             "last4": payment.payment_method.last4,
+                                             "type": payment.payment_method.type.name},
+                          "amount": "%s" % payment.amount}
+                         for payment in receipt.payments.all()],
+            "totals": dict((field.replace("_cache", ""), None if getattr(receipt, field) is None
+                            else "%s" % getattr(receipt, field))
+                           for field in Receipt.totals_cache_fields),
+        }
+
+    def jsonl(self):
+        """Yield one JSON line per receipt"""
+        for receipt in self.receipts():
+            yield json.dumps(receipt, sort_keys=True) + "\n"
+
+    def csv(self):
+        """Yield a header line, then one line per receipt component; receipts without any get one bare line"""
+        writer = csv.writer(Echo())
+        yield writer.writerow(CSV_COLUMNS)
+        for receipt in self.receipts():
+            supplier = receipt["supplier"]
+            head = [receipt["id"], receipt["date"], receipt["time"] or "", supplier["name"], supplier["city"] or "",
+                    supplier["state"] or ""]
+            rows = ([["item", item["product"]["name"], item["product"]["code"] or "",
+                      "|".join(item["product"]["types"]), item["quantity"], item["unit_price"]]
+                     for item in receipt["items"]]
+                    + [["fee", fee["name"], "", "", fee["quantity"], fee["amount"]] for fee in receipt["fees"]]
+                    + [["discount", discount["name"], "", "", "", discount["amount"]]
+                       for discount in receipt["discounts"]]
+                    + [["tax", tax["tax"], "", "", "", tax["amount"]] for tax in receipt["taxes"]]
+                    + [["tip", tip["to"] or "", "", "", "", tip["amount"]] for tip in receipt["gratuities"]]
+                    + [["payment", payment["payment_method"]["bank"], payment["payment_method"]["last4"] or "",
+                        payment["payment_method"]["type"], "", payment["amount"]] for payment in receipt["payments"]])
+            for row in rows or [[""] * 6]:
+                yield writer.writerow(head + row)
+
+    def lines(self, format):
+        return {"csv": self.csv, "jsonl": self.jsonl}[format]()
@@ -0,0 +1,104 @@
+from datetime import date, time, timedelta
+from decimal import Decimal
+from random import Random
+
+from .importer import ReceiptImporter
+
+
+CENT = Decimal("0.01")
+
+
+class ReceiptGenerator(object):
+    """Reproducible synthetic receipts, as dicts written by ``importer.ReceiptImporter``
+
+    The same ``seed`` always yields the same receipts. A few suppliers and products are far more popular
+    than the rest, receipts hold mostly a handful of items with a long tail of large shops, and fees,
+    discounts, taxes, tips and split or short payments turn up at roughly the rates of real grocery data.
+    Receipts are spread over the ``days`` days ending ``end``.
+    """
+    adjectives = ("Organic", "Fresh", "Whole", "Frozen", "Smoked", u"Cr\xe8me", "Spicy", "Sweet", "Large", "Light")
+    nouns = ("Milk", "Bread", "Cheese", "Apples", "Coffee", u"Br\xfbl\xe9e", "Pasta", "Rice", "Salmon", "Tomatoes",
+             "Yogurt", "Butter", "Eggs", "Chicken", "Lettuce", "Oranges", "Beans", "Juice", "Cereal", "Soap")
+    product_types = ("Dairy", "Bakery", "Produce", "Meat", "Seafood", "Frozen", "Pantry", "Drinks", "Snacks",
+                     "Household", "Personal Care", "Deli")
+    cities = (("Springfield", "IL"), ("Portland", "OR"), ("Austin", "TX"), ("Madison", "WI"), ("Salem", "MA"))
+    fees = ("Bag", "Bottle Deposit", "Delivery")
+    discounts = ("Coupon", "Member Savings", "Clearance")
+    taxes = ("Sales Tax", "City Tax")
+    banks = ("First Bank", "Credit Union", "Savings & Loan")
+    payment_method_types = ("Credit Card", "Debit Card", "Cash")
+
+    def __init__(self, seed=0, suppliers=50, products=1000, end=date(2017, 12, 31), days=3 * 365):
+        self.random = Random(seed)
+        self.end = end
+        self.days = days
+        self.suppliers = [self.supplier(index) for index in range(suppliers)]
+        self.products = [self.product(index) for index in range(products)]
+        self.payment_methods = [{"bank": self.random.choice(self.banks), "last4": "%04i" % self.random.randrange(10000),
+                                 "type": self.random.choice(self.payment_method_types)} for index in range(5)]
+
+    def popular(self, rows):
+        """A row picked with a long tailed popularity: the first rows are picked far more often"""
+        return rows[min(int(self.random.paretovariate(1.2)) - 1, len(rows) - 1)]
+
+    def price(self, low, high):
+        return Decimal(self.random.uniform(low, high)).quantize(CENT)
+
+    def supplier(self, index):
+        (city, state) = self.random.choice(self.cities)
+        return {"name": "%s Market %i" % (self.random.choice(self.adjectives), index), "city": city, "state": state,
+                "postal_code": "%05i" % self.random.randrange(100000)}
+
+    def product(self, index):
+        return {"name": "%s %s %i" % (self.random.choice(self.adjectives), self.random.choice(self.nouns), index),
+                "code": "%012i" % self.random.randrange(10 ** 12) if self.random.random() < 0.7 else None,
+                "types": self.random.sample(self.product_types, self.random.choice((1, 1, 1, 2)))}
+
+    def receipt(self):
+        day = self.end - timedelta(days=self.random.randrange(self.days))
+        items = [{"product": self.popular(self.products), "quantity": "%s" % self.random.choice((1, 1, 1, 2, 3)),
+                  "unit_price": "%s" % self.price(0.5, 25)}
+                 for index in range(min(int(self.random.expovariate(1 / 8.0)) + 1, 120))]
+        receipt = {"supplier": self.popular(self.suppliers), "date": day.isoformat(),
+                   "time": time(self.random.randrange(7, 22), self.random.randrange(60)).isoformat(),
+                   "items": items, "fees": [], "discounts": [], "taxes": [], "gratuities": [], "payments": []}
+        subtotal = sum(Decimal(item["unit_price"]) * Decimal(item["quantity"]) for item in items)
+        if self.random.random() < 0.3:
+            receipt["fees"].append({"name": self.random.choice(self.fees), "amount": "%s" % self.price(0.05, 5)})
+        if self.random.random() < 0.2:
+            receipt["discounts"].append({"name": self.random.choice(self.discounts),
+                                         "amount": "%s" % (subtotal * Decimal("0.1")).quantize(CENT)})
+        if self.random.random() < 0.8:
+            receipt["taxes"].append({"tax": self.random.choice(self.taxes),
+                                     "amount": "%s" % (subtotal * Decimal("0.06")).quantize(CENT)})
+        if self.random.random() < 0.1:
+            receipt["gratuities"].append({"to": "Staff", "amount": "%s" % self.price(1, 10)})
+        total = (subtotal + sum(Decimal(fee["amount"]) for fee in receipt["fees"])
+                 - sum(Decimal(discount["amount"]) for discount in receipt["discounts"])
+                 + sum(Decimal(tax["amount"]) for tax in receipt["taxes"])
+                 + sum(Decimal(tip["amount"]) for tip in receipt["gratuities"])).quantize(CENT)
+        chance = self.random.random()
+        if chance < 0.1:  # split between two cards
+            first = (total / 2).quantize(CENT)
+            amounts = [first, total - first]
+        elif chance < 0.12:  # short paid
+            amounts = [total - self.price(0.01, 1)]
+        elif chance < 0.15:  # not entered
+            amounts = []
+        else:
+            amounts = [total]
+        receipt["payments"] = [{"payment_method": self.random.choice(self.payment_methods), "amount": "%s" % amount}
+                               for amount in amounts]
+        return receipt
+
+    def receipts(self, count):
+        for index in range(count):
+            yield self.receipt()
+
+    def write(self, count, chunk_size=500):
+        """Write ``count`` more receipts, ``chunk_size`` per transaction; yields the rows written per chunk"""
+        importer = ReceiptImporter()
+        while count > 0:
+            chunk = list(self.receipts(min(count, chunk_size)))
+            yield importer.write(chunk)[1]
+            count -= len(chunk)
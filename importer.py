@@ -0,0 +1,305 @@
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.backends.base.operations import BaseDatabaseOperations
+from django.utils import six
+from django.utils.dateparse import parse_date, parse_time
+
+from .models import (Supplier, Tax, ProductType, Product, PaymentMethodType, PaymentMethod, Receipt, Item, Fee,
+                     Discount, TaxCharge, Gratuity, Payment, defer_totals, touch_receipt_totals,
+                     touch_supplier_stats)
+
+
+class ReceiptImportError(ValueError):
+    """An invalid receipt; ``index`` is its position in the batch passed to ``ReceiptImporter.write``"""
+    index = None
+
+
+class ReceiptImporter(object):
+    """Write receipts described as plain dicts, resolving related rows through in-memory caches
+
+    A receipt is ``{"supplier": ..., "date": "YYYY-MM-DD", "time": "HH:MM", "items": [...], "fees": [...],
+    "discounts": [...], "taxes": [...], "gratuities": [...], "payments": [...]}`` where
+
+    * ``supplier`` is a name or ``{"name", "street", "city", "state", "postal_code", "phone", "website"}``
+    * an item is ``{"product", "quantity", "unit_price"}`` and ``product`` a name or ``{"name", "code", "types"}``
+    * a fee is ``{"name", "quantity", "amount"}``, a discount ``{"name", "amount"}``,
+      a tax ``{"tax", "amount"}`` and a gratuity ``{"to", "amount"}``
+    * a payment is ``{"payment_method": {"bank", "last4", "type"}, "amount"}``
+
+    Suppliers, products, product types, taxes and payment methods are matched by name (products by code
+    first) and created when missing. Each cache grows with the number of distinct rows it resolves, never
+    with the number of receipts written.
+    """
+    supplier_fields = ("street", "city", "state", "postal_code", "phone", "website")
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.suppliers = {}
+        self.products = {}
+        self.product_types = {}
+        self.taxes = {}
+        self.payment_method_types = {}
+        self.payment_methods = {}
+
+    @staticmethod
+    def named(value, key="name"):
+        """Accept either a bare name or a dict holding it"""
+        data = value if isinstance(value, dict) else {key: value}
+        if not data.get(key):
+            raise ReceiptImportError("missing %s" % key)
+        return data
+
+    @staticmethod
+    def decimal(data, key, default=None, model=None):
+        """The number at ``key``, which must fit the ``model`` field of that name when one is given"""
+        value = data.get(key, default)
+        try:
+            number = Decimal("%s" % value)
+            if model is not None:
+                if not number.is_finite():
+                    raise ValidationError("not a number")
+                model._meta.get_field(key).run_validators(number)
+            return number
+        except (InvalidOperation, TypeError, ValueError, ValidationError):
+            raise ReceiptImportError("invalid %s: %r" % (key, value))
+
+    @staticmethod
+    def fee_quantity(fee):
+        """The whole, positive quantity of a fee, 1 when it has none"""
+        value = fee.get("quantity")
+        if value is None:
+            return 1
+        quantity = "%s" % value
+        largest = BaseDatabaseOperations.integer_field_ranges["PositiveIntegerField"]  # SQLite validates none
+        if isinstance(value, bool) or not quantity.isdigit() or not 0 < int(quantity) <= largest[1]:
+            raise ReceiptImportError("invalid quantity: %r" % (value,))
+        return int(quantity)
+
+    @staticmethod
+    def text(model, name, value):
+        """Check an optional string against the length of the ``model`` field it is written to"""
+        if value is None:
+            return
+        max_length = model._meta.get_field(name).max_length
+        if not isinstance(value, six.string_types) or (max_length and len(value) > max_length):
+            raise ReceiptImportError("invalid %s: %r" % (name, value))
+
+    @staticmethod
+    def components(data, key):
+        """The list of component objects at ``key``"""
+        components = data.get(key, [])
+        if not isinstance(components, list) or not all(isinstance(component, dict) for component in components):
+            raise ReceiptImportError("invalid %s: %r" % (key, components))
+        return components
+
+    @staticmethod
+    def supplier_key(data):
+        return (data["name"], data.get("city") or None, data.get("state") or None)
+
+    @staticmethod
+    def product_key(data):
+        return ("code", data["code"]) if data.get("code") else ("name", data["name"])
+
+    @staticmethod
+    def payment_method_key(data):
+        return (data["bank"], data.get("last4") or None, data.get("type") or data["bank"])
+
+    def preload(self, receipts):
+        """Resolve every related row a batch of receipts mentions with one ``in`` query per model"""
+        suppliers, products, types, taxes, methods = set(), set(), set(), set(), set()
+        for receipt in receipts:
+            suppliers.add(self.supplier_key(self.named(receipt.get("supplier"))))
+            for item in receipt.get("items", ()):
+                product = self.named(item.get("product"))
+                products.add(self.product_key(product))
+                types.update(product.get("types", ()))
+            for tax in receipt.get("taxes", ()):
+                taxes.add(tax.get("tax"))
+            for payment in receipt.get("payments", ()):
+                methods.add(self.payment_method_key(self.named(payment.get("payment_method"), "bank")))
+
+        missing = set(key for key in suppliers if key not in self.suppliers)
+        for supplier in Supplier.objects.filter(name__in=set(key[0] for key in missing)):
+            key = (supplier.name, supplier.city, supplier.state)
+            if key in missing:
+                self.suppliers.setdefault(key, supplier)
+        missing = set(key for key in products if key not in self.products)
+        for (field, values) in (("code", set(v for (f, v) in missing if f == "code")),
+                                ("name", set(v for (f, v) in missing if f == "name"))):
+            for product in Product.objects.filter(**{"%s__in" % field: values}).order_by("pk"):
+                self.products.setdefault((field, getattr(product, field)), product)
+        self.preload_names(ProductType, self.product_types, types)
+        self.preload_names(Tax, self.taxes, taxes)
+        self.preload_names(PaymentMethodType, self.payment_method_types, set(key[2] for key in methods))
+        missing = set(key for key in methods if key not in self.payment_methods)
+        for method in PaymentMethod.objects.filter(bank__in=set(key[0] for key in missing)).select_related("type"):
+            key = (method.bank, method.last4 or None, method.type.name)
+            if key in missing:
+                self.payment_methods.setdefault(key, method)
+
+    @staticmethod
+    def preload_names(model, cache, names):
+        for instance in model.objects.filter(name__in=set(name for name in names if name not in cache)).order_by("pk"):
+            cache.setdefault(instance.name, instance)
+
+    def supplier(self, value):
+        data = self.named(value)
+        key = self.supplier_key(data)
+        if key not in self.suppliers:
+            self.suppliers[key] = (Supplier.objects.filter(name=key[0], city=key[1], state=key[2]).first()
+                                   or Supplier.objects.create(name=data["name"], **dict(
+                                       (field, data.get(field) or None) for field in self.supplier_fields)))
+        return self.suppliers[key]
+
+    def product(self, value):
+        data = self.named(value)
+        key = self.product_key(data)
+        if key not in self.products:
+            product = Product.objects.filter(**{key[0]: key[1]}).order_by("pk").first()
+            if product is None:
+                product = Product.objects.create(name=data["name"], code=data.get("code") or None)
+                product.types.add(*[self.by_name(ProductType, self.product_types, name)
+                                    for name in data.get("types", ())])
+            self.products[key] = product
+        return self.products[key]
+
+    @staticmethod
+    def by_name(model, cache, name):
+        if name not in cache:
+            cache[name] = model.objects.filter(name=name).order_by("pk").first() or model.objects.create(name=name)
+        return cache[name]
+
+    def payment_method(self, value):
+        data = self.named(value, "bank")
+        key = self.payment_method_key(data)
+        if key not in self.payment_methods:
+            method_type = self.by_name(PaymentMethodType, self.payment_method_types, key[2])
+            self.payment_methods[key] = (
+                PaymentMethod.objects.filter(bank=key[0], last4=key[1], type=method_type).first()
+                or PaymentMethod.objects.create(bank=key[0], last4=key[1], type=method_type))
+        return self.payment_methods[key]
+
+    def validate(self, data):
+        """Check a receipt dict without touching the database
+
+        Every value is checked against the model field it is written to, so that no invalid receipt
+        gets as far as the database.
+        """
+        if not isinstance(data, dict):
+            raise ReceiptImportError("a receipt must be an object")
+        for (key, parse, required) in (("date", parse_date, True), ("time", parse_time, False)):
+            try:
+                valid = parse(data[key]) is not None if data.get(key) else not required
+            except (TypeError, ValueError):  # not a string, or well formed but out of range
+                valid = False
+            if not valid:
+                raise ReceiptImportError("invalid %s: %r" % (key, data.get(key)))
+        supplier = self.named(data.get("supplier"))
+        self.text(Supplier, "name", supplier["name"])
+        for field in self.supplier_fields:
+            self.text(Supplier, field, supplier.get(field) or None)
+        for item in self.components(data, "items"):
+            product = self.named(item.get("product"))
+            self.text(Product, "name", product["name"])
+            self.text(Product, "code", product.get("code") or None)
+            types = product.get("types", [])
+            if not isinstance(types, list):
+                raise ReceiptImportError("invalid types: %r" % (types,))
+            for name in types:
+                self.text(ProductType, "name", name)
+            self.decimal(item, "quantity", 1, Item)
+            self.decimal(item, "unit_price", model=Item)
+        for fee in self.components(data, "fees"):
+            self.text(Fee, "name", self.named(fee)["name"])
+            self.decimal(fee, "amount", model=Fee)
+            self.fee_quantity(fee)
+        for discount in self.components(data, "discounts"):
+            self.text(Discount, "name", self.named(discount)["name"])
+            self.decimal(discount, "amount", model=Discount)
+        for tax in self.components(data, "taxes"):
+            self.text(Tax, "name", self.named(tax, "tax")["tax"])
+            self.decimal(tax, "amount", model=TaxCharge)
+        for tip in self.components(data, "gratuities"):
+            self.text(Gratuity, "to", tip.get("to") or None)
+            self.decimal(tip, "amount", model=Gratuity)
+        for payment in self.components(data, "payments"):
+            method = self.named(payment.get("payment_method"), "bank")
+            self.text(PaymentMethod, "bank", method["bank"])
+            self.text(PaymentMethod, "last4", method.get("last4") or None)
+            self.text(PaymentMethodType, "name", method.get("type") or None)
+            self.decimal(payment, "amount", model=Payment)
+
+    def build(self, data):
+        """Return an unsaved receipt and a ``{model: [unsaved components]}`` dict for it"""
+        receipt = Receipt(supplier=self.supplier(data.get("supplier")),
+                          date=parse_date(data["date"]),
+                          time=parse_time(data["time"]) if data.get("time") else None)
+        components = {
+            Item: [Item(receipt=receipt, product=self.product(item.get("product")),
+                        quantity=self.decimal(item, "quantity", 1), unit_price=self.decimal(item, "unit_price"))
+                   for item in data.get("items", ())],
+            Fee: [Fee(receipt=receipt, name=self.named(fee)["name"], quantity=self.fee_quantity(fee),
+                      amount=self.decimal(fee, "amount"))
+                  for fee in data.get("fees", ())],
+            Discount: [Discount(receipt=receipt, name=self.named(discount)["name"],
+                                amount=self.decimal(discount, "amount"))
+                       for discount in data.get("discounts", ())],
+            TaxCharge: [TaxCharge(receipt=receipt, tax=self.by_name(Tax, self.taxes, self.named(tax, "tax")["tax"]),
+                                  amount=self.decimal(tax, "amount"))
+                        for tax in data.get("taxes", ())],
+            Gratuity: [Gratuity(receipt=receipt, to=tip.get("to") or None, amount=self.decimal(tip, "amount"))
+                       for tip in data.get("gratuities", ())],
+            Payment: [Payment(receipt=receipt, payment_method=self.payment_method(payment.get("payment_method")),
+                              amount=self.decimal(payment, "amount"))
+                      for payment in data.get("payments", ())],
+        }
+        return (receipt, components)
+
+    def write(self, receipts):
+        """Write a batch of receipts and their components in one transaction
+
+        Returns the saved receipts, with their totals, and the number of rows written. Nothing is written
+        when any receipt is invalid.
+        """
+        for (index, data) in enumerate(receipts):
+            try:
+                self.validate(data)
+            except ReceiptImportError as error:
+                error.index = index
+                raise
+        try:
+            self.preload(receipts)
+            with transaction.atomic():
+                return self.write_valid(receipts)
+        except Exception:
+            self.clear()  # cached rows may have been created by the rolled back transaction
+            raise
+
+    def write_valid(self, receipts):
+        built = [self.build(data) for data in receipts]
+        instances = [receipt for (receipt, components) in built]
+        with defer_totals():
+            if connection.features.can_return_ids_from_bulk_insert:
+                Receipt.objects.bulk_create(instances)
+                for receipt in instances:  # bulk created receipts send no signals
+                    touch_supplier_stats(receipt.supplier_id, visits=1, visited={receipt.date})
+            else:
+                for receipt in instances:
+                    receipt.save()
+            rows = len(instances)
+            for model in (Item, Fee, Discount, TaxCharge, Gratuity, Payment):
+                objs = []
+                for (receipt, components) in built:
+                    for component in components[model]:
+                        component.receipt = receipt  # picks up the primary key assigned on save
+                        objs.append(component)
+                if objs:
+                    model.objects.bulk_create(objs)
+                    rows += len(objs)
+            for receipt in instances:
+                touch_receipt_totals(receipt.pk, receipt)  # reload the in-memory totals too
+        return (instances, rows)
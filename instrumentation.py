@@ -0,0 +1,136 @@
+from collections import Counter, deque
+from contextlib import contextmanager
+from logging import getLogger
+from re import compile as regex
+from time import time
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = getLogger("mizer.queries")
+
+LITERALS = (
+    (regex(r"'(?:[^']|'')*'"), "?"),  # quoted strings
+    (regex(r"\b\d+(?:\.\d+)?\b"), "?"),  # numbers
+    (regex(r"\((?:\s*\?\s*,)+\s*\?\s*\)"), "(...)"),  # IN lists of any length
+)
+
+
+def query_signature(sql):
+    """The SQL with its literals replaced, so the same statement run for each row gives one signature
+
+    >>> query_signature('SELECT * FROM "mizer_tax" WHERE "mizer_tax"."id" IN (1, 2, 3) AND name = \\'VAT\\'')
+    'SELECT * FROM "mizer_tax" WHERE "mizer_tax"."id" IN (...) AND name = ?'
+    """
+    for (pattern, replacement) in LITERALS:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+class QueryRecorder(object):
+    """Record every query run on the given database connections (all of them by default)
+
+    Used as a context manager. Queries are read from each connection's debug cursor log, which this
+    forces on while recording, so it also works with ``DEBUG = False``. The log is swapped for an
+    unbounded one while recording and the recorded queries appended to it afterwards, since the
+    connection's own log stops growing once it holds ``queries_limit`` entries. Django 1.11 has no
+    ``execute_wrapper`` hook to time statements more cheaply.
+    """
+
+    def __init__(self, using=None, slowest=5):
+        self.using = using
+        self.slowest_count = slowest
+        self.queries = []
+        self.elapsed = 0
+
+    def __enter__(self):
+        self.connections = [connections[alias] for alias in self.using] if self.using else connections.all()
+        self.state = [(connection.force_debug_cursor, connection.queries_log) for connection in self.connections]
+        for connection in self.connections:
+            connection.force_debug_cursor = True
+            connection.queries_log = deque()
+        self.started = time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time() - self.started
+        for (connection, (forced, log)) in zip(self.connections, self.state):
+            (recorded, connection.queries_log) = (connection.queries_log, log)
+            connection.force_debug_cursor = forced
+            log.extend(recorded)  # enclosing recorders and DEBUG query logging see them too
+            self.queries.extend(dict(query, using=connection.alias) for query in recorded)
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def sql_time(self):
+        """Seconds spent in the database"""
+        return sum(float(query["time"]) for query in self.queries)
+
+    def duplicates(self):
+        """``(signature, count)`` of statements run more than once, the most repeated first: N+1 suspects"""
+        counts = Counter(query_signature(query["sql"]) for query in self.queries)
+        return [(signature, count) for (signature, count) in counts.most_common() if count > 1]
+
+    def slowest(self):
+        return sorted(self.queries, key=lambda query: -float(query["time"]))[:self.slowest_count]
+
+    def summary(self):
+        return {"queries": self.count, "sql_time": round(self.sql_time, 4), "time": round(self.elapsed, 4),
+                "duplicates": self.duplicates(),
+                "slowest": [(float(query["time"]), query["sql"]) for query in self.slowest()]}
+
+    def report(self):
+        """A multi-line description of the recorded queries, for logs and failed assertions"""
+        lines = ["%i queries in %.1f ms" % (self.count, self.sql_time * 1000)]
+        lines += ["  %ix %s" % (count, signature) for (signature, count) in self.duplicates()]
+        lines += ["  %.1f ms %s" % (float(query["time"]) * 1000, query["sql"]) for query in self.slowest()]
+        return "\n".join(lines)
+
+
+@contextmanager
+def query_budget(limit, using=None):
+    """Fail with a report of duplicated and slowest statements when the block runs more than ``limit`` queries
+
+    >>> with query_budget(5):
+    ...     admin.changelist_view(request).render()
+    """
+    with QueryRecorder(using) as recorder:
+        yield recorder
+    if recorder.count > limit:
+        raise AssertionError("Query budget of %i exceeded: %s" % (limit, recorder.report()))
+
+
+class QueryCountMiddleware(object):
+    """Report the queries of each request in ``X-Mizer-*`` response headers and the ``mizer.queries`` log
+
+    Every request is logged at debug level, with the view name, query count, SQL time and duplicated
+    statements. Requests to a view named in the ``MIZER_QUERY_BUDGETS`` setting (e.g.
+    ``{"mizer_year": 5, "admin:mizer_receipt_changelist": 10}``) that exceed its budget are logged as
+    warnings with their slowest statements. Queries run while a streaming response is being sent are not
+    counted.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+        match = getattr(request, "resolver_match", None)
+        view = match.view_name if match else request.path
+        response["X-Mizer-Queries"] = "%i" % recorder.count
+        response["X-Mizer-SQL-Time"] = "%.1f" % (recorder.sql_time * 1000)
+        response["X-Mizer-Duplicate-Queries"] = "%i" % sum(count - 1 for (signature, count) in recorder.duplicates())
+
+        budget = getattr(settings, "MIZER_QUERY_BUDGETS", {}).get(view)
+        if budget is not None and recorder.count > budget:
+            response["X-Mizer-Query-Budget"] = "%i exceeded" % budget
+            logger.warning("%s exceeded its budget of %i queries: %s", view, budget, recorder.report())
+        else:
+            logger.debug("%s: %i queries, %.1f ms SQL, duplicates %s", view, recorder.count,
+                         recorder.sql_time * 1000, recorder.duplicates())
+        return response
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from mizer.cache import page_cache, report_cache
+from mizer.models import Receipt, SpendingRollup
+
+
+class Command(BaseCommand):
+    help = "Rebuild the spending rollup table from the full receipt history"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000,
+                            help="Number of receipts summed per batch of grouped queries")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        with transaction.atomic():
+            # the writers of the rollup wait for the rebuild, so no receipt saved meanwhile is lost or counted twice:
+            # PostgreSQL locks the table, the delete takes SQLite's database-wide write lock before the scan
+            if connection.vendor == "postgresql":
+                with connection.cursor() as cursor:
+                    cursor.execute("LOCK TABLE %s IN EXCLUSIVE MODE"
+                                   % connection.ops.quote_name(SpendingRollup._meta.db_table))
+            years = set(SpendingRollup.objects.order_by().values_list("year", flat=True).distinct())
+            SpendingRollup.objects.all().delete()
+            # memory is bounded by the number of rollup keys, never by the number of receipts
+            rollup = {}
+            receipts = 0
+            last_pk = 0
+            while True:
+                pks = list(Receipt.objects.filter(pk__gt=last_pk).order_by("pk")
+                           .values_list("pk", flat=True)[:chunk_size])
+                if not pks:
+                    break
+                last_pk = pks[-1]
+                receipts += len(pks)
+                SpendingRollup.objects.merge(rollup, SpendingRollup.objects.receipt_contributions(pks))
+                if options["verbosity"] > 1:
+                    self.stdout.write("Summed %i receipts into %i rollup rows" % (receipts, len(rollup)))
+            years.update(year for (year, month, supplier_id, product_type_id) in rollup)
+            SpendingRollup.objects.bulk_create(
+                (SpendingRollup(year=year, month=month, supplier_id=supplier_id, product_type_id=product_type_id,
+                                **sums)
+                 for ((year, month, supplier_id, product_type_id), sums) in rollup.items()),
+                batch_size=chunk_size)
+        for year in years:  # the reports and pages of every year rebuilt or dropped
+            report_cache.bump("spending:%i" % year)
+            page_cache.bump("year:%i" % year)
+        self.stdout.write("Rebuilt %i rollup rows from %i receipts" % (len(rollup), receipts))
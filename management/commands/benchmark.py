@@ -0,0 +1,53 @@
+import json
+from datetime import datetime
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from mizer.benchmarks import Benchmarks
+from mizer.generator import ReceiptGenerator
+from mizer.models import Receipt
+
+
+class Command(BaseCommand):
+    help = ("Measure wall time and query count of the admin changelist, year and dashboard views, autocomplete "
+            "and receipt rendering, and write the results as JSON. With --sizes, synthetic receipts are added "
+            "before each round, so it must be run against a scratch database and confirmed with --write-synthetic.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", help="Comma separated receipt counts to grow the database to, e.g. 1000,10000,100000")
+        parser.add_argument("--write-synthetic", action="store_true", dest="write_synthetic",
+                            help="Confirm that --sizes may add synthetic receipts to the configured database")
+        parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs of each benchmark")
+        parser.add_argument("--benchmark", action="append", choices=Benchmarks.names, dest="benchmarks",
+                            help="Benchmark to run, all by default; may be repeated")
+        parser.add_argument("--output", help="JSON file to write, standard output by default")
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options["sizes"].split(",")] if options["sizes"] else [None]
+        except ValueError:
+            raise CommandError("Invalid --sizes: %s" % options["sizes"])
+        if options["sizes"] and not options["write_synthetic"]:
+            raise CommandError("--sizes adds synthetic receipts to the %s database %s; add --write-synthetic if it is "
+                               "a scratch database" % (connection.vendor, connection.settings_dict["NAME"]))
+        generator = ReceiptGenerator(seed=options["seed"]) if options["sizes"] else None
+        benchmarks = Benchmarks(repeat=options["repeat"])
+        report = {"created": datetime.now().isoformat(), "django": django.get_version(),
+                  "database": connection.vendor, "seed": options["seed"], "repeat": options["repeat"], "rounds": []}
+        for size in sizes:
+            if size is not None:
+                sum(generator.write(max(size - Receipt.objects.count(), 0)))
+            report["rounds"].append({"receipts": Receipt.objects.count(),
+                                     "results": benchmarks.run(options["benchmarks"])})
+            if options["verbosity"] > 1:
+                self.stderr.write("Measured %i receipts" % report["rounds"][-1]["receipts"])
+
+        content = json.dumps(report, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                output.write(content)
+        else:
+            self.stdout.write(content)
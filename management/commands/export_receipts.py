@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from mizer.exporter import ReceiptExporter, filter_receipts
+
+
+class Command(BaseCommand):
+    help = "Stream receipts with their items and charges as CSV or JSON lines, in the import_receipts formats"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=("csv", "jsonl"), default="jsonl")
+        parser.add_argument("--output", help="File to write, standard output by default")
+        parser.add_argument("--start", help="First receipt date, YYYY-MM-DD")
+        parser.add_argument("--end", help="Last receipt date, YYYY-MM-DD")
+        parser.add_argument("--supplier", type=int, help="Supplier id")
+        parser.add_argument("--product-type", type=int, help="Product type id; receipts with an item of that type")
+        parser.add_argument("--chunk-size", type=int, default=500, help="Number of receipts read per batch")
+
+    def handle(self, *args, **options):
+        dates = {}
+        for key in ("start", "end"):
+            if options[key]:
+                dates[key] = parse_date(options[key])
+                if dates[key] is None:
+                    raise CommandError("Invalid %s date: %s" % (key, options[key]))
+        receipts = filter_receipts(supplier=options["supplier"], product_type=options["product_type"], **dates)
+        exporter = ReceiptExporter(receipts, chunk_size=options["chunk_size"])
+
+        if not options["output"]:
+            for line in exporter.lines(options["format"]):
+                self.stdout.write(line, ending="")
+            return
+        with open(options["output"], "w") as output:
+            output.writelines(exporter.lines(options["format"]))
@@ -0,0 +1,25 @@
+from time import time
+
+from django.core.management.base import BaseCommand
+
+from mizer.generator import ReceiptGenerator
+
+
+class Command(BaseCommand):
+    help = "Write reproducible synthetic suppliers, products and receipts, e.g. into a scratch database for benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("count", type=int, help="Number of receipts to write")
+        parser.add_argument("--seed", type=int, default=0, help="Seed; the same seed writes the same data")
+        parser.add_argument("--suppliers", type=int, default=50)
+        parser.add_argument("--products", type=int, default=1000)
+        parser.add_argument("--chunk-size", type=int, default=500, help="Number of receipts written per transaction")
+
+    def handle(self, *args, **options):
+        generator = ReceiptGenerator(seed=options["seed"], suppliers=options["suppliers"],
+                                     products=options["products"])
+        started = time()
+        rows = 0
+        for written in generator.write(options["count"], options["chunk_size"]):
+            rows += written
+        self.stdout.write("Generated %i receipts, %i rows in %.1fs" % (options["count"], rows, time() - started))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from mizer.models import Product, Receipt
+from mizer.thumbnails import thumbnails
+
+
+class Command(BaseCommand):
+    help = "Write the missing thumbnails of product and receipt images, e.g. for images stored before thumbnails"
+
+    def handle(self, *args, **options):
+        for model in (Product, Receipt):
+            storage = model._meta.get_field("image").storage
+            written = 0
+            for name in model.objects.exclude(image="").exclude(image=None).values_list("image", flat=True).iterator():
+                written += len(thumbnails.generate(storage, name))
+            self.stdout.write("Wrote %i %s thumbnails" % (written, model._meta.verbose_name))
@@ -0,0 +1,118 @@
+import csv
+import io
+import json
+from itertools import groupby
+from time import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mizer.importer import ReceiptImporter, ReceiptImportError
+
+
+CSV_HELP = """
+CSV files hold one row per receipt component with the columns receipt, date, time, supplier, city, state,
+kind, name, code, category, quantity and amount. Consecutive rows sharing a receipt value form one receipt,
+whose date, time and supplier are read from its first row. kind is item, fee, discount, tax, tip, payment
+or blank for a receipt without components; name is the product, fee, discount or tax name, the gratuity
+recipient or the payment bank; code is the product code or the card's last 4 digits; category is the
+product types separated by "|" or the payment method type; amount is the item unit price or the component
+amount.
+"""
+
+
+def read_jsonl(stream):
+    """Yield ``(line number, receipt)`` for every non-blank line of a JSON lines stream"""
+    for (number, line) in enumerate(stream, 1):
+        if line.strip():
+            try:
+                yield (number, json.loads(line))
+            except ValueError as error:
+                raise CommandError("line %i: %s" % (number, error))
+
+
+def read_csv(stream):
+    """Yield ``(line number, receipt)`` for every group of consecutive CSV rows sharing a receipt value"""
+    rows = ((number, row) for (number, row) in enumerate(csv.DictReader(stream), 2))
+    for (key, group) in groupby(rows, key=lambda numbered: numbered[1].get("receipt")):
+        group = list(group)
+        (number, first) = group[0]
+        receipt = {
+            "date": first.get("date"),
+            "time": first.get("time"),
+            "supplier": {"name": first.get("supplier"), "city": first.get("city"), "state": first.get("state")},
+        }
+        for (row_number, row) in group:
+            kind = row.get("kind")
+            amount = row.get("amount")
+            if kind == "item":
+                receipt.setdefault("items", []).append({
+                    "product": {"name": row.get("name"), "code": row.get("code"),
+                                "types": [name for name in (row.get("category") or "").split("|") if name]},
+                    "quantity": row.get("quantity") or 1,
+                    "unit_price": amount})
+            elif kind == "fee":
+                receipt.setdefault("fees", []).append(
+                    {"name": row.get("name"), "quantity": row.get("quantity") or None, "amount": amount})
+            elif kind == "discount":
+                receipt.setdefault("discounts", []).append({"name": row.get("name"), "amount": amount})
+            elif kind == "tax":
+                receipt.setdefault("taxes", []).append({"tax": row.get("name"), "amount": amount})
+            elif kind == "tip":
+                receipt.setdefault("gratuities", []).append({"to": row.get("name"), "amount": amount})
+            elif not kind:  # a receipt without components
+                continue
+            elif kind == "payment":
+                receipt.setdefault("payments", []).append({
+                    "payment_method": {"bank": row.get("name"), "last4": row.get("code"),
+                                       "type": row.get("category")},
+                    "amount": amount})
+            else:
+                raise CommandError("line %i: unknown kind %r" % (row_number, kind))
+        yield (number, receipt)
+
+
+class Command(BaseCommand):
+    help = "Stream receipts from a CSV or JSON lines file into the database in chunked bulk transactions"
+    readers = {"csv": read_csv, "jsonl": read_jsonl}
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to import; a JSON lines file holds one receipt object per line. %s"
+                            % CSV_HELP.strip())
+        parser.add_argument("--format", choices=sorted(self.readers),
+                            help="Input format, guessed from the file extension by default")
+        parser.add_argument("--chunk-size", type=int, default=500,
+                            help="Number of receipts written per transaction")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        reader = self.readers.get(options["format"] or path.rsplit(".", 1)[-1].lower())
+        if reader is None:
+            raise CommandError("Cannot tell the format of %s; use --format" % path)
+
+        importer = ReceiptImporter()
+        started = time()
+        (receipts, rows) = (0, 0)
+        chunk = []
+        with io.open(path, encoding="utf-8", newline="") as stream:
+            for (number, receipt) in reader(stream):
+                chunk.append((number, receipt))
+                if len(chunk) >= options["chunk_size"]:
+                    rows += self.write(importer, chunk)
+                    receipts += len(chunk)
+                    chunk = []
+                    self.progress(receipts, rows, started)
+            if chunk:
+                rows += self.write(importer, chunk)
+                receipts += len(chunk)
+        self.progress(receipts, rows, started)
+
+    def write(self, importer, chunk):
+        try:
+            return importer.write([receipt for (number, receipt) in chunk])[1]
+        except ReceiptImportError as error:
+            number = chunk[error.index][0] if error.index is not None else chunk[0][0]
+            raise CommandError("line %i: %s (receipts before this chunk were imported)" % (number, error))
+
+    def progress(self, receipts, rows, started):
+        elapsed = max(time() - started, 1e-6)
+        self.stdout.write("Imported %i receipts, %i rows (%.0f rows/s)" % (receipts, rows, rows / elapsed))
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mizer.models import Receipt, bump_receipt_years
+
+
+class Command(BaseCommand):
+    help = "Verify the stored receipt totals columns against the receipt components and repair any that differ"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000,
+                            help="Number of receipts checked per query and transaction")
+        parser.add_argument("--verify-only", action="store_true",
+                            help="Report receipts with stale totals without repairing them")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        checked = stale = 0
+        last_pk = 0
+        while True:
+            pks = list(Receipt.objects.filter(pk__gt=last_pk).order_by("pk").values_list("pk", flat=True)[:chunk_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            with transaction.atomic():
+                receipts = Receipt.objects.filter(pk__in=pks).with_totals().order_by()
+                stale_pks = [receipt.pk for receipt in receipts if self.is_stale(receipt)]
+                if stale_pks and not options["verify_only"]:
+                    Receipt.objects.filter(pk__in=stale_pks).refresh_totals()
+            if stale_pks and not options["verify_only"]:
+                bump_receipt_years(stale_pks)
+            checked += len(pks)
+            stale += len(stale_pks)
+            if options["verbosity"] > 1:
+                for pk in stale_pks:
+                    self.stdout.write("Receipt %i has stale totals" % pk)
+                self.stdout.write("Checked %i receipts" % checked)
+
+        action = "found" if options["verify_only"] else "repaired"
+        self.stdout.write("Checked %i receipts, %s %i with stale totals" % (checked, action, stale))
+
+    @staticmethod
+    def is_stale(receipt):
+        return any(getattr(receipt, field) != getattr(receipt, field.replace("_cache", "_amount"))
+                   for field in Receipt.totals_cache_fields)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mizer.models import Product, Supplier
+
+
+class Command(BaseCommand):
+    help = "Rebuild the normalized names and prefix tokens used by the product and supplier autocomplete"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500,
+                            help="Number of rows reindexed per transaction")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        for model in (Product, Supplier):
+            indexed = 0
+            last_pk = 0
+            while True:
+                with transaction.atomic():
+                    chunk = list(model.objects.filter(pk__gt=last_pk).order_by("pk").values_list("pk", flat=True)[:chunk_size])
+                    if not chunk:
+                        break
+                    model.objects.filter(pk__in=chunk).reindex_search()
+                last_pk = chunk[-1]
+                indexed += len(chunk)
+            self.stdout.write("Reindexed %i %s" % (indexed, model._meta.verbose_name_plural))
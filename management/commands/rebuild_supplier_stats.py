@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mizer.models import Supplier, SupplierStats
+
+
+class Command(BaseCommand):
+    help = "Recompute the visit and spending statistics of every supplier from the stored receipt totals"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000,
+                            help="Number of suppliers refreshed per UPDATE and transaction")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        suppliers = 0
+        last_pk = 0
+        while True:
+            pks = list(Supplier.objects.filter(pk__gt=last_pk).order_by("pk").values_list("pk", flat=True)[:chunk_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            with transaction.atomic():
+                SupplierStats.objects.refresh_suppliers(pks)
+            suppliers += len(pks)
+            if options["verbosity"] > 1:
+                self.stdout.write("Refreshed %i suppliers" % suppliers)
+        self.stdout.write("Refreshed the statistics of %i suppliers" % suppliers)
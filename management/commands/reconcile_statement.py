@@ -0,0 +1,47 @@
+import io
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from mizer.models import PaymentMethod
+from mizer.reconciler import StatementError, StatementReconciler, read_statement
+
+
+class Command(BaseCommand):
+    help = "Match the lines of a payment method's CSV statement against its payments and report the rest"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV statement with date (YYYY-MM-DD), amount and description columns")
+        parser.add_argument("payment_method", type=int, help="Primary key of the statement's payment method")
+        parser.add_argument("--days", type=int, default=3,
+                            help="Days a statement line may be dated before or after the receipt it pays")
+        parser.add_argument("--charges-negative", action="store_true",
+                            help="The statement lists charges as negative amounts")
+        parser.add_argument("--apply", action="store_true", help="Mark the matched payments reconciled")
+
+    def handle(self, *args, **options):
+        payment_method = PaymentMethod.objects.filter(pk=options["payment_method"]).first()
+        if payment_method is None:
+            raise CommandError("No payment method %i" % options["payment_method"])
+        try:
+            with io.open(options["path"], encoding="utf-8", newline="") as stream:
+                lines = list(read_statement(stream, options["charges_negative"]))
+        except StatementError as error:
+            raise CommandError("%s" % error)
+
+        reconciliation = StatementReconciler(payment_method, options["days"]).reconcile(lines)
+        for line in reconciliation.unmatched:
+            self.stdout.write("line %i: unmatched %s %s %s" % (line.number, line.date, line.amount.usd(),
+                                                               line.description))
+        for (line, pks) in reconciliation.ambiguous:
+            self.stdout.write("line %i: ambiguous %s %s %s (payments %s)" % (
+                line.number, line.date, line.amount.usd(), line.description, ", ".join("%i" % pk for pk in pks)))
+        if options["verbosity"] > 1:
+            for (line, pk) in reconciliation.matched:
+                self.stdout.write("line %i: matched payment %i" % (line.number, pk))
+        if options["apply"]:
+            with transaction.atomic():
+                StatementReconciler.apply(reconciliation)
+        self.stdout.write("%s %i of %i lines, %i unmatched, %i ambiguous" % (
+            "Reconciled" if options["apply"] else "Matched", len(reconciliation.matched), len(lines),
+            len(reconciliation.unmatched), len(reconciliation.ambiguous)))
@@ -0,0 +1,25 @@
+import csv
+
+from django.core.management.base import BaseCommand
+from django.db.models.functions import TruncMonth, TruncYear
+
+from mizer.models import TaxCharge
+
+
+class Command(BaseCommand):
+    help = "Write the tax charged, the total of the receipts charged and the effective rate per tax and period as CSV"
+    periods = {"month": TruncMonth, "year": TruncYear}
+
+    def add_arguments(self, parser):
+        parser.add_argument("--year", type=int, help="Only charges on receipts of this year")
+        parser.add_argument("--period", choices=sorted(self.periods), default="month")
+
+    def handle(self, *args, **options):
+        charges = TaxCharge.objects.all()
+        if options["year"]:
+            charges = charges.filter(receipt__date__year=options["year"])
+        writer = csv.writer(self.stdout)
+        writer.writerow(["period", "tax", "charges", "charged", "receipts_total", "rate"])
+        for row in charges.report(self.periods[options["period"]]):
+            writer.writerow([row["period"].isoformat(), row["tax__name"], row["charges"], row["charged"],
+                             row["receipts_total"], "" if row["rate"] is None else row["rate"]])
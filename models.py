@@ -1,14 +1,26 @@
-from datetime import date
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from datetime import date, timedelta
 from decimal import Decimal
 from math import ceil
 from os import path
 from re import sub
+from threading import local
+from unicodedata import normalize
 
+from django.conf import settings
 from django.db import models
 from django.core.validators import MinValueValidator
+from django.utils.dateparse import parse_date, parse_time
+
+from .cache import autocomplete_cache, page_cache, report_cache, thumbnail_cache
+from .money import Money
+from .storage import image_storage
 
 
 BLANK_IMAGE = 'data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7'
+SEARCH_PREFIX_LENGTH = 10
+THUMBNAIL_SIZES = {"small": (40, 40), "medium": (200, 200)}
 
 
 class utils():
@@ -29,10 +41,7 @@ class utils():
         >>> utils.to_usd(-987.654)
         "-$987.65"
         """
-        usd = "$%2.2f" % num
-        if num < 0:
-            usd = "-$%2.2f" % (num * -1)
-        return usd
+        return Money.from_number(num).usd()
 
     @staticmethod
     def datestamp(date=date.today()):
@@ -43,6 +52,26 @@ class utils():
         name = "%s" % name # ensure a string
         return sub(r"[^a-z0-9_-]", "_", name.lower())
 
+    @staticmethod
+    def normalize_search(text):
+        """Lowercase ASCII words of the given text, separated by single spaces
+
+        >>> utils.normalize_search("  Crème Brûlée, 2-pack ")
+        "creme brulee 2 pack"
+        """
+        text = normalize("NFKD", "%s" % text).encode("ascii", "ignore").decode("ascii")
+        return " ".join(sub(r"[^a-z0-9]+", " ", text.lower()).split())
+
+    @staticmethod
+    def search_prefixes(text, length=SEARCH_PREFIX_LENGTH):
+        """Every prefix, up to ``length`` characters, of every word in the given text
+
+        >>> sorted(utils.search_prefixes("Big Mac"))
+        ["b", "bi", "big", "m", "ma", "mac"]
+        """
+        return set(word[:end] for word in utils.normalize_search(text).split()
+                   for end in range(1, min(len(word), length) + 1))
+
     @staticmethod
     def build_image_path(filename, *args):
         """
@@ -84,6 +113,38 @@ class utils():
         representation = "%i_%s" % (receipt.pk, supplier)
         return utils.build_image_path(filename, "receipt", year, month, day, representation)
 
+    @staticmethod
+    def thumbnail_sizes():
+        """Thumbnail names and (width, height) bounds, from the ``MIZER_THUMBNAIL_SIZES`` setting"""
+        return getattr(settings, "MIZER_THUMBNAIL_SIZES", THUMBNAIL_SIZES)
+
+    @staticmethod
+    def thumbnail_path(filename, size):
+        """
+        >>> utils.thumbnail_path("receipt/2016/02/01/12_store.png", "small")
+        "receipt/2016/02/01/12_store_small.jpg"
+        """
+        (root, ext) = path.splitext(filename)
+        return "%s_%s.jpg" % (root, size)
+
+    @staticmethod
+    def thumbnail_url(image, size="small"):
+        """URL of a written thumbnail of the given ``ImageField`` file, or ``BLANK_IMAGE`` until there is one
+
+        Whether the thumbnails are written is recorded in ``thumbnail_cache`` when thumbnails.py writes
+        them; the storage is asked about images missing from the cache until it has them all.
+        """
+        if not image:
+            return BLANK_IMAGE
+        key = thumbnail_cache.key("ready", image.name)
+        ready = thumbnail_cache.get(key)
+        if ready is None:
+            ready = all(image.storage.exists(utils.thumbnail_path(image.name, size_name))
+                        for size_name in utils.thumbnail_sizes())
+            if ready:  # a miss is not remembered, it would hide the thumbnails written later
+                thumbnail_cache.set(key, ready)
+        return image.storage.url(utils.thumbnail_path(image.name, size)) if ready else BLANK_IMAGE
+
 
 class Tax(models.Model):
     name = models.CharField(max_length=50)
@@ -95,7 +156,101 @@ class Tax(models.Model):
         return self.name
 
 
-class Supplier(models.Model):
+class SearchQuerySet(models.QuerySet):
+    """Indexed name search through the word prefix tokens of a ``Searchable`` model"""
+
+    def search_ranking(self, q):
+        """``When`` clauses, best first, that rank a search result above plain token matches"""
+        return [models.When(search_name__startswith=utils.normalize_search(q), then=models.Value(1))]
+
+    def search_ordering(self):
+        return ("-search_rank",) + tuple(self.model._meta.ordering)
+
+    def search_filter(self, q):
+        """Match every word of the query as a word prefix of the name"""
+        tokens = self.model._meta.get_field("search_tokens")
+        match = models.Q()
+        for word in utils.normalize_search(q).split():
+            match &= models.Q(pk__in=tokens.related_model.objects
+                              .filter(token=word[:SEARCH_PREFIX_LENGTH])
+                              .values(tokens.field.name))
+            if len(word) > SEARCH_PREFIX_LENGTH:
+                match &= models.Q(search_name__contains=word)
+        return match
+
+    def search(self, q):
+        """Rows whose name words start with every word of ``q``, best matches first; none for a query
+        without words"""
+        if not utils.normalize_search(q):
+            return self.none()
+        return (self
+                .filter(self.search_filter(q))
+                .annotate(search_rank=models.Case(*self.search_ranking(q),
+                                                  default=models.Value(0),
+                                                  output_field=models.IntegerField()))
+                .order_by(*self.search_ordering()))
+
+    def reindex_search(self):
+        """Rebuild the normalized names and prefix tokens of every row"""
+        for instance in self:
+            instance.search_name = utils.normalize_search(instance.name)
+            self.model.objects.filter(pk=instance.pk).update(search_name=instance.search_name)
+            instance.reindex_search_tokens()
+
+
+class Searchable(models.Model):
+    """Abstract base of models found by name through the autocomplete search index
+
+    Subclasses define a ``name`` and a token model with a foreign key ``related_name="search_tokens"``.
+    """
+    search_name = models.CharField(max_length=100, default="", db_index=True, editable=False)
+
+    objects = SearchQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        self.search_name = utils.normalize_search(self.name)
+        if kwargs.get("update_fields") is not None:
+            kwargs["update_fields"] = set(kwargs["update_fields"]) | {"search_name"}
+        super(Searchable, self).save(*args, **kwargs)
+
+    def reindex_search_tokens(self):
+        """Add and remove prefix tokens so they match the current name"""
+        tokens = self.search_tokens.model
+        owner = self._meta.get_field("search_tokens").field.name
+        wanted = utils.search_prefixes(self.name)
+        stored = set(self.search_tokens.values_list("token", flat=True))
+        if stored - wanted:
+            self.search_tokens.filter(token__in=stored - wanted).delete()
+        tokens.objects.bulk_create([tokens(token=token, **{owner: self}) for token in wanted - stored])
+
+
+class SearchToken(models.Model):
+    token = models.CharField(max_length=SEARCH_PREFIX_LENGTH)
+
+    class Meta:
+        abstract = True
+
+
+class SupplierQuerySet(SearchQuerySet):
+    def delete(self):
+        with deleting():
+            return super(SupplierQuerySet, self).delete()
+
+    def visit_ordering(self):
+        """Most visited first; suppliers without statistics yet go last"""
+        return (models.F("stats__visits").desc(nulls_last=True),) + tuple(self.model._meta.ordering)
+
+    def search_ordering(self):
+        return ("-search_rank",) + self.visit_ordering()
+
+    def frequent_first(self):
+        return self.order_by(*self.visit_ordering())
+
+
+class Supplier(Searchable):
     name = models.CharField(max_length=100)
     street = models.TextField(null=True, blank=True)
     city = models.CharField(max_length=100, null=True, blank=True)
@@ -104,6 +259,12 @@ class Supplier(models.Model):
     phone = models.CharField(max_length=50, null=True, blank=True)
     website = models.URLField(null=True, blank=True)
 
+    objects = SupplierQuerySet.as_manager()
+
+    def delete(self, *args, **kwargs):
+        with deleting():
+            return super(Supplier, self).delete(*args, **kwargs)
+
     def locality(self):
         return "%s, %s" % (self.city, self.state)
 
@@ -113,6 +274,43 @@ class Supplier(models.Model):
             repr = "%s (%s)" % (self.name, self.locality())
         return repr
 
+    @property
+    def statistics(self):
+        """The stored ``SupplierStats``, or empty ones for a supplier without receipts"""
+        try:
+            return self.stats
+        except SupplierStats.DoesNotExist:
+            return SupplierStats(supplier=self)
+
+    def visits(self):
+        return self.statistics.visits
+    visits.admin_order_field = "stats__visits"
+
+    def spend_usd(self):
+        return utils.to_usd(self.statistics.spend)
+    spend_usd.short_description = "Spend (USD)"
+    spend_usd.admin_order_field = "stats__spend"
+
+    def average_basket_usd(self):
+        average = self.statistics.average_basket
+        return average.usd() if average is not None else ""
+    average_basket_usd.short_description = "Average basket (USD)"
+
+    def last_visit(self):
+        return self.statistics.last_visit
+    last_visit.admin_order_field = "stats__last_visit"
+
+    def top_product(self):
+        return self.statistics.top_product
+    top_product.admin_order_field = "stats__top_product__name"
+
+    def top_products(self, count=5):
+        """The products bought most often here, annotated with their ``purchases_here``"""
+        return (Product.objects
+                .filter(purchases__receipt__supplier=self)
+                .annotate(purchases_here=models.Count("purchases"))
+                .order_by("-purchases_here", "name")[:count])
+
     class Meta:
         ordering = ("name", "state", "city",)
 
@@ -127,25 +325,93 @@ class ProductType(models.Model):
         ordering = ("name",)
 
 
-class Product(models.Model):
+class ProductQuerySet(SearchQuerySet):
+    def search_ranking(self, q):
+        return [models.When(code=q.strip(), then=models.Value(2))] + super(ProductQuerySet, self).search_ranking(q)
+
+    def search_ordering(self):
+        return ("-search_rank", "-purchase_count") + tuple(self.model._meta.ordering)
+
+    def search_filter(self, q):
+        """Match name word prefixes or the exact product code"""
+        return super(ProductQuerySet, self).search_filter(q) | models.Q(code=q.strip())
+
+    def refresh_purchase_counts(self):
+        """Recount the items bought of each product in a single UPDATE"""
+        purchases = (Item.objects
+                     .filter(product=models.OuterRef("pk"))
+                     .order_by()
+                     .values("product")
+                     .annotate(count=models.Count("pk"))
+                     .values("count"))
+        return self.update(purchase_count=models.functions.Coalesce(
+            models.Subquery(purchases, output_field=models.IntegerField()), 0))
+
+    def with_cheapest_supplier(self, days=90):
+        """Annotate the lowest unit price paid in the last ``days`` days and the supplier that charged it
+
+        ``cheapest_price``, ``cheapest_supplier_id`` and ``cheapest_supplier_name`` are None for products
+        not bought in that time; of equal prices the most recent wins. All products are answered by a
+        single query.
+        """
+        cheapest = (Item.objects
+                    .bought_since(days)
+                    .filter(product=models.OuterRef("pk"))
+                    .order_by("unit_price", "-receipt__date", "-pk"))
+        return self.annotate(
+            cheapest_price=models.Subquery(cheapest.values("unit_price")[:1], output_field=ItemQuerySet.price_field),
+            cheapest_supplier_id=models.Subquery(cheapest.values("receipt__supplier")[:1],
+                                                 output_field=models.IntegerField()),
+            cheapest_supplier_name=models.Subquery(cheapest.values("receipt__supplier__name")[:1],
+                                                   output_field=models.CharField()))
+
+
+class Product(Searchable):
     name = models.CharField(max_length=100)
     description = models.TextField(null=True, blank=True)
-    code = models.CharField("UPC / SKU / Product Code", max_length=25, null=True, blank=True)
-    image = models.ImageField(upload_to=utils.product_image_path, null=True, blank=True)
+    code = models.CharField("UPC / SKU / Product Code", max_length=25, null=True, blank=True, db_index=True)
+    image = models.ImageField(upload_to=utils.product_image_path, storage=image_storage, null=True, blank=True)
     types = models.ManyToManyField("ProductType")
+    # number of items bought, maintained by the item save/delete hooks in signals.py
+    purchase_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = ProductQuerySet.as_manager()
+
+    def type_names(self):
+        """Comma separated product type names, read from the ``prefetch_related("types")`` cache when present"""
+        return ", ".join([product_type.name for product_type in self.types.all()])
 
     def __str__(self):
-        return "%s (%s)" % (self.name,
-                                             ", ".join([product_type.name for product_type in self.types.all()]))
+        return "%s (%s)" % (self.name, self.type_names())
 
     def image_html(self):
-        return '<img src="%s" class="thumbnail" alt="">' % (
-            self.image.url if self.image and self.image.url else BLANK_IMAGE)
+        return '<img src="%s" class="thumbnail" alt="">' % utils.thumbnail_url(self.image)
+
+    def price_history(self, period=models.functions.TruncMonth, days=None):
+        """``ItemQuerySet.price_history`` rows of this product, optionally limited to the last ``days`` days"""
+        items = self.purchases.all()
+        if days is not None:
+            items = items.bought_since(days)
+        return items.price_history(period)
 
     class Meta:
         ordering = ("name",)
 
 
+class SupplierSearchToken(SearchToken):
+    supplier = models.ForeignKey("Supplier", related_name="search_tokens")
+
+    class Meta:
+        unique_together = ("token", "supplier")
+
+
+class ProductSearchToken(SearchToken):
+    product = models.ForeignKey("Product", related_name="search_tokens")
+
+    class Meta:
+        unique_together = ("token", "product")
+
+
 class PaymentMethodType(models.Model):
     name = models.CharField(max_length=100)
 
@@ -163,99 +429,537 @@ class PaymentMethod(models.Model):
 
     def __str__(self):
         number = ""
-        type = ""
+        type = "%s" % self.type
         if self.last4:
             number = " x%s" % self.last4
-        if self.bank != self.type:
-            type = " (%s)" % self.type
+        if self.bank != type:
+            type = " (%s)" % type
+        else:
+            type = ""
         return "%s%s%s" % (self.bank, number, type)
 
     class Meta:
         ordering = ("bank", "type", "last4",)
 
 
-class Payment(models.Model):
+_totals_state = local()
+_deletion_state = local()
+
+
+@contextmanager
+def deleting():
+    """Scope the marks the delete hooks in signals.py put on the rows being deleted
+
+    The marks are dropped when the outermost deletion ends, also when it fails between the pre_delete
+    and post_delete signals, so they never outlive it.
+    """
+    if getattr(_deletion_state, "receipts", None) is not None:
+        yield  # inside an enclosing deletion
+        return
+    _deletion_state.receipts = set()
+    _deletion_state.suppliers = set()
+    try:
+        yield
+    finally:
+        _deletion_state.receipts = _deletion_state.suppliers = None
+
+
+def deletion_marks(name):
+    """The set of the ids of the ``name`` ("receipts" or "suppliers") being deleted inside ``deleting()``,
+    None outside"""
+    return getattr(_deletion_state, name, None)
+
+
+def touch_receipt_totals(receipt_id, receipt=None):
+    """Refresh the stored totals of a receipt, or queue it while inside ``defer_totals()``
+
+    ``receipt`` is an in-memory instance to be updated along with the database row.
+    """
+    if receipt_id is None:
+        return
+    pending = getattr(_totals_state, "pending", None)
+    if pending is None:
+        Receipt.objects.filter(pk=receipt_id).refresh_totals(instances=[receipt] if receipt else [])
+        bump_receipt_years([receipt_id], [receipt] if receipt else [])
+    else:
+        pending.setdefault(receipt_id, [])
+        if receipt is not None:
+            pending[receipt_id].append(receipt)
+
+
+def bump_receipt_years(receipt_ids, instances=()):
+    """Invalidate the cached pages of the years the receipts are dated in
+
+    In-memory ``instances`` of the receipts spare looking up their dates.
+    """
+    years = set(receipt.date.year for receipt in instances if receipt.date)
+    unknown = set(receipt_ids) - set(receipt.pk for receipt in instances)
+    if unknown:
+        years.update(day.year for day in Receipt.objects.filter(pk__in=unknown).dates("date", "year"))
+    for year in years:
+        page_cache.bump("year:%i" % year)
+
+
+def touch_product_purchases(product_id):
+    """Recount the purchases of a product, or queue it while inside ``defer_totals()``"""
+    if product_id is None:
+        return
+    products = getattr(_totals_state, "products", None)
+    if products is None:
+        Product.objects.filter(pk=product_id).refresh_purchase_counts()
+    else:
+        products.add(product_id)
+
+
+def touch_supplier_stats(supplier_id, **changes):
+    """Add changes to the statistics of a supplier, or queue them while inside ``defer_totals()``
+
+    See ``SupplierStatsQuerySet.apply`` for the changes; spending follows the spending rollup deltas.
+    """
+    if supplier_id is not None:
+        SupplierStats.objects.apply({supplier_id: changes})
+
+
+@contextmanager
+def defer_totals():
+    """Collect every receipt, rollup, purchase count and supplier statistics change made inside the block
+    and write them once, on exit"""
+    if getattr(_totals_state, "pending", None) is not None:
+        yield  # already deferred by an enclosing block
+        return
+    _totals_state.pending = {}
+    _totals_state.rollup = {}
+    _totals_state.products = set()
+    _totals_state.suppliers = {}
+    try:
+        yield
+        (pending, rollup, products, suppliers) = (_totals_state.pending, _totals_state.rollup,
+                                                  _totals_state.products, _totals_state.suppliers)
+    finally:
+        _totals_state.pending = _totals_state.rollup = _totals_state.products = _totals_state.suppliers = None
+    if products:
+        Product.objects.filter(pk__in=list(products)).refresh_purchase_counts()
+    if pending:
+        instances = [receipt for receipts in pending.values() for receipt in receipts]
+        Receipt.objects.filter(pk__in=list(pending)).refresh_totals(instances=instances)
+        bump_receipt_years(pending, instances)
+    if rollup:
+        SpendingRollup.objects.add(rollup)
+        SupplierStats.objects.merge(suppliers, SpendingRollup.objects.supplier_spend(rollup))
+    if suppliers:
+        SupplierStats.objects.apply(suppliers)
+
+
+class ReceiptComponentQuerySet(models.QuerySet):
+    """Bulk operations on receipt components that keep the receipt totals columns current"""
+    # the fields the receipt totals, spending rollup and purchase counts are computed from
+    totals_fields = ("receipt", "receipt_id", "product", "product_id", "quantity", "unit_price", "amount")
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        receipt_ids = set(obj.receipt_id for obj in objs)
+        components = self.model.objects.filter(receipt__in=receipt_ids)
+        before = SpendingRollup.objects.contributions(components)
+        objs = super(ReceiptComponentQuerySet, self).bulk_create(objs, *args, **kwargs)
+        with defer_totals():
+            SpendingRollup.objects.apply(SpendingRollup.objects.contributions(components), before)
+            for receipt_id in receipt_ids:
+                touch_receipt_totals(receipt_id)
+            if self.model is Item:
+                for obj in objs:
+                    touch_product_purchases(obj.product_id)
+                SupplierStats.objects.apply(SupplierStats.objects.purchases(components, "bought"))
+        return objs
+
+    def update(self, **kwargs):
+        if not any(field in self.totals_fields for field in kwargs):  # e.g. marking payments reconciled
+            return super(ReceiptComponentQuerySet, self).update(**kwargs)
+        product = kwargs.get("product", kwargs.get("product_id"))
+        product_ids = set()
+        if self.model is Item and product is not None:  # items move between products
+            product_ids = set(self.values_list("product_id", flat=True)) | {getattr(product, "pk", product)}
+        rows = dict(self.values_list("pk", "receipt_id"))
+        components = self.model.objects.filter(pk__in=list(rows))
+        before = SpendingRollup.objects.contributions(components)
+        receipt = kwargs.get("receipt", kwargs.get("receipt_id"))
+        purchases = {}
+        if self.model is Item and (product is not None or receipt is not None):  # items move between suppliers
+            purchases = SupplierStats.objects.purchases(components, "unbought")
+        updated = super(ReceiptComponentQuerySet, self).update(**kwargs)
+        receipt_ids = set(rows.values())
+        if receipt is not None:
+            receipt_ids.add(getattr(receipt, "pk", receipt))
+        with defer_totals():
+            SpendingRollup.objects.apply(SpendingRollup.objects.contributions(components), before)
+            for receipt_id in receipt_ids:
+                touch_receipt_totals(receipt_id)
+            for product_id in product_ids:
+                touch_product_purchases(product_id)
+            if purchases:
+                SupplierStats.objects.apply(SupplierStats.objects.merge(
+                    purchases, SupplierStats.objects.purchases(components, "bought")))
+        return updated
+
+    def delete(self):
+        with defer_totals():  # delete signals fire per row; write each receipt and rollup once
+            return super(ReceiptComponentQuerySet, self).delete()
+
+
+class ReceiptComponent(models.Model):
+    """Abstract base of the rows that add up into a receipt's totals
+
+    Subclasses define a ``receipt`` foreign key; the receipt a row was loaded with is remembered so a
+    row moved to another receipt refreshes both. See ``signals`` for the save/delete hooks.
+    """
+    objects = ReceiptComponentQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(ReceiptComponent, cls).from_db(db, field_names, values)
+        instance._loaded_receipt_id = instance.__dict__.get("receipt_id")
+        return instance
+
+    def cached_receipt(self):
+        """The related receipt if it is already loaded on this instance, without querying for it"""
+        return getattr(self, self._meta.get_field("receipt").get_cache_name(), None)
+
+
+class Payment(ReceiptComponent):
     receipt = models.ForeignKey("Receipt", related_name="payments")
     payment_method = models.ForeignKey("PaymentMethod")
     amount = models.DecimalField(
         default=1,
         max_digits=8,
         decimal_places=2)  # up to 999999.99
+    # matched to a statement line by ``reconciler.StatementReconciler``
+    reconciled = models.BooleanField(default=False, db_index=True, editable=False)
+
+
+class GroupSubquery(models.Subquery):
+    """A subquery per group of an aggregate query, left out of its GROUP BY
+
+    The subquery may only refer to grouped columns through its ``OuterRef``s. Grouping by it as well,
+    which Django does for every non-aggregate annotation, would run it once for every row grouped.
+    """
+
+    def get_group_by_cols(self):
+        return []
+
+
+class Round(models.Func):
+    """Round a numeric expression to the nearest cent in SQL, halves away from zero
+
+    ``Item.cost`` agrees with the default ``half_up`` ``MIZER_MONEY_ROUNDING``; with ``half_even`` the
+    stored totals and the Python costs may differ by a cent on exact halves.
+    """
+    function = "ROUND"
+    template = "%(function)s(%(expressions)s, 2)"
+
+
+class ReceiptQuerySet(models.QuerySet):
+    money_field = models.DecimalField(max_digits=10, decimal_places=2)
+    summary_fields = (
+        ("purchases", "subtotal_cache"),
+        ("fees", "fee_cache"),
+        ("discounts", "discount_cache"),
+        ("taxes", "tax_cache"),
+        ("tips", "tip_cache"),
+        ("final", "total_cache"),
+    )
+
+    def _component_sum(self, model, expression, default=0):
+        """Scalar subquery summing ``expression`` over a receipt component model"""
+        components = (model.objects
+                      .filter(receipt=models.OuterRef("pk"))
+                      .order_by()
+                      .values("receipt")
+                      .annotate(amount=models.Sum(expression))
+                      .values("amount"))
+        subquery = models.Subquery(components, output_field=self.money_field)
+        if default is None:
+            return subquery
+        return models.functions.Coalesce(subquery, default, output_field=self.money_field)
+
+    def _totals(self):
+        """Expressions for every money component of a receipt, keyed by annotation name"""
+        totals = {
+            "subtotal_amount": self._component_sum(Item, Round(models.F("unit_price") * models.F("quantity"))),
+            "fee_amount": self._component_sum(Fee, "amount"),
+            "discount_amount": self._component_sum(Discount, "amount"),
+            "tax_amount": self._component_sum(TaxCharge, "amount"),
+            "tip_amount": self._component_sum(Gratuity, "amount"),
+        }
+        totals["total_amount"] = models.ExpressionWrapper(
+            totals["subtotal_amount"]
+            + totals["fee_amount"]
+            - totals["discount_amount"]
+            + totals["tax_amount"]
+            + totals["tip_amount"],
+            output_field=self.money_field)
+        return totals
+
+    def with_totals(self):
+        """Annotate every money component of each receipt, computed in a single SQL statement
+
+        The annotations are read back by ``Receipt.subtotal``, ``fee``, ``discount``, ``tax``, ``tip``,
+        ``total`` and ``paid`` in preference to the stored ``*_cache`` columns, so they always reflect the
+        components as they are in the database.
+        ``paid_amount`` and ``balance_amount`` (paid less total) are NULL when a receipt has no payments.
+        """
+        return self.annotate(
+            paid_amount=self._component_sum(Payment, "amount", default=None),
+            **self._totals()
+        ).annotate(
+            balance_amount=models.ExpressionWrapper(
+                models.F("paid_amount") - models.F("total_amount"),
+                output_field=self.money_field),
+        )
+
+    def with_balance(self):
+        """Annotate ``balance_amount`` (paid less total) from the stored totals columns"""
+        return self.annotate(balance_amount=models.F("balance_cache"))
+
+    def with_status(self):
+        """Annotate ``payment_status``, which ``Receipt.status()`` reads, computed by the database"""
+        return self.annotate(payment_status=models.Case(
+            *[models.When(condition, then=models.Value("" if status == "Unpaid" else status))
+              for (status, condition) in self.model.payment_statuses],
+            output_field=models.CharField()))
+
+    def payment_status(self, status):
+        """Receipts with the given ``Receipt.status()``, e.g. "Underpaid", using the stored balance index"""
+        return self.filter(dict(self.model.payment_statuses)[status])
+
+    def underpaid(self):
+        return self.payment_status("Underpaid")
+
+    def overpaid(self):
+        return self.payment_status("Overpaid")
+
+    # Meta.ordering with the primary key as a tie breaker, receipts without a time last on every database
+    keyset_ordering = (models.F("date").desc(), models.F("time").desc(nulls_last=True), models.F("pk").desc())
+
+    @staticmethod
+    def keyset_cursor(receipt):
+        """An opaque position after ``receipt`` in ``keyset_ordering``: ``"date,time,pk"``"""
+        return "%s,%s,%i" % (receipt.date.isoformat(), receipt.time.isoformat() if receipt.time else "", receipt.pk)
+
+    def after(self, cursor):
+        """Receipts following the position of a ``keyset_cursor`` in ``keyset_ordering``
+
+        Raises ValueError for a malformed cursor.
+        """
+        (day, time, pk) = ("%s" % cursor).split(",")
+        (day, parsed_time, pk) = (parse_date(day), parse_time(time) if time else None, int(pk))
+        if day is None or (time and parsed_time is None):
+            raise ValueError("Invalid cursor: %s" % cursor)
+        time = parsed_time
+        if time is None:
+            same_day = models.Q(time__isnull=True, pk__lt=pk)
+        else:
+            same_day = models.Q(time__lt=time) | models.Q(time__isnull=True) | models.Q(time=time, pk__lt=pk)
+        return self.filter(models.Q(date__lt=day) | models.Q(same_day, date=day))
+
+    def keyset_page(self, cursor=None, size=50):
+        """Return ``(receipts, next cursor)``: the ``size`` receipts after ``cursor`` (from the first without)
+
+        Every page costs one indexed query however deep it is, unlike an OFFSET; the next cursor is None
+        on the last page.
+        """
+        receipts = self.after(cursor) if cursor else self
+        page = list(receipts.order_by(*self.keyset_ordering)[:size + 1])
+        return (page[:size], self.keyset_cursor(page[size - 1]) if len(page) > size else None)
+
+    def delete(self):
+        with deleting():
+            return super(ReceiptQuerySet, self).delete()
+
+    def refresh_totals(self, instances=()):
+        """Recompute the stored totals columns from the receipt components in a single UPDATE
+
+        ``instances`` are in-memory receipts whose totals attributes are reloaded afterwards.
+        """
+        totals = self._totals()
+        paid = self._component_sum(Payment, "amount", default=None)
+        # both sides are recomputed: some databases read already updated columns later in the same SET
+        balance = models.ExpressionWrapper(paid - totals["total_amount"], output_field=self.money_field)
+        rows = self.update(paid_cache=paid, balance_cache=balance,
+                           **dict((field.replace("_amount", "_cache"), expression)
+                                  for (field, expression) in totals.items()))
+        instances = [receipt for receipt in instances if receipt.pk is not None]
+        if instances:
+            values = dict((row["pk"], row) for row in Receipt.objects
+                          .filter(pk__in=set(receipt.pk for receipt in instances))
+                          .values("pk", *Receipt.totals_cache_fields))
+            for receipt in instances:
+                for field in Receipt.totals_cache_fields:
+                    setattr(receipt, field, values.get(receipt.pk, {}).get(field, getattr(receipt, field)))
+        return rows
+
+    def summarize_by(self, period=models.functions.TruncMonth):
+        """Sum the stored totals per period of the receipt date in one grouped query
+
+        Each row holds ``period`` (a date) and the keys of ``summary_fields``, ordered by period.
+        """
+        sums = dict((name, models.functions.Coalesce(models.Sum(field), 0, output_field=self.money_field))
+                    for (name, field) in self.summary_fields)
+        return (self
+                .annotate(period=period("date", output_field=models.DateField()))
+                .order_by()
+                .values("period")
+                .annotate(**sums)
+                .order_by("period"))
+
+    def compare(self, ranges):
+        """Sum the stored totals over each inclusive ``(start, end)`` date range in one aggregate query
+
+        Returns a dict per range, in order, holding ``start``, ``end``, the number of ``receipts`` and
+        Money sums keyed like ``summary_fields`` plus ``paid``. Ranges may overlap.
+        """
+        fields = self.summary_fields + (("paid", "paid_cache"),)
+        (sums, span) = ({}, models.Q())
+        for (index, (start, end)) in enumerate(ranges):
+            within = models.Q(date__gte=start, date__lte=end)
+            span |= within
+            sums["receipts_%i" % index] = models.Sum(models.Case(models.When(within, then=models.Value(1)),
+                                                                 default=models.Value(0),
+                                                                 output_field=models.IntegerField()))
+            for (name, field) in fields:
+                sums["%s_%i" % (name, index)] = models.Sum(models.Case(models.When(within, then=models.F(field)),
+                                                                       output_field=self.money_field))
+        row = self.filter(span).order_by().aggregate(**sums) if ranges else {}
+        periods = []
+        for (index, (start, end)) in enumerate(ranges):
+            period = {"start": start, "end": end, "receipts": row["receipts_%i" % index] or 0}
+            period.update((name, Money.from_number(row["%s_%i" % (name, index)] or 0)) for (name, field) in fields)
+            periods.append(period)
+        return periods
+
+    def summarize(self, period=models.functions.TruncMonth):
+        """Return ``(totals, periods)``: overall sums and the per-period rows of ``summarize_by``"""
+        periods = list(self.summarize_by(period))
+        totals = dict((name, Money.sum(row[name] for row in periods)) for (name, field) in self.summary_fields)
+        return (totals, periods)
 
 
 class Receipt(models.Model):
     supplier = models.ForeignKey("Supplier")
-    date = models.DateField(null=False, blank=False, default=date.today)
+    date = models.DateField(null=False, blank=False, default=date.today, db_index=True)
     time = models.TimeField(null=True, blank=True)
-    image = models.ImageField(upload_to=utils.receipt_image_path,
+    image = models.ImageField(upload_to=utils.receipt_image_path, storage=image_storage,
                               null=True, blank=True)
 
+    # denormalized totals, maintained by the component save/delete hooks in signals.py
+    subtotal_cache = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
+    fee_cache = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
+    discount_cache = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
+    tax_cache = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
+    tip_cache = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
+    total_cache = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False, db_index=True)
+    paid_cache = models.DecimalField(max_digits=10, decimal_places=2, null=True, editable=False, db_index=True)
+    # paid less total, NULL without payments; indexed so payment status filters need no scan
+    balance_cache = models.DecimalField(max_digits=10, decimal_places=2, null=True, editable=False, db_index=True)
+
+    totals_cache_fields = ("subtotal_cache", "fee_cache", "discount_cache", "tax_cache", "tip_cache",
+                           "total_cache", "paid_cache", "balance_cache")
+
+    # payment status of Receipt.status() -> condition on the indexed stored totals
+    payment_statuses = (
+        ("Underpaid", models.Q(balance_cache__lt=0)),
+        ("Overpaid", models.Q(balance_cache__gt=0)),
+        ("Refunded", models.Q(balance_cache=0, paid_cache__lt=0)),
+        ("Paid", models.Q(balance_cache=0, paid_cache__gte=0)),
+        ("Unpaid", models.Q(paid_cache__isnull=True)),
+    )
+
+    objects = ReceiptQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            # never write back totals that may have gone stale in memory; see refresh_totals()
+            kwargs["update_fields"] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.totals_cache_fields]
+        super(Receipt, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with deleting():
+            return super(Receipt, self).delete(*args, **kwargs)
+
     @property
     def subtotal(self):
-        cost = 0
-        for item in self.items.all():
-            cost += item.cost
-        return cost
+        if hasattr(self, "subtotal_amount"):
+            return self.subtotal_amount
+        return self.subtotal_cache
 
     def subtotal_usd(self):
         return utils.to_usd(self.subtotal)
     subtotal_usd.short_description = "Subtotal (USD)"
+    subtotal_usd.admin_order_field = "subtotal_cache"
 
     @property
     def tax(self):
-        cost = 0
-        for tax in self.taxes.all():
-            cost += tax.amount
-        return cost
+        if hasattr(self, "tax_amount"):
+            return self.tax_amount
+        return self.tax_cache
 
     def tax_usd(self):
         return utils.to_usd(self.tax)
     tax_usd.short_description = "Tax (USD)"
+    tax_usd.admin_order_field = "tax_cache"
 
     @property
     def discount(self):
-        amount = 0
-        for coupon in self.discounts.all():
-            amount += coupon.amount
-        return amount
+        if hasattr(self, "discount_amount"):
+            return self.discount_amount
+        return self.discount_cache
 
     def discount_usd(self):
         return utils.to_usd(self.discount)
     discount_usd.short_description = "Discount (USD)"
+    discount_usd.admin_order_field = "discount_cache"
 
     @property
     def fee(self):
-        amount = 0
-        for fee in self.fees.all():
-            amount += fee.amount
-        return amount
+        if hasattr(self, "fee_amount"):
+            return self.fee_amount
+        return self.fee_cache
 
     def fee_usd(self):
         return utils.to_usd(self.fee)
     fee_usd.short_description = "Fees (USD)"
+    fee_usd.admin_order_field = "fee_cache"
 
     @property
     def tip(self):
-        amount = 0
-        for tip in self.gratuities.all():
-            amount += tip.amount
-        return amount
+        if hasattr(self, "tip_amount"):
+            return self.tip_amount
+        return self.tip_cache
 
     def tip_usd(self):
         return utils.to_usd(self.tip)
     tip_usd.short_description = "Tip (USD)"
+    tip_usd.admin_order_field = "tip_cache"
 
     @property
     def total(self):
-        return (self.subtotal
-                + self.fee
-                - self.discount
-                + self.tax
-                + self.tip)
+        if hasattr(self, "total_amount"):
+            return self.total_amount
+        return self.total_cache
 
     def total_usd(self):
         return utils.to_usd(self.total)
     total_usd.short_description = "Total (USD)"
+    total_usd.admin_order_field = "total_cache"
+
+    @property
+    def paid(self):
+        """Sum of all payments, or None when the receipt has no payments"""
+        if hasattr(self, "paid_amount"):
+            return self.paid_amount
+        return self.paid_cache
 
     @property
     def when(self):
@@ -269,29 +973,106 @@ class Receipt(models.Model):
         return when
 
     def status(self):
+        if hasattr(self, "payment_status"):
+            return self.payment_status
         status = ""
-        if (self.payments.count() > 0):
-            paid = self.payments.all().aggregate(total=models.Sum(models.F('amount')))
-            total = paid["total"]
-            if total < self.total:
+        paid = self.paid
+        if paid is not None:
+            total = self.total
+            if paid < total:
                 status = "Underpaid"
-            elif total > self.total:
+            elif paid > total:
                 status = "Overpaid"
-            elif total < 0:
+            elif paid < 0:
                 status = "Refunded"
             else:
                 status = "Paid"
 
         return status
+    status.admin_order_field = "balance_cache"
 
     def __str__(self):
         return "%s - %s - %s (%s)" % (self.when, self.supplier, self.total_usd(), self.status())
 
     class Meta:
         ordering = ('-date', '-time',)
+        index_together = (("date", "time"),)  # keyset pages
+
 
+class ItemQuerySet(ReceiptComponentQuerySet):
+    price_field = models.DecimalField(max_digits=8, decimal_places=2)
+    # split spending keeps fractions of a cent until the caller rounds it
+    spend_field = models.DecimalField(max_digits=16, decimal_places=6)
 
-class Item(models.Model):
+    @staticmethod
+    def primary_type():
+        """Subquery of the primary (lowest pk) product type of an item's product"""
+        primary_type = (ProductType.objects
+                        .filter(product=models.OuterRef("product"))
+                        .order_by("pk")
+                        .values("pk")[:1])
+        return models.Subquery(primary_type, output_field=models.IntegerField())
+
+    def spending_by_type(self, period=models.functions.TruncMonth, allocation="full"):
+        """``(period, product type id, spend)`` rows of the item costs per product type, in one grouped query
+
+        Products of several types count in full towards each of them (``"full"``), are split evenly
+        between them (``"split"``) or count towards their primary type only (``"primary"``, as in
+        ``SpendingRollup``). Products without a type are reported under a None type.
+        """
+        if allocation not in self.model.allocations:
+            raise ValueError("Unknown allocation: %s" % allocation)
+        spend = Round(models.F("unit_price") * models.F("quantity"))
+        items = self.annotate(period=period("receipt__date")).order_by()
+        type_field = "product__types"
+        if allocation == "primary":
+            items = items.annotate(product_type=self.primary_type())
+            type_field = "product_type"
+        elif allocation == "split":
+            type_count = (Product.types.through.objects
+                          .filter(product=models.OuterRef("product"))
+                          .order_by()
+                          .values("product")
+                          .annotate(count=models.Count("pk"))
+                          .values("count"))
+            # the multiplier keeps SQLite from dividing whole amounts, stored as integers, as integers
+            spend = spend * models.Value(Decimal("1.000000")) / models.functions.Coalesce(
+                models.Subquery(type_count, output_field=models.IntegerField()), 1)
+        return (items
+                .values("period", type_field)
+                .annotate(spend=models.Sum(spend, output_field=self.spend_field))
+                .values_list("period", type_field, "spend"))
+
+    def bought_since(self, days):
+        """Items on receipts dated within the last ``days`` days"""
+        return self.filter(receipt__date__gte=date.today() - timedelta(days=days))
+
+    def price_history(self, period=models.functions.TruncMonth):
+        """Unit prices per product, supplier and period, oldest period first
+
+        Each row has ``product``, ``supplier``, ``period``, the number of ``purchases`` and the
+        ``min_price``, ``avg_price``, ``max_price`` and ``last_price`` paid. The last price is read by a
+        correlated subquery run once per row of the result, since Django 1.11 has no window functions.
+        """
+        last_price = (self.model.objects
+                      .annotate(period=period("receipt__date"))
+                      .filter(product=models.OuterRef("product"), receipt__supplier=models.OuterRef("supplier"),
+                              period=models.OuterRef("period"))
+                      .order_by("-receipt__date", "-receipt__time", "-pk")
+                      .values("unit_price")[:1])
+        return (self
+                .annotate(period=period("receipt__date"), supplier=models.F("receipt__supplier"))
+                .order_by()
+                .values("product", "supplier", "period")
+                .annotate(purchases=models.Count("pk"),
+                          min_price=models.Min("unit_price"),
+                          avg_price=Round(models.Avg("unit_price"), output_field=self.price_field),
+                          max_price=models.Max("unit_price"))
+                .annotate(last_price=GroupSubquery(last_price, output_field=self.price_field))
+                .order_by("product", "period", "supplier"))
+
+
+class Item(ReceiptComponent):
     product = models.ForeignKey("Product", related_name="purchases")
     receipt = models.ForeignKey("Receipt", related_name="items")
     quantity = models.DecimalField(
@@ -300,16 +1081,27 @@ class Item(models.Model):
         decimal_places=3)  # up to 999999.999
     unit_price = models.DecimalField(max_digits=8, decimal_places=2)  # up to 999999.99
 
+    objects = ItemQuerySet.as_manager()
+
+    # how ItemQuerySet.spending_by_type counts products of several types
+    allocations = ("full", "split", "primary")
+
+    class Meta:
+        index_together = (("product", "receipt"),)  # price history and cheapest supplier lookups
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Item, cls).from_db(db, field_names, values)
+        instance._loaded_product_id = instance.__dict__.get("product_id")
+        return instance
+
     def unit_price_usd(self):
         return utils.to_usd(self.unit_price)
     unit_price.short_description = "Unit Price (USD)"
 
     @property
     def cost(self):
-        hundred = Decimal(100)
-        cost = self.unit_price * self.quantity
-        rounded = round(cost, 2)
-        return rounded
+        return Money.from_number(self.unit_price * self.quantity)
 
     def cost_usd(self):
         return utils.to_usd(self.cost)
@@ -319,7 +1111,7 @@ class Item(models.Model):
         return "%.3f of %s for %s" % (self.quantity, self.product.name, self.cost_usd())
 
 
-class Fee(models.Model):
+class Fee(ReceiptComponent):
     receipt = models.ForeignKey("Receipt", related_name="fees")
     name = models.CharField(max_length=100)
     quantity = models.PositiveIntegerField(null=True, default=1)
@@ -331,7 +1123,7 @@ class Fee(models.Model):
 
     @property
     def cost(self):
-        return self.amount * self.quantity
+        return Money.from_number(self.amount) * (self.quantity or 0)
 
     def cost_usd(self):
         return utils.to_usd(self.cost)
@@ -341,7 +1133,7 @@ class Fee(models.Model):
         return "%d of %s for %s" % (self.quantity, self.name, self.cost_usd())
 
 
-class Discount(models.Model):
+class Discount(ReceiptComponent):
     receipt = models.ForeignKey("Receipt", related_name="discounts")
     name = models.CharField(max_length=100)
     amount = models.DecimalField(max_digits=6, decimal_places=2) # up to 999999.99
@@ -354,7 +1146,48 @@ class Discount(models.Model):
         return "%s for %s" % (self.name, self.amount_usd())
 
 
-class TaxCharge(models.Model):
+class TaxChargeQuerySet(ReceiptComponentQuerySet):
+    rate_field = models.DecimalField(max_digits=12, decimal_places=6)
+
+    def _share(self, amount, total):
+        """``amount / total`` as a decimal fraction, NULL where ``total`` is zero"""
+        # the multiplier keeps SQLite from dividing whole amounts, stored as integers, as integers
+        share = models.F(amount) * models.Value(Decimal("1.000000")) / models.F(total)
+        return models.Case(models.When(**{total: 0, "then": models.Value(None)}),
+                           default=models.ExpressionWrapper(share, output_field=self.rate_field),
+                           output_field=self.rate_field)
+
+    def with_rates(self):
+        """Annotate ``rate_amount``, the share of the receipt total charged as the tax, which ``rate()`` reads"""
+        return self.annotate(rate_amount=self._share("amount", "receipt__total_cache"))
+
+    def report(self, period=models.functions.TruncMonth):
+        """Tax charged per tax and period, oldest period first, in a single query
+
+        Each row has ``tax``, ``tax__name``, ``period``, the number of ``charges``, the ``charged`` amount,
+        the ``receipts_total`` of the receipts charged and the effective ``rate`` between the two. A receipt
+        charged the same tax twice counts once towards ``receipts_total``.
+        """
+        charged = self.filter(tax__pk=models.OuterRef(models.OuterRef("tax"))).order_by().values("receipt")
+        receipts_total = (Receipt.objects
+                          .annotate(period=period("date"))
+                          .filter(period=models.OuterRef("period"), pk__in=models.Subquery(charged))
+                          .order_by()
+                          .values("period")
+                          .annotate(total=models.Sum("total_cache"))
+                          .values("total"))
+        return (self
+                .annotate(period=period("receipt__date"))
+                .order_by()
+                .values("tax", "tax__name", "period")
+                .annotate(charges=models.Count("pk"),
+                          charged=models.Sum("amount"))
+                .annotate(receipts_total=GroupSubquery(receipts_total, output_field=ReceiptQuerySet.money_field))
+                .annotate(rate=self._share("charged", "receipts_total"))
+                .order_by("period", "tax__name"))
+
+
+class TaxCharge(ReceiptComponent):
     tax = models.ForeignKey("Tax", related_name="charges")
     receipt = models.ForeignKey("Receipt", related_name="taxes")
     amount = models.DecimalField(max_digits=8, decimal_places=2) # up to 999999.99
@@ -367,25 +1200,33 @@ class TaxCharge(models.Model):
         return utils.to_usd(self.amount)
     amount_usd.short_description = "Amount (USD)"
 
+    objects = TaxChargeQuerySet.as_manager()
+
     def rate(self):
-        return self.amount / self.receipt.total
+        """Share of the receipt total, from the ``with_rates()`` annotation when present; None for a zero total"""
+        if hasattr(self, "rate_amount"):
+            return self.rate_amount
+        total = self.receipt.total
+        return self.amount / total if total else None
     rate.short_description = "Tax Rate"
 
     def percentage(self):
         """Convert tax rate decimal into a percentage, e.g. 0.14 --> 14"""
-        return self.rate() * 100
+        rate = self.rate()
+        return None if rate is None else rate * 100
     percentage.short_description = "Tax %"
 
     def percentage_str(self):
         """Convert tax rate decimal into a percentage string, e.g. 0.14 --> 14%"""
-        return "%2.3f%%" % self.percentage()
+        percentage = self.percentage()
+        return "n/a" if percentage is None else "%2.3f%%" % percentage
     percentage_str.short_description = "Tax"
 
     def __str__(self):
         return "%s (%s)" % (self.tax.name, self.percentage_str())
 
 
-class Gratuity(models.Model):
+class Gratuity(ReceiptComponent):
     receipt = models.ForeignKey("Receipt", related_name="gratuities")
     to = models.CharField("server, salesperson, etc", max_length=100, null=True, blank=True)
     amount = models.DecimalField(max_digits=6, decimal_places=2) # up to 999999.99
@@ -402,3 +1243,294 @@ class Gratuity(models.Model):
         if self.to:
             repr = "%s for %s" % (self.amount_usd(), self.to)
         return repr
+
+
+class SpendingRollupQuerySet(models.QuerySet):
+    money_field = models.DecimalField(max_digits=12, decimal_places=2)
+
+    @staticmethod
+    def component_column(model):
+        """The rollup column a receipt component model adds up into, None when it is not rolled up"""
+        return {Item: "purchases", Fee: "fees", Discount: "discounts", TaxCharge: "taxes", Gratuity: "tips"}.get(model)
+
+    def contributions(self, components):
+        """Sums a queryset of receipt components adds to each (year, month, supplier, product type) key
+
+        Item purchases count towards the primary (lowest pk) type of their product and every other
+        component towards no product type. Returns ``{key: {column: amount}}`` from one grouped query.
+        """
+        column = self.component_column(components.model)
+        if column is None:
+            return {}
+        components = components.order_by().annotate(year=models.functions.ExtractYear("receipt__date"),
+                                                    month=models.functions.ExtractMonth("receipt__date"))
+        if components.model is Item:
+            components = components.annotate(product_type=ItemQuerySet.primary_type())
+            amount = Round(models.F("unit_price") * models.F("quantity"))
+            key_fields = ("year", "month", "receipt__supplier", "product_type")
+        else:
+            amount = models.F("amount")
+            key_fields = ("year", "month", "receipt__supplier")
+        rows = components.values(*key_fields).annotate(amount=models.Sum(amount, output_field=self.money_field))
+        contributions = {}
+        for row in rows:
+            key = (row["year"], row["month"], row["receipt__supplier"], row.get("product_type"))
+            contributions.setdefault(key, {})[column] = row["amount"]
+        return contributions
+
+    def receipt_contributions(self, receipts):
+        """Sums every component of a queryset of receipts adds to each rollup key"""
+        contributions = {}
+        for model in (Item, Fee, Discount, TaxCharge, Gratuity):
+            self.merge(contributions, self.contributions(model.objects.filter(receipt__in=receipts)))
+        return contributions
+
+    @staticmethod
+    def merge(target, contributions, sign=1):
+        for (key, sums) in contributions.items():
+            row = target.setdefault(key, {})
+            for (column, amount) in sums.items():
+                row[column] = row.get(column, 0) + sign * amount
+        return target
+
+    def apply(self, after, before=None):
+        """Add the difference of two ``contributions()`` results to the stored running sums
+
+        Inside ``defer_totals()`` the difference is queued and applied once, on exit.
+        """
+        deltas = self.merge(self.merge({}, after), before or {}, sign=-1)
+        pending = getattr(_totals_state, "rollup", None)
+        if pending is not None:
+            self.merge(pending, deltas)
+            return
+        self.add(deltas)
+        SupplierStats.objects.apply(self.supplier_spend(deltas))
+
+    def add(self, deltas):
+        """Add ``apply()`` deltas to the stored running sums"""
+        # zero deltas too: a product type added besides the primary one changes the spending pivots
+        for year in set(key[0] for key in deltas):
+            report_cache.bump("spending:%i" % year)
+        for ((year, month, supplier_id, product_type_id), sums) in deltas.items():
+            sums = dict((column, amount) for (column, amount) in sums.items() if amount)
+            if not sums:
+                continue
+            updated = self.filter(year=year, month=month, supplier_id=supplier_id,
+                                  product_type_id=product_type_id).update(
+                **dict((column, models.F(column) + amount) for (column, amount) in sums.items()))
+            if not updated:
+                self.create(year=year, month=month, supplier_id=supplier_id, product_type_id=product_type_id,
+                            **sums)
+
+    @staticmethod
+    def supplier_spend(deltas):
+        """The change ``apply()`` deltas make to the receipt totals of each supplier, as ``SupplierStats`` changes"""
+        spend = {}
+        for ((year, month, supplier_id, product_type_id), sums) in deltas.items():
+            amount = (sums.get("purchases", 0) + sums.get("fees", 0) - sums.get("discounts", 0)
+                      + sums.get("taxes", 0) + sums.get("tips", 0))
+            SupplierStats.objects.merge(spend, {supplier_id: {"spend": amount}})
+        return spend
+
+    def summarize(self):
+        """Sum the running sums per month, returning ``(totals, periods)`` like ``ReceiptQuerySet.summarize``"""
+        sums = dict((column, models.Sum(column)) for column in SpendingRollup.columns)
+        periods = []
+        for row in self.order_by().values("year", "month").annotate(**sums).order_by("year", "month"):
+            period = {"period": date(row.pop("year"), row.pop("month"), 1)}
+            period.update((column, row[column]) for column in SpendingRollup.columns)
+            period["final"] = (row["purchases"] + row["fees"] - row["discounts"] + row["taxes"] + row["tips"])
+            periods.append(period)
+        totals = dict((name, Money.sum(period[name] for period in periods))
+                      for name in SpendingRollup.columns + ("final",))
+        return (totals, periods)
+
+
+class SpendingRollup(models.Model):
+    """Running sums of spending per month, supplier and product type
+
+    Maintained by deltas from the receipt component hooks in signals.py; rebuilt from scratch by the
+    ``backfill_spending_rollup`` management command.
+    """
+    year = models.PositiveSmallIntegerField()
+    month = models.PositiveSmallIntegerField()
+    supplier = models.ForeignKey("Supplier", related_name="rollups")
+    product_type = models.ForeignKey("ProductType", related_name="rollups", null=True, blank=True)
+    purchases = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    fees = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    discounts = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    taxes = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    tips = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    columns = ("purchases", "fees", "discounts", "taxes", "tips")
+
+    objects = SpendingRollupQuerySet.as_manager()
+
+    class Meta:
+        ordering = ("year", "month",)
+        unique_together = ("year", "month", "supplier", "product_type")
+
+    def __str__(self):
+        return "%04i-%02i %s (%s)" % (self.year, self.month, self.supplier, self.product_type or "no product type")
+
+
+class SupplierStatsQuerySet(models.QuerySet):
+    @staticmethod
+    def top_product():
+        """Subquery of the product a supplier's receipts hold the most items of, the lowest pk on a tie"""
+        favorites = (Item.objects
+                     .filter(receipt__supplier=models.OuterRef("supplier"))
+                     .order_by()
+                     .values("product")
+                     .annotate(purchases=models.Count("pk"))
+                     .order_by("-purchases", "product_id"))
+        return models.Subquery(favorites.values("product")[:1], output_field=models.IntegerField())
+
+    def refresh(self):
+        """Recompute the statistics from the stored receipt totals in a single UPDATE"""
+        receipts = Receipt.objects.filter(supplier=models.OuterRef("supplier")).order_by().values("supplier")
+        rows = self.update(
+            visits=models.functions.Coalesce(models.Subquery(receipts.annotate(count=models.Count("pk"))
+                                                             .values("count"), output_field=models.IntegerField()), 0),
+            spend=models.functions.Coalesce(models.Subquery(receipts.annotate(spend=models.Sum("total_cache"))
+                                                            .values("spend"),
+                                                            output_field=SpendingRollupQuerySet.money_field), 0),
+            last_visit=models.Subquery(receipts.annotate(last=models.Max("date")).values("last"),
+                                       output_field=models.DateField()),
+            top_product=self.top_product())
+        if rows:
+            autocomplete_cache.bump("supplier")  # the labels show the statistics
+        return rows
+
+    @staticmethod
+    def purchases(items, change):
+        """``{supplier id: {change: {product ids}}}`` for the items of a queryset, ``change`` being ``bought``
+        or ``unbought``"""
+        purchases = {}
+        for (supplier_id, product_id) in items.order_by().values_list("receipt__supplier", "product").distinct():
+            purchases.setdefault(supplier_id, {}).setdefault(change, set()).add(product_id)
+        return purchases
+
+    @staticmethod
+    def merge(target, changes):
+        for (supplier_id, values) in changes.items():
+            row = target.setdefault(supplier_id, {})
+            for (name, value) in values.items():
+                if isinstance(value, set):
+                    row[name] = row.get(name, set()) | value
+                else:
+                    row[name] = row.get(name, 0) + value
+        return target
+
+    def apply(self, changes):
+        """Add changes to the stored statistics, without recounting the receipts of their suppliers
+
+        ``changes`` maps supplier ids to any of the differences in ``visits`` and ``spend``, the sets of
+        receipt dates ``visited`` and ``unvisited`` and of products ``bought`` and ``unbought`` (whose item
+        counts rose and fell). The last visit is only looked up again when the stored one was unvisited,
+        and the top product only recomputed when a change could displace it. Inside ``defer_totals()``
+        the changes are queued and applied once, on exit.
+        """
+        pending = getattr(_totals_state, "suppliers", None)
+        if pending is not None:
+            self.merge(pending, changes)
+            return
+        changes = dict((supplier_id, values) for (supplier_id, values) in changes.items() if supplier_id is not None)
+        dated = [supplier_id for (supplier_id, values) in changes.items()
+                 if values.get("visited") or values.get("unvisited")]
+        stored = dict(self.filter(supplier__in=dated).values_list("supplier", "last_visit")) if dated else {}
+        unvisited = [supplier_id for (supplier_id, day) in stored.items()
+                     if day in changes[supplier_id].get("unvisited", ())]
+        latest = dict(Receipt.objects
+                      .filter(supplier__in=unvisited)
+                      .order_by()
+                      .values("supplier")
+                      .annotate(last=models.Max("date"))
+                      .values_list("supplier", "last")) if unvisited else {}
+        relabel = False  # the autocomplete labels show visits and the last visit
+        missing = set()
+        for (supplier_id, values) in changes.items():
+            updates = {}
+            if values.get("visits"):
+                updates["visits"] = models.F("visits") + values["visits"]
+                relabel = True
+            if values.get("spend"):
+                updates["spend"] = models.F("spend") + values["spend"]
+            if supplier_id in stored:
+                days = [latest.get(supplier_id) if supplier_id in unvisited else stored[supplier_id]]
+                last_visit = max([day for day in days + list(values.get("visited", ())) if day] or [None])
+                if last_visit != stored[supplier_id]:
+                    updates["last_visit"] = last_visit
+                    relabel = True
+            (bought, unbought) = (values.get("bought", set()), values.get("unbought", set()))
+            if len(bought) > 1:  # at most one of them is the top product already
+                updates["top_product"] = self.top_product()
+            elif bought or unbought:
+                # the top product can only be overtaken by another one gaining an item, or lose its own; a
+                # deleted top product is already NULL (SET_NULL runs before the items' post_delete)
+                displaced = models.Q(top_product__isnull=True)
+                if unbought:
+                    displaced |= models.Q(top_product__in=unbought)
+                for product_id in bought:
+                    displaced |= ~models.Q(top_product=product_id)
+                updates["top_product"] = models.Case(models.When(displaced, then=self.top_product()),
+                                                     default=models.F("top_product"),
+                                                     output_field=models.IntegerField())
+            if updates and not self.filter(supplier_id=supplier_id).update(**updates) and values.get("visits", 0) > 0:
+                missing.add(supplier_id)  # the first receipt of a supplier
+        refreshed = self.refresh_suppliers(missing) if missing else 0
+        if relabel and not refreshed:  # refreshing bumps it already
+            autocomplete_cache.bump("supplier")
+
+    def refresh_suppliers(self, supplier_ids):
+        """Refresh the statistics of the given suppliers, creating the rows they do not have yet"""
+        supplier_ids = set(supplier_ids) - {None}
+        if not supplier_ids:
+            return 0
+        rows = self.filter(supplier__in=supplier_ids).refresh()
+        if rows < len(supplier_ids):
+            missing = supplier_ids - set(self.filter(supplier__in=supplier_ids).values_list("supplier", flat=True))
+            missing &= set(Supplier.objects.filter(pk__in=missing).values_list("pk", flat=True))
+            if missing:
+                self.bulk_create([SupplierStats(supplier_id=supplier_id) for supplier_id in missing])
+                rows += self.filter(supplier__in=missing).refresh()
+        return rows
+
+
+class SupplierStats(models.Model):
+    """Visits and spending per supplier, for the admin and for ranking the supplier autocomplete
+
+    Maintained by changes from the receipt and item hooks in signals.py and the spending rollup deltas;
+    rebuilt from scratch by the ``rebuild_supplier_stats`` management command.
+    """
+    supplier = models.OneToOneField("Supplier", related_name="stats")
+    visits = models.PositiveIntegerField(default=0, db_index=True)
+    spend = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    last_visit = models.DateField(null=True, blank=True)
+    top_product = models.ForeignKey("Product", related_name="+", null=True, blank=True, on_delete=models.SET_NULL)
+
+    objects = SupplierStatsQuerySet.as_manager()
+
+    class Meta:
+        verbose_name_plural = "supplier stats"
+
+    @property
+    def average_basket(self):
+        """Mean receipt total as Money, None before the first visit"""
+        if not self.visits:
+            return None
+        return Money.from_number(Decimal(self.spend) / self.visits)
+
+    def __str__(self):
+        return "%s: %i visits" % (self.supplier, self.visits)
+
+
+class StoredImage(models.Model):
+    """A distinct image kept by ``storage.ContentAddressedStorage``, with the number of uploads sharing it"""
+    name = models.CharField(max_length=255, unique=True)
+    original_name = models.CharField("Name of the first upload", max_length=255)
+    size = models.PositiveIntegerField()
+    references = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return "%s (%s)" % (self.name, self.original_name)
@@ -0,0 +1,142 @@
+from decimal import Decimal, ROUND_HALF_EVEN, ROUND_HALF_UP
+from functools import total_ordering
+
+from django.conf import settings
+from django.utils import six
+
+
+ONE = Decimal(1)
+ROUNDINGS = {"half_up": ROUND_HALF_UP, "half_even": ROUND_HALF_EVEN}
+USD_CACHE_SIZE = 10000
+
+_usd_cache = {}
+
+
+def rounding():
+    """The ``decimal`` rounding mode named by the ``MIZER_MONEY_ROUNDING`` setting: half_up or half_even"""
+    return ROUNDINGS[getattr(settings, "MIZER_MONEY_ROUNDING", "half_up")]
+
+
+@total_ordering
+class Money(object):
+    """An immutable amount of money held as a whole number of cents
+
+    Adding, subtracting and summing are integer operations, so totals of many amounts neither pay for
+    ``Decimal`` contexts nor drift like floats. Amounts are rounded to the cent once, when they are made
+    from a number, with the ``MIZER_MONEY_ROUNDING`` mode; ``half_up`` matches the ``ROUND()`` of the
+    database, which computes the stored receipt totals. Money compares equal to the number it rounds from,
+    and ``str()`` gives that number, so it can stand in for the ``Decimal`` totals it replaces; ints and
+    Decimals added to or subtracted from it are rounded to the cent first.
+    """
+    __slots__ = ("cents",)
+
+    def __init__(self, cents=0):
+        object.__setattr__(self, "cents", int(cents))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Money is immutable")
+
+    def __reduce__(self):
+        return (Money, (self.cents,))  # pickled by caches; the default would set the slot after creation
+
+    @classmethod
+    def from_number(cls, value):
+        """Money from an int, float, Decimal or numeric string of dollars, rounded to the cent"""
+        if isinstance(value, Money):
+            return value
+        if isinstance(value, six.integer_types):
+            return cls(value * 100)
+        if isinstance(value, float):
+            value = repr(value)  # the shortest decimal that reads back as the float, not its binary expansion
+        return cls(Decimal(value).scaleb(2).quantize(ONE, rounding=rounding()))
+
+    @classmethod
+    def sum(cls, values):
+        """Total of Money or numbers, e.g. the ``Decimal`` columns of a query"""
+        return cls(sum(value.cents if isinstance(value, Money) else cls.from_number(value).cents
+                       for value in values))
+
+    @property
+    def decimal(self):
+        return Decimal(self.cents).scaleb(-2)
+
+    def usd(self):
+        """US dollar formatting: ``$1234.50``, ``-$0.05``; recently formatted amounts are cached"""
+        text = _usd_cache.get(self.cents)
+        if text is None:
+            (dollars, cents) = divmod(abs(self.cents), 100)
+            text = "%s$%i.%02i" % ("-" if self.cents < 0 else "", dollars, cents)
+            if len(_usd_cache) >= USD_CACHE_SIZE:
+                _usd_cache.clear()
+            _usd_cache[self.cents] = text
+        return text
+
+    @staticmethod
+    def _operand(other):
+        """Money for another operand of ``+`` and ``-``: Money, an int or a Decimal; None for anything else"""
+        if isinstance(other, Money):
+            return other
+        if isinstance(other, six.integer_types + (Decimal,)) and not isinstance(other, bool):
+            return Money.from_number(other)
+        return None
+
+    def __add__(self, other):
+        other = self._operand(other)
+        return NotImplemented if other is None else Money(self.cents + other.cents)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        other = self._operand(other)
+        return NotImplemented if other is None else Money(self.cents - other.cents)
+
+    def __rsub__(self, other):
+        other = self._operand(other)
+        return NotImplemented if other is None else Money(other.cents - self.cents)
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __mul__(self, factor):
+        """Multiply by a quantity, rounding the product to the cent"""
+        if isinstance(factor, Money):
+            return NotImplemented
+        return Money.from_number(self.decimal * (factor if isinstance(factor, Decimal) else Decimal("%s" % factor)))
+
+    __rmul__ = __mul__
+
+    def _cents_of(self, other):
+        if isinstance(other, Money):
+            return other.cents
+        if isinstance(other, six.integer_types + (float, Decimal)):
+            return Decimal("%s" % other).scaleb(2)  # unrounded, so only equal amounts compare equal
+        return None
+
+    def __eq__(self, other):
+        cents = self._cents_of(other)
+        return NotImplemented if cents is None else self.cents == cents
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __lt__(self, other):
+        cents = self._cents_of(other)
+        return NotImplemented if cents is None else self.cents < cents
+
+    def __hash__(self):
+        return hash(self.decimal)
+
+    def __bool__(self):
+        return self.cents != 0
+
+    __nonzero__ = __bool__
+
+    def __float__(self):
+        return self.cents / 100.0
+
+    def __str__(self):
+        return "%s" % self.decimal
+
+    def __repr__(self):
+        return "Money('%s')" % self.decimal
@@ -0,0 +1,111 @@
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+import csv
+from datetime import timedelta
+from decimal import InvalidOperation
+
+from django.utils.dateparse import parse_date
+
+from .models import Payment, utils
+from .money import Money
+
+
+class StatementError(ValueError):
+    pass
+
+
+class StatementLine(namedtuple("StatementLine", ("number", "date", "amount", "description"))):
+    """A statement entry: its line number in the file, date, Money amount and description"""
+    __slots__ = ()
+
+
+def read_statement(stream, charges_negative=False):
+    """Yield a ``StatementLine`` for every row of a CSV statement with date, amount and description columns
+
+    With ``charges_negative`` the statement lists charges as negative amounts and refunds as positive ones,
+    the opposite of payments.
+    """
+    for (number, row) in enumerate(csv.DictReader(stream), 2):
+        try:
+            day = parse_date((row.get("date") or "").strip())
+        except ValueError:  # well formed, but out of range
+            day = None
+        if day is None:
+            raise StatementError("line %i: invalid date: %r" % (number, row.get("date")))
+        try:
+            amount = Money.from_number((row.get("amount") or "").replace(",", "").replace("$", "").strip())
+        except (InvalidOperation, ValueError):
+            raise StatementError("line %i: invalid amount: %r" % (number, row.get("amount")))
+        yield StatementLine(number, day, -amount if charges_negative else amount, row.get("description") or "")
+
+
+Reconciliation = namedtuple("Reconciliation", ("matched", "unmatched", "ambiguous"))
+
+
+class StatementReconciler(object):
+    """Match the lines of a payment method statement against the unreconciled payments made with it
+
+    A line matches a payment of the same amount on a receipt dated up to ``days`` days either side of
+    it. Of several such payments, those on receipts from a supplier named in the line description are
+    preferred, then the one closest in date; a tie leaves the line ambiguous. Each payment matches at
+    most one line, earlier lines first.
+
+    Payments are read in one query and indexed by amount, each amount's payments sorted by date, so a
+    line finds its candidates by a dict lookup and a binary search rather than a scan of every payment.
+    """
+
+    def __init__(self, payment_method, days=3):
+        self.payment_method = payment_method
+        self.window = timedelta(days=days)
+
+    def payments(self, lines):
+        """``{cents: ([dates], [(date, payment id, normalized supplier name)])}`` covering the lines"""
+        index = {}
+        if not lines:
+            return index
+        payments = (Payment.objects
+                    .filter(payment_method=self.payment_method, reconciled=False,
+                            receipt__date__gte=min(line.date for line in lines) - self.window,
+                            receipt__date__lte=max(line.date for line in lines) + self.window)
+                    .values_list("receipt__date", "pk", "amount", "receipt__supplier__search_name")
+                    .order_by("receipt__date", "pk"))
+        for (day, pk, amount, supplier) in payments:
+            (dates, entries) = index.setdefault(Money.from_number(amount).cents, ([], []))
+            dates.append(day)
+            entries.append((day, pk, supplier))
+        return index
+
+    def reconcile(self, lines):
+        """Return ``Reconciliation(matched=[(line, payment id)], unmatched=[line], ambiguous=[(line, [ids])])``
+
+        Each list is in statement order.
+        """
+        lines = sorted(lines, key=lambda line: (line.date, line.number))
+        index = self.payments(lines)
+        used = set()
+        result = Reconciliation([], [], [])
+        for line in lines:
+            (dates, entries) = index.get(line.amount.cents, ((), ()))
+            candidates = [entry for entry in entries[bisect_left(dates, line.date - self.window):
+                                                     bisect_right(dates, line.date + self.window)]
+                          if entry[1] not in used]
+            description = " %s " % utils.normalize_search(line.description)
+            named = [entry for entry in candidates if entry[2] and " %s " % entry[2] in description]
+            candidates = named or candidates
+            if not candidates:
+                result.unmatched.append(line)
+                continue
+            distances = sorted((abs((day - line.date).days), pk) for (day, pk, supplier) in candidates)
+            if len(distances) > 1 and distances[0][0] == distances[1][0]:
+                result.ambiguous.append((line, [pk for (distance, pk) in distances]))
+                continue
+            used.add(distances[0][1])
+            result.matched.append((line, distances[0][1]))
+        for reported in result:
+            reported.sort(key=lambda entry: entry.number if isinstance(entry, StatementLine) else entry[0].number)
+        return result
+
+    @staticmethod
+    def apply(reconciliation):
+        """Mark the matched payments reconciled, so later statements no longer match them"""
+        return Payment.objects.filter(pk__in=[pk for (line, pk) in reconciliation.matched]).update(reconciled=True)
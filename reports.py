@@ -0,0 +1,106 @@
+from datetime import date, timedelta
+
+from django.db.models.functions import TruncDay, TruncMonth, TruncYear
+
+from .cache import report_cache
+from .models import Item, ProductType, Receipt, ReceiptQuerySet
+from .money import Money
+
+
+def same_period_years(start, end, years):
+    """``(start, end)`` and the same dates in each of the ``years - 1`` years before, oldest first
+
+    February 29th falls back to the 28th in years that have none.
+    """
+    def shift(day, back):
+        try:
+            return day.replace(year=day.year - back)
+        except ValueError:
+            return day.replace(year=day.year - back, day=28)
+    return [(shift(start, back), shift(end, back)) for back in range(years - 1, -1, -1)]
+
+
+def compare_periods(ranges, receipts=None):
+    """The totals of each ``(start, end)`` range, from ``ReceiptQuerySet.compare``, with their changes
+
+    Every period but the first also holds ``change``, the difference from the period before it per total
+    and in the number of receipts, and ``percent``, that difference in percent of the earlier amount
+    (None when it was zero).
+    """
+    receipts = Receipt.objects.all() if receipts is None else receipts
+    periods = receipts.compare(ranges)
+    names = [name for (name, field) in ReceiptQuerySet.summary_fields] + ["paid"]
+    for (previous, period) in zip(periods, periods[1:]):
+        period["change"] = dict((name, period[name] - previous[name]) for name in names)
+        period["change"]["receipts"] = period["receipts"] - previous["receipts"]
+        period["percent"] = dict((name, round(100.0 * period["change"][name].cents / previous[name].cents, 1)
+                                  if previous[name] else None) for name in names)
+    return periods
+
+
+def period_start(day, period):
+    """First day of the week (Monday), month, quarter or year holding ``day``"""
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    if period == "quarter":
+        return date(day.year, (day.month - 1) // 3 * 3 + 1, 1)
+    return date(day.year, 1, 1)
+
+
+class SpendingPivot(object):
+    """Item spending per product type and week, month, quarter or year
+
+    Spending is read a year at a time with ``ItemQuerySet.spending_by_type``, grouped by day for weeks
+    (which Django 1.11 cannot truncate to), by month for months and quarters and by year for years, and
+    folded into the requested periods here. Each year is cached in ``report_cache`` until a change to its
+    spending rollup, which every item, receipt and product type change goes through, bumps its version.
+    """
+    grains = {"week": TruncDay, "month": TruncMonth, "quarter": TruncMonth, "year": TruncYear}
+
+    def __init__(self, period="month", allocation="full"):
+        if period not in self.grains:
+            raise ValueError("Unknown period: %s" % period)
+        if allocation not in Item.allocations:
+            raise ValueError("Unknown allocation: %s" % allocation)
+        self.period = period
+        self.allocation = allocation
+
+    def year(self, year):
+        """``[(product type id, day, cents)]`` of one year at the grain of the period, cached"""
+        grain = self.grains[self.period]
+        key = report_cache.key("spending:%i" % year, "types", grain.kind, self.allocation)
+        rows = report_cache.get(key)
+        if rows is None:
+            spending = (Item.objects
+                        .filter(receipt__date__gte=date(year, 1, 1), receipt__date__lte=date(year, 12, 31))
+                        .spending_by_type(grain, self.allocation))
+            rows = [(product_type, day, Money.from_number(spend).cents) for (day, product_type, spend) in spending]
+            report_cache.set(key, rows)
+        return rows
+
+    def build(self, start, end):
+        """The pivot of the receipts dated ``start`` through ``end``
+
+        Returns ``{"periods": [first days], "rows": [{"product_type", "name", "spend", "total"}], "totals"}``
+        with ``spend`` and ``totals`` lists of Money aligned with ``periods``; months and years of a
+        partial range are reported whole.
+        """
+        grain = self.grains[self.period].kind
+        first = start if grain == "day" else period_start(start, grain)
+        cells = {}
+        for year in range(start.year, end.year + 1):
+            for (product_type, day, cents) in self.year(year):
+                if first <= day <= end:
+                    cell = (product_type, period_start(day, self.period))
+                    cells[cell] = cells.get(cell, 0) + cents
+        periods = sorted(set(period for (product_type, period) in cells))
+        names = dict(ProductType.objects.filter(pk__in=set(cell[0] for cell in cells)).values_list("pk", "name"))
+        rows = []
+        for product_type in sorted(set(cell[0] for cell in cells), key=lambda pk: (pk is None, names.get(pk, ""))):
+            spend = [Money(cells.get((product_type, period), 0)) for period in periods]
+            rows.append({"product_type": product_type, "name": names.get(product_type, "No product type"),
+                         "spend": spend, "total": Money.sum(spend)})
+        totals = [Money.sum(row["spend"][index] for row in rows) for index in range(len(periods))]
+        return {"periods": periods, "rows": rows, "totals": totals}
@@ -0,0 +1,223 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+
+from .cache import autocomplete_cache, page_cache
+from .models import (Item, Fee, Discount, TaxCharge, Gratuity, Payment, Product, ProductType, Receipt, SpendingRollup,
+                     Supplier, defer_totals, deletion_marks, touch_product_purchases, touch_receipt_totals,
+                     touch_supplier_stats)
+from .thumbnails import thumbnails
+
+
+RECEIPT_COMPONENTS = (Item, Fee, Discount, TaxCharge, Gratuity, Payment)
+
+
+def component_saving(sender, instance, raw=False, **kwargs):
+    """Remember what the stored row contributed to the spending rollup before it is overwritten"""
+    instance._rollup_before = {}
+    if not raw and not instance._state.adding:
+        instance._rollup_before = SpendingRollup.objects.contributions(sender.objects.filter(pk=instance.pk))
+
+
+def component_saved(sender, instance, raw=False, **kwargs):
+    """Refresh the totals of the receipt a component belongs to, and of the one it was moved from"""
+    if raw:
+        return
+    after = SpendingRollup.objects.contributions(sender.objects.filter(pk=instance.pk))
+    before = getattr(instance, "_rollup_before", None) or {}
+    loaded_receipt_id = getattr(instance, "_loaded_receipt_id", None)
+    loaded_product_id = getattr(instance, "_loaded_product_id", None)
+    with defer_totals():  # one supplier statistics update for the spending and the purchases
+        SpendingRollup.objects.apply(after, before)
+        if loaded_receipt_id != instance.receipt_id:
+            touch_receipt_totals(loaded_receipt_id)
+        touch_receipt_totals(instance.receipt_id, instance.cached_receipt())
+        if sender is Item and (loaded_receipt_id, loaded_product_id) != (instance.receipt_id, instance.product_id):
+            # the rollup keys hold the suppliers of the receipts the item was and is on
+            for key in before:
+                touch_supplier_stats(key[2], unbought={loaded_product_id})
+            for key in after:
+                touch_supplier_stats(key[2], bought={instance.product_id})
+    instance._loaded_receipt_id = instance.receipt_id
+
+
+def component_deleting(sender, instance, **kwargs):
+    """Remember what the row contributed to the spending rollup before it is deleted"""
+    instance._rollup_before = SpendingRollup.objects.contributions(sender.objects.filter(pk=instance.pk))
+
+
+def component_deleted(sender, instance, **kwargs):
+    # the rollup rows of a supplier being deleted are deleted with it, before its components
+    suppliers = deletion_marks("suppliers") or ()
+    before = dict((key, sums) for (key, sums) in (getattr(instance, "_rollup_before", None) or {}).items()
+                  if key[2] not in suppliers)
+    with defer_totals():  # one supplier statistics update for the spending and the purchases
+        SpendingRollup.objects.apply({}, before)
+        if sender is Item:
+            for key in before:
+                touch_supplier_stats(key[2], unbought={instance.product_id})
+        if instance.receipt_id not in (deletion_marks("receipts") or ()):  # else deleted along with its receipt
+            touch_receipt_totals(instance.receipt_id, instance.cached_receipt())
+
+
+def item_saved(sender, instance, raw=False, **kwargs):
+    """Recount the purchases of the product an item is for, and of the one it was changed from"""
+    if raw:
+        return
+    loaded_product_id = getattr(instance, "_loaded_product_id", None)
+    if loaded_product_id != instance.product_id:
+        touch_product_purchases(loaded_product_id)
+        touch_product_purchases(instance.product_id)
+    instance._loaded_product_id = instance.product_id
+
+
+def item_deleted(sender, instance, **kwargs):
+    touch_product_purchases(instance.product_id)
+
+
+def searchable_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        instance.reindex_search_tokens()
+
+
+def autocomplete_changed(sender, **kwargs):
+    """Invalidate the cached autocomplete results that render the changed model"""
+    autocomplete_cache.bump("supplier" if sender is Supplier else "product")
+
+
+def receipt_saving(sender, instance, raw=False, **kwargs):
+    """Remember the rollup contributions of a receipt whose month or supplier is about to change, the
+    supplier, date and products of one whose date or supplier is and the year of one whose year is"""
+    instance._rollup_before = instance._stats_before = instance._year_before = None
+    if raw or instance._state.adding:
+        return
+    stored = Receipt.objects.filter(pk=instance.pk).values("date", "supplier_id").first()
+    if stored and ((stored["date"].year, stored["date"].month, stored["supplier_id"])
+                   != (instance.date.year, instance.date.month, instance.supplier_id)):
+        instance._rollup_before = SpendingRollup.objects.receipt_contributions([instance.pk])
+    if stored and (stored["date"], stored["supplier_id"]) != (instance.date, instance.supplier_id):
+        products = set()
+        if stored["supplier_id"] != instance.supplier_id:  # its items move to the other supplier
+            products = set(Item.objects.filter(receipt=instance.pk).values_list("product", flat=True))
+        instance._stats_before = (stored["supplier_id"], stored["date"], products)
+    if stored and stored["date"].year != instance.date.year:
+        instance._year_before = stored["date"].year
+
+
+def receipt_saved(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    with defer_totals():  # one supplier statistics update per supplier
+        if instance._rollup_before is not None:
+            SpendingRollup.objects.apply(SpendingRollup.objects.receipt_contributions([instance.pk]),
+                                         instance._rollup_before)
+        if created or instance._stats_before is not None:
+            (supplier_id, day, products) = instance._stats_before or (None, None, set())
+            touch_supplier_stats(supplier_id, visits=-1, unvisited={day}, unbought=products)
+            touch_supplier_stats(instance.supplier_id, visits=1, visited={instance.date}, bought=products)
+    for year in set([instance.date.year, instance._year_before]) - {None}:
+        page_cache.bump("year:%i" % year)
+
+
+def receipt_deleting(sender, instance, **kwargs):
+    """Mark a receipt being deleted, so the components deleted with it leave its totals alone"""
+    marks = deletion_marks("receipts")
+    if marks is not None:
+        marks.add(instance.pk)
+
+
+def supplier_deleting(sender, instance, **kwargs):
+    """Mark a supplier being deleted, so the components deleted with it leave the rollup alone"""
+    marks = deletion_marks("suppliers")
+    if marks is not None:
+        marks.add(instance.pk)
+
+
+def receipt_deleted(sender, instance, **kwargs):
+    touch_supplier_stats(instance.supplier_id, visits=-1, unvisited={instance.date})
+    page_cache.bump("year:%i" % instance.date.year)
+
+
+def supplier_renamed(sender, instance, created=False, raw=False, **kwargs):
+    """Invalidate the cached pages listing receipts of a changed supplier"""
+    if created or raw:
+        return
+    for day in instance.receipt_set.dates("date", "year"):
+        page_cache.bump("year:%i" % day.year)
+
+
+def image_replacing(sender, instance, raw=False, **kwargs):
+    """Release the stored image a row is about to stop pointing at, when its storage counts references
+
+    The release waits for the commit, so a rolled back save keeps the image its row still points at.
+    """
+    release = getattr(instance.image.storage, "release", None)
+    if raw or release is None or instance._state.adding:
+        return
+    stored = sender.objects.filter(pk=instance.pk).values_list("image", flat=True).first()
+    if stored and stored != instance.image.name:
+        transaction.on_commit(partial(release, stored))
+
+
+def image_deleted(sender, instance, **kwargs):
+    release = getattr(instance.image.storage, "release", None)
+    if release is not None:
+        transaction.on_commit(partial(release, instance.image.name))
+
+
+def image_saved(sender, instance, raw=False, **kwargs):
+    """Queue the thumbnails of a saved image; existing ones are kept, so unchanged images cost no work"""
+    if not raw and instance.image:
+        thumbnails.submit(instance.image)
+
+
+def product_types_changing(sender, instance, action, reverse, pk_set, **kwargs):
+    """Move the purchases of products between rollup product types when their primary type changes"""
+    if reverse:
+        products = Product.objects.filter(pk__in=pk_set) if pk_set is not None else instance.product_set.all()
+    else:
+        products = [instance]
+    items = Item.objects.filter(product__in=list(products))
+    if action.startswith("pre_"):
+        instance._rollup_items = items
+        instance._rollup_before = SpendingRollup.objects.contributions(items)
+    elif hasattr(instance, "_rollup_before"):
+        SpendingRollup.objects.apply(SpendingRollup.objects.contributions(instance._rollup_items),
+                                     instance._rollup_before)
+        del instance._rollup_items, instance._rollup_before
+
+
+def product_type_deleting(sender, instance, **kwargs):
+    """Detach the products first so their purchases move to their next product type"""
+    instance.product_set.clear()
+
+
+for component in RECEIPT_COMPONENTS:
+    uid = "mizer_totals_%s" % component.__name__
+    pre_save.connect(component_saving, sender=component, dispatch_uid="%s_saving" % uid)
+    post_save.connect(component_saved, sender=component, dispatch_uid="%s_saved" % uid)
+    pre_delete.connect(component_deleting, sender=component, dispatch_uid="%s_deleting" % uid)
+    post_delete.connect(component_deleted, sender=component, dispatch_uid="%s_deleted" % uid)
+post_save.connect(item_saved, sender=Item, dispatch_uid="mizer_purchases_item_saved")
+post_delete.connect(item_deleted, sender=Item, dispatch_uid="mizer_purchases_item_deleted")
+for searchable in (Product, Supplier):
+    post_save.connect(searchable_saved, sender=searchable, dispatch_uid="mizer_search_%s_saved" % searchable.__name__)
+for rendered in (Product, ProductType, Supplier):
+    uid = "mizer_autocomplete_%s" % rendered.__name__
+    post_save.connect(autocomplete_changed, sender=rendered, dispatch_uid="%s_saved" % uid)
+    post_delete.connect(autocomplete_changed, sender=rendered, dispatch_uid="%s_deleted" % uid)
+m2m_changed.connect(autocomplete_changed, sender=Product.types.through, dispatch_uid="mizer_autocomplete_product_types")
+pre_save.connect(receipt_saving, sender=Receipt, dispatch_uid="mizer_rollup_receipt_saving")
+post_save.connect(receipt_saved, sender=Receipt, dispatch_uid="mizer_rollup_receipt_saved")
+pre_delete.connect(receipt_deleting, sender=Receipt, dispatch_uid="mizer_totals_receipt_deleting")
+post_delete.connect(receipt_deleted, sender=Receipt, dispatch_uid="mizer_stats_receipt_deleted")
+pre_delete.connect(supplier_deleting, sender=Supplier, dispatch_uid="mizer_rollup_supplier_deleting")
+post_save.connect(supplier_renamed, sender=Supplier, dispatch_uid="mizer_pages_supplier_saved")
+m2m_changed.connect(product_types_changing, sender=Product.types.through, dispatch_uid="mizer_rollup_product_types")
+pre_delete.connect(product_type_deleting, sender=ProductType, dispatch_uid="mizer_rollup_product_type_deleting")
+for imaged in (Product, Receipt):
+    uid = "mizer_images_%s" % imaged.__name__
+    pre_save.connect(image_replacing, sender=imaged, dispatch_uid="%s_replacing" % uid)
+    post_save.connect(image_saved, sender=imaged, dispatch_uid="%s_saved" % uid)
+    post_delete.connect(image_deleted, sender=imaged, dispatch_uid="%s_deleted" % uid)
@@ -0,0 +1,87 @@
+from hashlib import sha256
+from os import listdir, path
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, default_storage, get_storage_class
+from django.db import transaction
+from django.db.models import F
+from django.test.signals import setting_changed
+from django.utils.functional import LazyObject, empty
+
+from .cache import thumbnail_cache
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """File system storage keeping one copy of each distinct upload, named by the SHA-256 of its content
+
+    An upload is hashed chunk by chunk while it streams in and is stored as
+    ``content/ab/cd/abcd...<ext>``; the name built by ``upload_to`` is only recorded as the
+    ``StoredImage.original_name`` of its first upload. Every upload of the same content adds a reference
+    and every ``delete`` removes one; the file and anything stored next to it under the same hash, such as
+    its thumbnails, are deleted with the last reference. Names already under ``content/`` are stored as
+    given, which is how thumbnails end up next to their image.
+    """
+    directory = "content"
+
+    def hashed_name(self, digest, name):
+        return "/".join((self.directory, digest[:2], digest[2:4], digest + path.splitext(name)[1].lower()))
+
+    def is_hashed(self, name):
+        return name.startswith(self.directory + "/")
+
+    def _save(self, name, content):
+        if self.is_hashed(name):
+            return super(ContentAddressedStorage, self)._save(name, content)
+        digest = sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        hashed = self.hashed_name(digest.hexdigest(), name)
+        StoredImage = apps.get_model("mizer", "StoredImage")
+        with transaction.atomic():
+            (stored, created) = StoredImage.objects.select_for_update().get_or_create(
+                name=hashed, defaults={"original_name": name, "size": content.size})
+            if created or not self.exists(hashed):
+                super(ContentAddressedStorage, self)._save(hashed, content)
+            StoredImage.objects.filter(pk=stored.pk).update(references=F("references") + 1)
+        return hashed
+
+    def delete(self, name):
+        if not self.is_hashed(name):
+            return super(ContentAddressedStorage, self).delete(name)
+        StoredImage = apps.get_model("mizer", "StoredImage")
+        with transaction.atomic():
+            if StoredImage.objects.filter(name=name, references__gt=1).update(references=F("references") - 1):
+                return
+            StoredImage.objects.filter(name=name).delete()
+        thumbnail_cache.delete(thumbnail_cache.key("ready", name))
+        (directory, filename) = path.split(name)
+        digest = path.splitext(filename)[0]
+        if self.exists(directory):
+            for stored in listdir(self.path(directory)):
+                if stored.startswith(digest):
+                    super(ContentAddressedStorage, self).delete("%s/%s" % (directory, stored))
+
+    def release(self, name):
+        """Drop the reference held by a model row that no longer points at ``name``"""
+        if name and self.is_hashed(name):
+            self.delete(name)
+
+
+class ImageStorage(LazyObject):
+    """The storage of product and receipt images: ``MIZER_IMAGE_STORAGE`` when set, else the default storage"""
+
+    def _setup(self):
+        storage = getattr(settings, "MIZER_IMAGE_STORAGE", None)
+        self._wrapped = get_storage_class(storage)() if storage else default_storage
+
+
+image_storage = ImageStorage()
+
+
+def image_storage_changed(setting, **kwargs):
+    if setting == "MIZER_IMAGE_STORAGE":
+        image_storage._wrapped = empty
+
+
+setting_changed.connect(image_storage_changed, dispatch_uid="mizer_image_storage_changed")
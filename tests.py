@@ -1,10 +1,41 @@
+# -*- coding: utf-8 -*-
 from datetime import date, time
 from decimal import Decimal
-from os import path
-
-from django.test import TestCase
-
-from mizer.models import utils, Supplier, Tax, TaxCharge, ProductType, Product, Item, Fee, Discount, Gratuity, Receipt
+import json
+import pickle
+from io import BytesIO
+from os import listdir, path
+from shutil import rmtree
+from tempfile import NamedTemporaryFile, mkdtemp
+
+from django import http
+from django.contrib.admin import site
+from django.contrib.admin.templatetags.admin_list import results
+from django.contrib.auth.models import User
+from django.core.exceptions import PermissionDenied
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection, models, reset_queries, transaction
+from django.db.models.signals import pre_delete
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils.six import StringIO
+from PIL import Image
+
+from mizer.admin import ReceiptAdmin, SupplierAdmin, TaxChargeTabularAdmin
+from mizer.benchmarks import Benchmarks
+from mizer.cache import autocomplete_cache, page_cache, report_cache, thumbnail_cache
+from mizer.generator import ReceiptGenerator
+from mizer.instrumentation import QueryCountMiddleware, QueryRecorder, query_budget
+from mizer.money import Money
+from mizer.reconciler import StatementError, StatementLine, StatementReconciler, read_statement
+from mizer.reports import SpendingPivot, compare_periods, same_period_years
+from mizer.thumbnails import thumbnails
+from mizer.views import (ComparisonView, DashboardView, ExportView, ProductAutocompleteView, ReceiptBulkView,
+                         SpendingPivotView, SupplierAutocompleteView, YearListView, YearReceiptsView)
+from mizer.models import (BLANK_IMAGE, utils, Supplier, Tax, TaxCharge, ProductType, Product, Item, Fee, Discount, Gratuity, Receipt,
+                          PaymentMethodType, PaymentMethod, Payment, SpendingRollup, StoredImage, SupplierStats,
+                          defer_totals)
 
 
 class UtilsTest(TestCase):
@@ -207,6 +238,342 @@ class ProductTest(TestCase):
     def test_representation(self):
         self.assertRegexpMatches("%s" % Product.objects.first(), r"\b%s\b" % self.product_name)
 
+    def test_representation_prefetched(self):
+        """The product string reads prefetched types without querying"""
+        product = Product.objects.prefetch_related("types").first()
+        with self.assertNumQueries(0):
+            self.assertRegexpMatches("%s" % product, r"\b%s\b" % self.type_name)
+
+
+class MoneyTest(TestCase):
+    def test_rounding(self):
+        """Amounts are rounded half up by default, and half to even when configured"""
+        self.assertEqual(Money.from_number(Decimal("0.125")).cents, 13)
+        self.assertEqual(Money.from_number(Decimal("-0.125")).cents, -13)
+        with self.settings(MIZER_MONEY_ROUNDING="half_even"):
+            self.assertEqual(Money.from_number(Decimal("0.125")).cents, 12)
+        self.assertEqual(Money.from_number(0.1 + 0.2).cents, 30)
+        self.assertEqual(Money.from_number("2.49") * 3, Decimal("7.47"))
+        self.assertEqual(pickle.loads(pickle.dumps(Money(-5))), Money(-5))
+
+    def test_mixed_arithmetic(self):
+        """Money adds and subtracts with the Decimal totals and ints it stands in for"""
+        self.assertEqual(Money(250) + Decimal("1.25"), Money(375))
+        self.assertEqual(Decimal("1.25") + Money(250), Money(375))
+        self.assertEqual(Money(250) - Decimal("0.50"), Money(200))
+        self.assertEqual(Decimal("5.00") - Money(250), Money(250))
+        self.assertEqual(0 - Money(250), Money(-250))
+        self.assertEqual(Money(250) + 1, Money(350))
+        self.assertEqual(sum([Money(1), Money(2)]), Money(3))
+        with self.assertRaises(TypeError):
+            Money(250) + 1.5
+
+    def test_sum(self):
+        """Sums are exact, where summing floats drifts"""
+        self.assertEqual(Money.sum([0.1] * 10), 1)
+        self.assertNotEqual(sum([0.1] * 10), 1)
+        self.assertEqual(sum([Money(5), Money(7)]), Money(12))
+        self.assertEqual(Money.sum([Decimal("1.10"), Money(5)]).usd(), "$1.15")
+
+    def test_value(self):
+        money = Money.from_number("-1234.5")
+        self.assertEqual((money.usd(), "%s" % money, float(money)), ("-$1234.50", "-1234.50", -1234.5))
+        self.assertEqual(money, Decimal("-1234.50"))
+        self.assertNotEqual(Money(1), Decimal("0.011"))
+        self.assertLess(money, 0)
+        self.assertEqual(len(set([Money(100), Money.from_number(1)])), 1)
+        with self.assertRaises(AttributeError):
+            money.cents = 0
+
+
+class ThumbnailTest(TestCase):
+    def setUp(self):
+        self.media_root = mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root, MEDIA_URL="/media/", MIZER_THUMBNAIL_WORKERS=0)
+        self.settings.enable()
+        thumbnail_cache.clear("ready")
+
+    def tearDown(self):
+        self.settings.disable()
+        rmtree(self.media_root)
+
+    @staticmethod
+    def upload(name="photo.png", color="white"):
+        content = BytesIO()
+        Image.new("RGBA", (800, 600), color).save(content, "PNG")
+        return SimpleUploadedFile(name, content.getvalue())
+
+    def test_thumbnail_path(self):
+        self.assertEqual(utils.thumbnail_path("product/1/2016-02-01_milk.png", "small"), "product/1/2016-02-01_milk_small.jpg")
+
+    def test_saved_images(self):
+        """Thumbnails are written next to product and receipt images and served by image_html"""
+        product = Product.objects.create(name="Milk", image=self.upload())
+        (root, ext) = path.splitext(product.image.name)
+        self.assertEqual(product.image_html(), '<img src="/media/%s_small.jpg" class="thumbnail" alt="">' % root)
+        with Image.open(path.join(self.media_root, "%s_medium.jpg" % root)) as thumbnail:
+            self.assertEqual(thumbnail.size, (200, 150))
+        receipt = Receipt.objects.create(supplier=Supplier.objects.create(name="Store"))
+        receipt.image = self.upload()
+        receipt.save()
+        self.assertNotEqual(utils.thumbnail_url(receipt.image), BLANK_IMAGE)
+
+    def test_rendering_skips_storage(self):
+        """Once the thumbnails are written, rendering an image never asks the storage about them"""
+        product = Product.objects.create(name="Milk", image=self.upload())
+        (root, ext) = path.splitext(product.image.name)
+        rmtree(path.join(self.media_root, path.dirname(root)))
+        self.assertIn("%s_small.jpg" % root, Product.objects.get(pk=product.pk).image_html())
+
+    def stored_without_thumbnails(self):
+        """A product whose image was stored without going through save()"""
+        product = Product.objects.create(name="Milk")
+        Product.objects.filter(pk=product.pk).update(image=default_storage.save("product/photo.png", self.upload()))
+        return Product.objects.get(pk=product.pk)
+
+    def test_background(self):
+        """image_html falls back to the blank image until the worker has written the thumbnail"""
+        product = self.stored_without_thumbnails()
+        self.assertEqual(product.image_html(), '<img src="%s" class="thumbnail" alt="">' % BLANK_IMAGE)
+        self.assertIsNone(thumbnail_cache.get(thumbnail_cache.key("ready", product.image.name)))
+        with override_settings(MIZER_THUMBNAIL_WORKERS=1):
+            self.assertEqual(len(thumbnails.submit(product.image).result()), 2)
+        self.assertNotIn(BLANK_IMAGE, product.image_html())
+        self.assertEqual(thumbnails.generate(product.image.storage, product.image.name), [])
+
+    def test_generate_thumbnails(self):
+        self.stored_without_thumbnails()
+        Product.objects.create(name="Bread")
+        out = StringIO()
+        call_command("generate_thumbnails", stdout=out)
+        self.assertIn("Wrote 2 product thumbnails", out.getvalue())
+
+
+@override_settings(MIZER_IMAGE_STORAGE="mizer.storage.ContentAddressedStorage", MIZER_THUMBNAIL_WORKERS=0)
+class ContentAddressedStorageTest(TransactionTestCase):  # images are released on commit
+    def setUp(self):
+        self.media_root = mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        rmtree(self.media_root)
+
+    def test_deduplicated(self):
+        """Identical uploads share one file, which is deleted with its thumbnails by the last reference"""
+        supplier = Supplier.objects.create(name="Store")
+        receipts = [Receipt.objects.create(supplier=supplier) for index in range(2)]
+        for receipt in receipts:
+            receipt.image = ThumbnailTest.upload()
+            receipt.save()
+        self.assertEqual(receipts[0].image.name, receipts[1].image.name)
+        self.assertRegexpMatches(receipts[0].image.name, r"^content/\w\w/\w\w/\w{64}\.png$")
+        stored = StoredImage.objects.get()
+        self.assertEqual((stored.references, stored.original_name),
+                         (2, "receipt/%s/%i_store.png" % (receipts[0].date.strftime("%Y/%m/%d"), receipts[0].pk)))
+        self.assertNotEqual(utils.thumbnail_url(receipts[1].image), BLANK_IMAGE)
+
+        receipts[0].image = ThumbnailTest.upload(color="red")
+        receipts[0].save()
+        self.assertEqual(StoredImage.objects.get(name=receipts[1].image.name).references, 1)
+        receipts[1].delete()
+        self.assertFalse(StoredImage.objects.filter(name=receipts[1].image.name).exists())
+        self.assertIsNone(thumbnail_cache.get(thumbnail_cache.key("ready", receipts[1].image.name)))
+        self.assertEqual(len(listdir(path.join(self.media_root, path.dirname(receipts[1].image.name)))), 0)
+        self.assertEqual(len(listdir(path.join(self.media_root, path.dirname(receipts[0].image.name)))), 3)
+
+    def test_rolled_back(self):
+        """A rolled back replacement or deletion keeps the image its row still points at"""
+        receipt = Receipt.objects.create(supplier=Supplier.objects.create(name="Store"))
+        receipt.image = ThumbnailTest.upload()
+        receipt.save()
+        name = receipt.image.name
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            receipt.image = ThumbnailTest.upload(color="red")
+            receipt.save()
+            raise RuntimeError("save failed")
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            Receipt.objects.get(pk=receipt.pk).delete()
+            raise RuntimeError("delete failed")
+        self.assertEqual(Receipt.objects.get(pk=receipt.pk).image.name, name)
+        self.assertEqual(StoredImage.objects.get(name=name).references, 1)
+        self.assertTrue(path.exists(path.join(self.media_root, name)))
+
+
+class PriceHistoryTest(TestCase):
+    def setUp(self):
+        self.milk = Product.objects.create(name="Milk")
+        self.bread = Product.objects.create(name="Bread")
+        self.corner, self.market = (Supplier.objects.create(name="Corner"), Supplier.objects.create(name="Market"))
+        for (supplier, day, product, price) in [(self.corner, date(2016, 1, 5), self.milk, "2.00"),
+                                                (self.corner, date(2016, 1, 20), self.milk, "2.50"),
+                                                (self.corner, date(2016, 1, 20), self.milk, "2.45"),
+                                                (self.market, date(2016, 1, 9), self.milk, "1.90"),
+                                                (self.market, date(2016, 2, 1), self.milk, "2.10"),
+                                                (self.market, date(2016, 2, 1), self.bread, "3.00")]:
+            receipt = Receipt.objects.create(supplier=supplier, date=day)
+            Item.objects.create(receipt=receipt, product=product, unit_price=price)
+
+    def test_price_history(self):
+        with self.assertNumQueries(1):
+            history = [(row["supplier"], row["period"], row["purchases"], row["min_price"], row["avg_price"],
+                        row["max_price"], row["last_price"]) for row in self.milk.price_history()]
+        self.assertEqual(history, [
+            (self.corner.pk, date(2016, 1, 1), 3, Decimal("2.00"), Decimal("2.32"), Decimal("2.50"), Decimal("2.45")),
+            (self.market.pk, date(2016, 1, 1), 1, Decimal("1.90"), Decimal("1.90"), Decimal("1.90"), Decimal("1.90")),
+            (self.market.pk, date(2016, 2, 1), 1, Decimal("2.10"), Decimal("2.10"), Decimal("2.10"), Decimal("2.10")),
+        ])
+        self.assertEqual(len(Item.objects.price_history(models.functions.TruncYear)), 3)
+        group_by = ("%s" % Item.objects.price_history().query).split("GROUP BY")[1]
+        self.assertNotIn("SELECT", group_by)  # the last price subquery runs per group, not per item
+
+    def test_cheapest_supplier(self):
+        """One query answers every product; products not bought recently have no cheapest supplier"""
+        Item.objects.create(receipt=Receipt.objects.create(supplier=self.corner, date=date.today()),
+                            product=self.bread, unit_price="3.10")
+        with self.assertNumQueries(1):
+            cheapest = [(product.name, product.cheapest_price, product.cheapest_supplier_name)
+                        for product in Product.objects.with_cheapest_supplier(days=30)]
+        self.assertEqual(cheapest, [("Bread", Decimal("3.10"), "Corner"), ("Milk", None, None)])
+        self.assertEqual(Product.objects.with_cheapest_supplier(days=100000).get(pk=self.milk.pk).cheapest_supplier_id,
+                         self.market.pk)
+
+
+class PaymentMethodTest(TestCase):
+    def setUp(self):
+        card = PaymentMethodType.objects.create(name="Card")
+        PaymentMethod.objects.create(bank="Test Bank", last4="1234", type=card)
+        PaymentMethod.objects.create(bank="Card", type=card)
+
+    def test_representation(self):
+        """Payment method strings name the type unless the bank already says it, reading it once"""
+        methods = PaymentMethod.objects.select_related("type")
+        with self.assertNumQueries(1):
+            self.assertEqual(["%s" % method for method in methods], ["Card", "Test Bank x1234 (Card)"])
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.supplier = Supplier.objects.create(name="Test Supplier")
+        receipt = Receipt.objects.create(supplier=self.supplier)
+        for (name, code, purchases) in (("Milk 2%", "0001", 1),
+                                        ("Chocolate Milk", "0002", 3),
+                                        ("Mint Tea", "milk", 0),
+                                        ("Crème Brûlée", None, 0),
+                                        ("Supercalifragilistic Soap", None, 0)):
+            product = Product.objects.create(name=name, code=code)
+            for i in range(purchases):
+                Item.objects.create(receipt=receipt, product=product, unit_price=1)
+
+    def search(self, q, model=Product):
+        return [result.name for result in model.objects.search(q)]
+
+    def test_normalize_search(self):
+        self.assertEqual(utils.normalize_search("  Crème Brûlée, 2-pack "), "creme brulee 2 pack")
+        self.assertEqual(utils.search_prefixes("Big Mac"), {"b", "bi", "big", "m", "ma", "mac"})
+
+    def test_word_prefixes(self):
+        """Every query word has to start a word of the name; accents and case are ignored"""
+        self.assertEqual(set(self.search("mi")), {"Milk 2%", "Chocolate Milk", "Mint Tea"})
+        self.assertEqual(self.search("choc MI"), ["Chocolate Milk"])
+        self.assertEqual(self.search("creme"), ["Crème Brûlée"])
+        self.assertEqual(self.search("ilk"), [])
+        self.assertEqual(self.search("supercalifragilistic"), ["Supercalifragilistic Soap"])
+        self.assertEqual(self.search("supercalifragilistix"), [])
+        self.assertEqual(self.search("%, -!"), [])
+
+    def test_ranking(self):
+        """Exact codes rank first, then name prefixes, then the most purchased"""
+        self.assertEqual(self.search("milk"), ["Mint Tea", "Milk 2%", "Chocolate Milk"])
+        self.assertEqual(self.search("0002"), ["Chocolate Milk"])
+        self.assertEqual(Product.objects.get(name="Chocolate Milk").purchase_count, 3)
+
+    def test_purchase_counts(self):
+        """Purchase counts follow items that are moved or deleted"""
+        item = Item.objects.filter(product__name="Chocolate Milk").first()
+        item.product = Product.objects.get(name="Mint Tea")
+        item.save()
+        Item.objects.filter(product__name="Milk 2%").delete()
+        self.assertEqual(dict(Product.objects.values_list("name", "purchase_count")),
+                         {"Milk 2%": 0, "Chocolate Milk": 2, "Mint Tea": 1, "Crème Brûlée": 0,
+                          "Supercalifragilistic Soap": 0})
+
+    def test_renamed(self):
+        """Renaming reindexes the name"""
+        product = Product.objects.get(name="Mint Tea")
+        product.name = "Green Tea"
+        product.save()
+        self.assertEqual(self.search("gr"), ["Green Tea"])
+        self.assertEqual(self.search("mint"), [])
+
+    def test_supplier_search(self):
+        self.assertEqual(self.search("test sup", Supplier), ["Test Supplier"])
+
+    def test_rebuild_command(self):
+        """The rebuild command indexes rows written without the save hooks"""
+        Product.objects.filter(name="Mint Tea").update(name="Black Tea", search_name="")
+        call_command("rebuild_search_index", chunk_size=2, stdout=StringIO())
+        self.assertEqual(self.search("black"), ["Black Tea"])
+        self.assertEqual(self.search("mint"), [])
+
+
+class AutocompleteCacheTest(TestCase):
+    def setUp(self):
+        autocomplete_cache.clear("product", "supplier")
+        self.user = User.objects.create(username="test")
+        self.product = Product.objects.create(name="Milk")
+        self.product.types.add(ProductType.objects.create(name="Dairy"))
+        Supplier.objects.create(name="Mini Mart")
+
+    def get(self, view=ProductAutocompleteView, **params):
+        request = RequestFactory().get("/", params)
+        request.user = self.user
+        return view.as_view()(request).content.decode("utf-8")
+
+    def test_cached(self):
+        """A repeated query is answered without touching the database"""
+        content = self.get(q="mi")
+        self.assertIn("Milk", content)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get(q=" mi "), content)
+
+    def test_invalidated(self):
+        """Saving a product, its types or a product type renders the results again"""
+        self.get(q="mi")
+        self.product.name = "Mild"
+        self.product.save()
+        self.assertIn("Mild", self.get(q="mi"))
+        ProductType.objects.update(name="Cheese")  # not seen without a save hook
+        self.assertNotIn("Cheese", self.get(q="mi"))
+        ProductType.objects.get().save()
+        self.assertIn("Cheese", self.get(q="mi"))
+        self.product.types.clear()
+        self.assertNotIn("Cheese", self.get(q="mi"))
+
+    def test_groups(self):
+        """Product changes leave cached supplier results in place"""
+        self.get(SupplierAutocompleteView, q="mi")
+        self.product.save()
+        with self.assertNumQueries(0):
+            self.assertIn("Mini Mart", self.get(SupplierAutocompleteView, q="mi"))
+
+    def test_label_queries(self):
+        """Rendering a page of products costs a count, the page and the prefetched types, however many match"""
+        for i in range(20):
+            Product.objects.create(name="Milk %i" % i).types.add(ProductType.objects.get())
+        with self.assertNumQueries(3):
+            content = self.get(q="milk")
+        self.assertEqual(content.count("Dairy"), ProductAutocompleteView.paginate_by)
+
+    @override_settings(MIZER_AUTOCOMPLETE_CACHE_SIZE=1)
+    def test_lru(self):
+        """Only the most recently used entries stay in process memory"""
+        self.get(q="m")
+        self.get(q="mi")
+        self.assertEqual(len(autocomplete_cache.recent), 1)
+        self.assertIn(autocomplete_cache.key("product", "mi", 1), autocomplete_cache.recent)
+
 
 class ReceiptTest(TestCase):
     supplier_name = "Test Supplier"
@@ -295,6 +662,999 @@ class ReceiptTest(TestCase):
         self.assertRegexpMatches("%s" % receipt, r"\b%d\b" % receipt.subtotal)
 
 
+class ReceiptTotalsTest(TestCase):
+    supplier_name = "Test Supplier"
+    product_name = "Test Product"
+    receipt_count = 3
+
+    def setUp(self):
+        supplier = Supplier.objects.create(name=self.supplier_name)
+        product = Product.objects.create(name=self.product_name)
+        tax = Tax.objects.create(name="Test Tax")
+        method = PaymentMethod.objects.create(bank="Test Bank",
+                                              type=PaymentMethodType.objects.create(name="Card"))
+        for i in range(self.receipt_count):
+            receipt = Receipt.objects.create(supplier=supplier, date=date(2016, 1, i + 1))
+            Item.objects.create(receipt=receipt, product=product, quantity=Decimal("1.333"), unit_price=Decimal("2.99"))
+            Item.objects.create(receipt=receipt, product=product, quantity=2, unit_price=Decimal("1.25"))
+            Fee.objects.create(receipt=receipt, name="Bag", amount=Decimal("0.10"))
+            Discount.objects.create(receipt=receipt, name="Coupon", amount=Decimal("0.50"))
+            TaxCharge.objects.create(receipt=receipt, tax=tax, amount=Decimal("0.42"))
+            Gratuity.objects.create(receipt=receipt, amount=Decimal("1.00"))
+            if i:
+                Payment.objects.create(receipt=receipt, payment_method=method, amount=Decimal("10.00") * i)
+
+    def test_annotations_match_properties(self):
+        """Annotated totals equal the totals computed component by component"""
+        for annotated in Receipt.objects.with_totals():
+            receipt = Receipt.objects.get(pk=annotated.pk)
+            self.assertEqual(annotated.subtotal, receipt.subtotal)
+            self.assertEqual(annotated.fee, receipt.fee)
+            self.assertEqual(annotated.discount, receipt.discount)
+            self.assertEqual(annotated.tax, receipt.tax)
+            self.assertEqual(annotated.tip, receipt.tip)
+            self.assertEqual(annotated.total, receipt.total)
+            self.assertEqual(annotated.paid, receipt.paid)
+            self.assertEqual(annotated.status(), receipt.status())
+
+    def test_single_query(self):
+        """Listing annotated receipts and all their totals costs one query"""
+        with self.assertNumQueries(1):
+            for receipt in Receipt.objects.with_totals():
+                receipt.total
+                receipt.status()
+
+    def test_empty_receipt(self):
+        """A receipt without components has zero totals and no payment"""
+        Receipt.objects.create(supplier=Supplier.objects.first())
+        receipt = Receipt.objects.with_totals().get(items=None)
+        self.assertEqual(receipt.total, 0)
+        self.assertIsNone(receipt.paid)
+        self.assertEqual(receipt.status(), "")
+
+
+class ReceiptTotalsCacheTest(TestCase):
+    def setUp(self):
+        self.supplier = Supplier.objects.create(name="Test Supplier")
+        self.product = Product.objects.create(name="Test Product")
+        self.receipt = Receipt.objects.create(supplier=self.supplier)
+        self.other = Receipt.objects.create(supplier=self.supplier)
+
+    def assertTotalsCurrent(self):
+        for receipt in Receipt.objects.with_totals():
+            for field in Receipt.totals_cache_fields:
+                self.assertEqual(getattr(receipt, field), getattr(receipt, field.replace("_cache", "_amount")),
+                                 "%s of receipt %i" % (field, receipt.pk))
+
+    def test_component_save_and_delete(self):
+        """Saving and deleting components keeps the stored totals current"""
+        item = Item.objects.create(receipt=self.receipt, product=self.product, quantity=3, unit_price=Decimal("1.10"))
+        self.assertEqual(self.receipt.subtotal_cache, Decimal("3.30"))
+        Discount.objects.create(receipt=self.receipt, name="Coupon", amount=Decimal("0.30"))
+        self.assertEqual(Receipt.objects.get(pk=self.receipt.pk).total_cache, Decimal("3.00"))
+        item.unit_price = Decimal("2.00")
+        item.save()
+        self.assertTotalsCurrent()
+        item.delete()
+        self.assertEqual(Receipt.objects.get(pk=self.receipt.pk).subtotal_cache, 0)
+        self.assertTotalsCurrent()
+
+    def test_receipt_deleted(self):
+        """Deleting a receipt doesn't refresh the totals of the receipt going away with its components"""
+        for amount in ("0.10", "0.20", "0.30"):
+            Fee.objects.create(receipt=self.receipt, name="Bag", amount=Decimal(amount))
+        with QueryRecorder() as recorder:
+            self.receipt.delete()
+        self.assertFalse([query for query in recorder.queries if query["sql"].startswith('UPDATE "mizer_receipt"')])
+        Fee.objects.create(receipt=self.other, name="Bag", amount=Decimal("0.10"))
+        self.assertEqual(Receipt.objects.get(pk=self.other.pk).fee_cache, Decimal("0.10"))
+
+    def test_failed_receipt_delete(self):
+        """A receipt whose deletion failed is no longer treated as being deleted"""
+        fee = Fee.objects.create(receipt=self.receipt, name="Bag", amount=Decimal("0.10"))
+
+        def fail(sender, **kwargs):
+            raise RuntimeError("delete failed")
+        pre_delete.connect(fail, sender=Receipt, dispatch_uid="mizer_test_fail")
+        try:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                Receipt.objects.filter(pk=self.receipt.pk).delete()
+        finally:
+            pre_delete.disconnect(sender=Receipt, dispatch_uid="mizer_test_fail")
+        fee.delete()
+        self.assertEqual(Receipt.objects.get(pk=self.receipt.pk).fee_cache, 0)
+
+    def test_component_moved(self):
+        """A component moved to another receipt refreshes both receipts"""
+        Fee.objects.create(receipt=self.receipt, name="Bag", amount=Decimal("0.10"))
+        fee = Fee.objects.get()
+        fee.receipt = self.other
+        fee.save()
+        self.assertEqual(Receipt.objects.get(pk=self.receipt.pk).fee_cache, 0)
+        self.assertEqual(Receipt.objects.get(pk=self.other.pk).fee_cache, Decimal("0.10"))
+
+    def test_bulk_operations(self):
+        """bulk_create, queryset update and queryset delete keep the stored totals current"""
+        Gratuity.objects.bulk_create([Gratuity(receipt=receipt, amount=Decimal("2.00"))
+                                      for receipt in (self.receipt, self.other, self.other)])
+        self.assertTotalsCurrent()
+        Gratuity.objects.filter(receipt=self.other).update(amount=Decimal("0.75"))
+        self.assertTotalsCurrent()
+        Gratuity.objects.filter(receipt=self.receipt).update(receipt=self.other)
+        self.assertTotalsCurrent()
+        Gratuity.objects.all().delete()
+        self.assertEqual(Receipt.objects.get(pk=self.other.pk).tip_cache, 0)
+        self.assertTotalsCurrent()
+
+    def test_deferred_refresh(self):
+        """Components saved inside defer_totals() refresh each receipt once, on exit"""
+        # 10 inserts and their 10 rollup contributions, then once: purchase count update, totals update,
+        # in-memory receipt reload, supplier statistics update, rollup update and rollup insert
+        with self.assertNumQueries(26):
+            with defer_totals():
+                for i in range(10):
+                    Item.objects.create(receipt=self.receipt, product=self.product, unit_price=1)
+        self.assertEqual(self.receipt.subtotal, 10)
+        self.assertTotalsCurrent()
+
+    def test_receipt_save_keeps_totals(self):
+        """Saving a receipt instance with stale totals does not overwrite the stored totals"""
+        receipt = Receipt.objects.get(pk=self.receipt.pk)
+        Item.objects.create(receipt=self.receipt, product=self.product, unit_price=5)
+        receipt.save()
+        self.assertEqual(Receipt.objects.get(pk=self.receipt.pk).subtotal_cache, 5)
+
+    def test_totals_are_filterable(self):
+        Payment.objects.create(receipt=self.receipt, amount=Decimal("4.00"),
+                               payment_method=PaymentMethod.objects.create(
+                                   bank="Test Bank", type=PaymentMethodType.objects.create(name="Card")))
+        Item.objects.create(receipt=self.receipt, product=self.product, unit_price=5)
+        self.assertEqual(list(Receipt.objects.filter(total_cache__gt=1)), [self.receipt])
+        self.assertEqual(list(Receipt.objects.filter(paid_cache__lt=models.F("total_cache"))), [self.receipt])
+
+    def test_rebuild_command(self):
+        """The rebuild command finds and repairs stale totals in chunks"""
+        for receipt in (self.receipt, self.other):
+            Item.objects.create(receipt=receipt, product=self.product, unit_price=Decimal("3.00"))
+        Receipt.objects.update(subtotal_cache=0, total_cache=0)
+        group = "year:%i" % self.receipt.date.year
+        out = StringIO()
+        call_command("rebuild_receipt_totals", verify_only=True, chunk_size=1, stdout=out)
+        self.assertIn("found 2 with stale totals", out.getvalue())
+        version = page_cache.version(group)
+        call_command("rebuild_receipt_totals", chunk_size=1, stdout=out)
+        self.assertTotalsCurrent()
+        self.assertNotEqual(page_cache.version(group), version)  # pages showing the stale totals are dropped
+        out = StringIO()
+        call_command("rebuild_receipt_totals", verify_only=True, stdout=out)
+        self.assertIn("found 0 with stale totals", out.getvalue())
+
+
+class SpendingRollupTest(TestCase):
+    def setUp(self):
+        self.supplier = Supplier.objects.create(name="Test Supplier")
+        self.food = ProductType.objects.create(name="Food")
+        self.drink = ProductType.objects.create(name="Drink")
+        self.apple = Product.objects.create(name="Apple")
+        self.apple.types.add(self.food)
+        self.soda = Product.objects.create(name="Soda")
+        self.soda.types.add(self.drink, self.food)
+        self.receipt = Receipt.objects.create(supplier=self.supplier, date=date(2016, 3, 5))
+        Item.objects.create(receipt=self.receipt, product=self.apple, quantity=3, unit_price=Decimal("0.50"))
+        Item.objects.create(receipt=self.receipt, product=self.soda, unit_price=Decimal("1.99"))
+        Fee.objects.create(receipt=self.receipt, name="Bag", amount=Decimal("0.10"))
+        TaxCharge.objects.create(receipt=self.receipt, tax=Tax.objects.create(name="Test Tax"), amount=Decimal("0.20"))
+
+    def assertRollupCurrent(self):
+        """The incrementally maintained rollup equals one summed from scratch"""
+        stored = {}
+        for rollup in SpendingRollup.objects.all():
+            sums = dict((column, getattr(rollup, column)) for column in SpendingRollup.columns
+                        if getattr(rollup, column))
+            if sums:
+                stored[(rollup.year, rollup.month, rollup.supplier_id, rollup.product_type_id)] = sums
+        expected = {}
+        for (key, sums) in SpendingRollup.objects.receipt_contributions(Receipt.objects.all()).items():
+            sums = dict((column, amount) for (column, amount) in sums.items() if amount)
+            if sums:
+                expected[key] = sums
+        self.assertEqual(stored, expected)
+
+    def test_component_changes(self):
+        """Purchases roll up under the primary product type, other components under none"""
+        self.assertEqual(SpendingRollup.objects.get(product_type=self.food).purchases, Decimal("3.49"))
+        self.assertEqual(SpendingRollup.objects.get(product_type=None).fees, Decimal("0.10"))
+        item = Item.objects.get(product=self.apple)
+        item.quantity = 1
+        item.save()
+        Gratuity.objects.create(receipt=self.receipt, amount=Decimal("3.00"))
+        Fee.objects.all().delete()
+        self.assertRollupCurrent()
+        self.assertEqual(SpendingRollup.objects.get(product_type=None).tips, Decimal("3.00"))
+
+    def test_receipt_moved(self):
+        """Changing the month or supplier of a receipt moves its whole contribution"""
+        self.receipt.date = date(2016, 4, 1)
+        self.receipt.save()
+        self.receipt.supplier = Supplier.objects.create(name="Other Supplier")
+        self.receipt.save()
+        self.assertRollupCurrent()
+        self.assertFalse(SpendingRollup.objects.filter(month=3).exclude(purchases=0).exists())
+
+    def test_product_types_changed(self):
+        """Purchases follow a product whose primary type changes"""
+        self.apple.types.add(self.drink)
+        self.assertRollupCurrent()
+        self.soda.types.clear()
+        self.assertRollupCurrent()
+        self.drink.delete()
+        self.assertRollupCurrent()
+
+    def test_receipt_deleted(self):
+        """Deleting a receipt subtracts all of its components"""
+        Receipt.objects.all().delete()
+        for rollup in SpendingRollup.objects.all():
+            self.assertEqual([getattr(rollup, column) for column in SpendingRollup.columns], [0] * 5)
+
+    def test_supplier_deleted(self):
+        """Deleting a supplier with receipts leaves no rollup rows behind for it"""
+        other = Supplier.objects.create(name="Other Supplier")
+        Fee.objects.create(receipt=Receipt.objects.create(supplier=other, date=date(2016, 3, 1)), name="Bag",
+                           amount=Decimal("0.10"))
+        self.supplier.delete()
+        self.assertEqual(list(SpendingRollup.objects.values_list("supplier", "fees")), [(other.pk, Decimal("0.10"))])
+        self.assertRollupCurrent()
+
+    def test_summary(self):
+        Receipt.objects.create(supplier=self.supplier, date=date(2016, 5, 5))
+        Discount.objects.create(receipt=Receipt.objects.get(date__month=5), name="Coupon", amount=Decimal("1.00"))
+        (totals, months) = SpendingRollup.objects.filter(year=2016).summarize()
+        self.assertEqual([month["period"] for month in months], [date(2016, 3, 1), date(2016, 5, 1)])
+        self.assertEqual(months[0]["final"], self.receipt.total)
+        (expected, expected_months) = Receipt.objects.filter(date__year=2016).summarize()
+        self.assertEqual(totals, expected)
+
+    def test_backfill_command(self):
+        """The backfill command rebuilds the rollup from history"""
+        SpendingRollup.objects.update(purchases=0)
+        SpendingRollup.objects.create(year=2000, month=1, supplier=self.supplier, tips=5)
+        groups = [(cache, group % year) for year in (2000, 2016)
+                  for (cache, group) in ((report_cache, "spending:%i"), (page_cache, "year:%i"))]
+        versions = [(cache.version(group), cache, group) for (cache, group) in groups]
+        call_command("backfill_spending_rollup", chunk_size=1, stdout=StringIO())
+        self.assertRollupCurrent()
+        self.assertFalse(SpendingRollup.objects.filter(year=2000).exists())
+        for (version, cache, group) in versions:
+            self.assertNotEqual(cache.version(group), version, group)
+
+
+class SupplierStatsTest(TestCase):
+    def setUp(self):
+        autocomplete_cache.clear("supplier")
+        self.market = Supplier.objects.create(name="Market")
+        self.mart = Supplier.objects.create(name="Mini Mart")
+        self.milk = Product.objects.create(name="Milk")
+        self.bread = Product.objects.create(name="Bread")
+        self.receipt = Receipt.objects.create(supplier=self.market, date=date(2016, 3, 5))
+        Item.objects.create(receipt=self.receipt, product=self.milk, quantity=2, unit_price=Decimal("2.50"))
+        Item.objects.create(receipt=self.receipt, product=self.bread, unit_price=Decimal("3.00"))
+        receipt = Receipt.objects.create(supplier=self.market, date=date(2016, 3, 9))
+        Item.objects.create(receipt=receipt, product=self.milk, unit_price=Decimal("2.00"))
+
+    def test_maintained(self):
+        """Adding, changing, moving and deleting receipts keeps the statistics current"""
+        stats = SupplierStats.objects.get(supplier=self.market)
+        self.assertEqual((stats.visits, stats.spend, stats.last_visit, stats.top_product),
+                         (2, Decimal("10.00"), date(2016, 3, 9), self.milk))
+        self.assertEqual(stats.average_basket, Money(500))
+        self.receipt.supplier = self.mart
+        self.receipt.date = date(2016, 4, 1)
+        self.receipt.save()
+        self.assertEqual(SupplierStats.objects.get(supplier=self.market).visits, 1)
+        stats = SupplierStats.objects.get(supplier=self.mart)
+        self.assertEqual((stats.visits, stats.spend, stats.last_visit), (1, Decimal("8.00"), date(2016, 4, 1)))
+        self.receipt.delete()
+        stats = SupplierStats.objects.get(supplier=self.mart)
+        self.assertEqual((stats.visits, stats.spend, stats.last_visit, stats.top_product), (0, 0, None, None))
+        self.assertIsNone(stats.average_basket)
+
+    def assertStatsCurrent(self):
+        """The incrementally maintained statistics equal ones recomputed from scratch"""
+        fields = ("supplier", "visits", "spend", "last_visit", "top_product")
+        stored = list(SupplierStats.objects.order_by("supplier").values_list(*fields))
+        SupplierStats.objects.all().refresh()
+        self.assertEqual(stored, list(SupplierStats.objects.order_by("supplier").values_list(*fields)))
+
+    def test_top_product_deleted(self):
+        """Deleting the top product hands its place to the next one"""
+        self.milk.delete()
+        self.assertEqual(SupplierStats.objects.get(supplier=self.market).top_product, self.bread)
+        self.assertStatsCurrent()
+
+    def test_incremental(self):
+        """Changes add to the statistics and recount only what they could change"""
+        version = autocomplete_cache.version("supplier")
+        item = Item.objects.get(product=self.bread)
+        item.unit_price = Decimal("4.00")
+        with QueryRecorder() as recorder:
+            item.save()
+        [update] = [query["sql"] for query in recorder.queries
+                    if query["sql"].startswith('UPDATE "mizer_supplierstats"')]
+        self.assertNotIn("SELECT", update)  # neither receipts nor items recounted
+        self.assertEqual(autocomplete_cache.version("supplier"), version)  # the labels show no spending
+        self.assertStatsCurrent()
+        for i in range(2):  # bread ties with milk, then overtakes it
+            Item.objects.create(receipt=self.receipt, product=self.bread, unit_price=Decimal("1.00"))
+            self.assertStatsCurrent()
+        self.assertEqual(SupplierStats.objects.get(supplier=self.market).top_product, self.bread)
+        Item.objects.filter(product=self.bread).update(product=self.milk)
+        self.assertStatsCurrent()
+        Receipt.objects.create(supplier=self.market, date=date(2016, 3, 1))  # an earlier visit
+        self.assertNotEqual(autocomplete_cache.version("supplier"), version)
+        self.assertStatsCurrent()
+        receipt = Receipt.objects.get(date=date(2016, 3, 9))
+        receipt.date = date(2016, 3, 2)
+        receipt.save()
+        self.assertEqual(SupplierStats.objects.get(supplier=self.market).last_visit, date(2016, 3, 5))
+        Item.objects.filter(receipt=self.receipt).update(receipt=Receipt.objects.create(supplier=self.mart))
+        self.assertStatsCurrent()
+
+    def test_imported(self):
+        """Bulk imported receipts create the statistics of their suppliers"""
+        ImportReceiptsTest.import_file("\n".join(json.dumps(receipt) for receipt in ImportReceiptsTest.receipts),
+                                       ".jsonl")
+        stats = Supplier.objects.get(name="Corner Store").stats
+        self.assertEqual((stats.visits, stats.spend, stats.last_visit), (2, Decimal("11.52"), date(2016, 2, 3)))
+
+    def test_rebuild_command(self):
+        SupplierStats.objects.all().delete()
+        call_command("rebuild_supplier_stats", chunk_size=1, stdout=StringIO())
+        self.assertEqual(dict(SupplierStats.objects.values_list("supplier__name", "visits")),
+                         {"Market": 2, "Mini Mart": 0})
+
+    def test_autocomplete(self):
+        """Frequently visited suppliers are listed first, with their visits in the label"""
+        request = RequestFactory().get("/", {"q": "m"})
+        request.user = User.objects.create(username="test")
+        results = json.loads(SupplierAutocompleteView.as_view()(request).content.decode("utf-8"))["results"]
+        self.assertEqual([result["id"] for result in results], ["%s" % self.market.pk, "%s" % self.mart.pk])
+        self.assertIn("2 visits, last 2016-03-09", results[0]["text"])
+        self.assertIn("0 visits", results[1]["text"])
+        self.assertEqual(list(Supplier.objects.frequent_first()), [self.market, self.mart])
+
+    def test_admin(self):
+        """Rendering the statistics columns of a page costs one query regardless of row count"""
+        admin = SupplierAdmin(Supplier, site)
+        with self.assertNumQueries(1):
+            rows = [[getattr(supplier, column)() for column in admin.list_display[1:]]
+                    for supplier in Supplier.objects.select_related(*admin.list_select_related)]
+        self.assertEqual(rows, [[2, "$10.00", "$5.00", date(2016, 3, 9), self.milk],
+                                [0, "$0.00", "", None, None]])
+        self.assertEqual(admin.top_products_list(self.market), "Milk (2), Bread (1)")
+
+
+class SpendingPivotTest(TestCase):
+    def setUp(self):
+        report_cache.clear("spending:2016")
+        (dairy, drinks, bakery) = [ProductType.objects.create(name=name) for name in ("Dairy", "Drinks", "Bakery")]
+        self.milk = Product.objects.create(name="Milk")
+        self.milk.types.add(dairy, drinks)
+        bread = Product.objects.create(name="Bread")
+        bread.types.add(bakery)
+        soap = Product.objects.create(name="Soap")
+        supplier = Supplier.objects.create(name="Store")
+        for (day, product, price) in ((date(2016, 1, 4), self.milk, "3.01"), (date(2016, 1, 10), bread, "2.00"),
+                                      (date(2016, 2, 1), bread, "2.50"), (date(2016, 4, 1), soap, "1.00")):
+            Item.objects.create(receipt=Receipt.objects.create(supplier=supplier, date=day), product=product,
+                                unit_price=Decimal(price))
+
+    def spend(self, period="month", allocation="full", start=date(2016, 1, 1), end=date(2016, 12, 31)):
+        report = SpendingPivot(period, allocation).build(start, end)
+        return dict((row["name"], dict(zip(report["periods"], row["spend"]))) for row in report["rows"])
+
+    def test_allocations(self):
+        """Products of several types count in full, split evenly or towards their primary type only"""
+        january = date(2016, 1, 1)
+        full = self.spend()
+        self.assertEqual((full["Dairy"][january], full["Drinks"][january], full["Bakery"][january]),
+                         (Decimal("3.01"), Decimal("3.01"), Decimal("2.00")))
+        self.assertEqual(full["No product type"][date(2016, 4, 1)], Decimal("1.00"))
+        split = self.spend(allocation="split")
+        self.assertEqual((split["Dairy"][january], split["Drinks"][january]), (Decimal("1.51"), Decimal("1.51")))
+        primary = self.spend(allocation="primary")
+        self.assertEqual(primary["Dairy"][january], Decimal("3.01"))
+        self.assertNotIn("Drinks", primary)
+        with self.assertRaises(ValueError):
+            SpendingPivot(allocation="evenly")
+
+    def test_periods(self):
+        """Weeks and quarters are folded from days and months; partial ranges cut at the grain"""
+        self.assertEqual(self.spend("quarter")["Bakery"], {date(2016, 1, 1): Decimal("4.50"), date(2016, 4, 1): 0})
+        self.assertEqual(self.spend("week", start=date(2016, 1, 5), end=date(2016, 2, 1))["Bakery"],
+                         {date(2016, 1, 4): Decimal("2.00"), date(2016, 2, 1): Decimal("2.50")})
+        self.assertEqual(SpendingPivot("year").build(date(2016, 6, 1), date(2016, 6, 2))["totals"],
+                         [Decimal("11.52")])  # milk counts towards both of its types
+
+    def test_cached(self):
+        """A year is computed once until an item or product type of that year changes"""
+        self.spend()
+        with self.assertNumQueries(1):  # product type names only
+            self.spend()
+        Item.objects.create(receipt=Receipt.objects.get(date=date(2016, 1, 4)), product=self.milk, unit_price=1)
+        self.assertEqual(self.spend()["Drinks"][date(2016, 1, 1)], Decimal("4.01"))
+        self.milk.types.add(ProductType.objects.create(name="Breakfast"))
+        self.assertEqual(self.spend()["Breakfast"][date(2016, 1, 1)], Decimal("4.01"))
+
+    def test_view(self):
+        request = RequestFactory().get("/report/types", {"start": "2016-01-01", "end": "2016-12-31",
+                                                         "period": "quarter"})
+        request.user = User.objects.create_user("user")
+        report = json.loads(SpendingPivotView.as_view()(request).content.decode("utf-8"))
+        self.assertEqual(report["periods"], ["2016-01-01", "2016-04-01"])
+        self.assertEqual(report["totals"], ["10.52", "1.00"])
+
+
+class ComparisonTest(TestCase):
+    def setUp(self):
+        supplier = Supplier.objects.create(name="Test Supplier")
+        product = Product.objects.create(name="Test Product")
+        for (day, price) in ((date(2015, 3, 1), "10.00"), (date(2016, 2, 29), "4.00"), (date(2016, 3, 1), "2.00"),
+                             (date(2016, 12, 31), "1.00"), (date(2017, 1, 1), "8.00")):
+            receipt = Receipt.objects.create(supplier=supplier, date=day)
+            Item.objects.create(receipt=receipt, product=product, unit_price=Decimal(price))
+            TaxCharge.objects.create(receipt=receipt, tax=Tax.objects.get_or_create(name="Tax")[0],
+                                     amount=Decimal("0.50"))
+
+    def test_compare(self):
+        """Every range is summed by one query, each with its change from the one before"""
+        with self.assertNumQueries(1):
+            periods = compare_periods(same_period_years(date(2016, 1, 1), date(2016, 12, 31), 3))
+        self.assertEqual([(period["start"], period["receipts"], period["purchases"], period["final"])
+                          for period in periods],
+                         [(date(2014, 1, 1), 0, 0, 0), (date(2015, 1, 1), 1, Money(1000), Money(1050)),
+                          (date(2016, 1, 1), 3, Money(700), Money(850))])
+        self.assertNotIn("change", periods[0])
+        self.assertEqual(periods[1]["percent"]["final"], None)
+        self.assertEqual((periods[2]["change"]["final"], periods[2]["change"]["receipts"],
+                          periods[2]["percent"]["purchases"]), (Money(-200), 2, -30.0))
+        overlapping = Receipt.objects.compare([(date(2016, 1, 1), date(2017, 1, 1)),
+                                               (date(2016, 3, 1), date(2016, 3, 1))])
+        self.assertEqual([period["taxes"] for period in overlapping], [Money(200), Money(50)])
+
+    def test_same_period_years(self):
+        self.assertEqual(same_period_years(date(2016, 2, 1), date(2016, 2, 29), 2),
+                         [(date(2015, 2, 1), date(2015, 2, 28)), (date(2016, 2, 1), date(2016, 2, 29))])
+
+    def test_view(self):
+        request = RequestFactory().get("/", {"ranges": "2016-03-01:2016-03-31,2017-01-01:2017-01-31"})
+        request.user = User.objects.create(username="test")
+        periods = json.loads(ComparisonView.as_view()(request).content.decode("utf-8"))["periods"]
+        self.assertEqual([(period["start"], period["final"]) for period in periods],
+                         [("2016-03-01", "2.50"), ("2017-01-01", "8.50")])
+        self.assertEqual(periods[1]["change"], {"purchases": "6.00", "fees": "0.00", "discounts": "0.00",
+                                                "taxes": "0.00", "tips": "0.00", "final": "6.00", "paid": "0.00",
+                                                "receipts": 0})
+        for params in ({"ranges": "2016-01-01"}, {"years": "100"}, {"years": "0"}):
+            request = RequestFactory().get("/", params)
+            request.user = User.objects.get()
+            self.assertEqual(ComparisonView.as_view()(request).status_code, 400)
+
+
+class ImportReceiptsTest(TestCase):
+    receipts = [
+        {"supplier": {"name": "Corner Store", "city": "Springfield", "state": "ST"},
+         "date": "2016-02-01", "time": "08:15",
+         "items": [{"product": {"name": "Milk", "code": "0001", "types": ["Dairy"]},
+                    "quantity": "2", "unit_price": "2.49"},
+                   {"product": "Bread", "unit_price": "3.00"}],
+         "fees": [{"name": "Bag", "quantity": 2, "amount": "0.05"}],
+         "discounts": [{"name": "Coupon", "amount": "0.50"}],
+         "taxes": [{"tax": "Sales Tax", "amount": "0.40"}],
+         "gratuities": [{"to": "Cashier", "amount": "1.00"}],
+         "payments": [{"payment_method": {"bank": "Test Bank", "last4": "1234", "type": "Card"},
+                       "amount": "8.93"}]},
+        {"supplier": {"name": "Corner Store", "city": "Springfield", "state": "ST"},
+         "date": "2016-02-03",
+         "items": [{"product": {"name": "Whole Milk", "code": "0001"}, "quantity": "1", "unit_price": "2.59"}]},
+    ]
+
+    @staticmethod
+    def import_file(content, suffix, **options):
+        with NamedTemporaryFile("w", suffix=suffix) as stream:
+            stream.write(content)
+            stream.flush()
+            out = StringIO()
+            call_command("import_receipts", stream.name, stdout=out, **options)
+        return out.getvalue()
+
+    def test_jsonl(self):
+        """Receipts, components and missing related rows are written; existing rows are reused"""
+        Product.objects.create(name="Bread")
+        out = self.import_file("\n".join(json.dumps(receipt) for receipt in self.receipts), ".jsonl", chunk_size=1)
+        self.assertIn("Imported 2 receipts, 10 rows", out)
+        self.assertEqual(Supplier.objects.count(), 1)
+        self.assertEqual(Product.objects.count(), 2)  # matched by code, then by name
+        receipt = Receipt.objects.get(date=date(2016, 2, 1))
+        self.assertEqual(receipt.time, time(8, 15))
+        self.assertEqual(receipt.total, Decimal("8.93"))
+        self.assertEqual(receipt.status(), "Paid")
+        self.assertEqual(Product.objects.get(code="0001").type_names(), "Dairy")
+        self.assertEqual(Product.objects.get(code="0001").purchase_count, 2)
+        self.assertEqual(SpendingRollup.objects.get(product_type__name="Dairy").purchases, Decimal("7.57"))
+
+    def test_csv(self):
+        content = "\n".join([
+            "receipt,date,time,supplier,city,state,kind,name,code,category,quantity,amount",
+            "1,2016-02-01,08:15,Corner Store,Springfield,ST,item,Milk,0001,Dairy|Drinks,2,2.49",
+            "1,,,,,,fee,Bag,,,2,0.05",
+            "1,,,,,,payment,Test Bank,1234,Card,,5.03",
+            "2,2016-02-03,,Corner Store,Springfield,ST,item,Milk,0001,,1,2.49",
+        ])
+        self.assertIn("Imported 2 receipts, 6 rows", self.import_file(content, ".csv"))
+        self.assertEqual(Receipt.objects.get(date=date(2016, 2, 1)).status(), "Paid")
+        self.assertEqual(Product.objects.get().type_names(), "Dairy, Drinks")
+
+    def test_invalid(self):
+        """An invalid receipt rolls back its own chunk only and reports its line"""
+        receipts = self.receipts + [dict(self.receipts[1], date="2016-02-30")]
+        with self.assertRaisesRegexp(CommandError, "line 3: invalid date"):
+            self.import_file("\n".join(json.dumps(receipt) for receipt in receipts), ".jsonl", chunk_size=2)
+        self.assertEqual(Receipt.objects.count(), 2)
+
+
+class ReceiptBulkViewTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="test", is_superuser=True)
+
+    def post(self, body, user=None):
+        request = RequestFactory().post("/", body if isinstance(body, str) else json.dumps(body),
+                                        content_type="application/json")
+        request.user = user or self.user
+        response = ReceiptBulkView.as_view()(request)
+        return (response.status_code, json.loads(response.content.decode("utf-8")))
+
+    def test_created(self):
+        """Every posted receipt is written with its components and answered with its totals"""
+        (status, content) = self.post({"receipts": ImportReceiptsTest.receipts})
+        self.assertEqual(status, 201)
+        self.assertEqual(content["rows"], 10)
+        self.assertEqual([receipt["id"] for receipt in content["receipts"]],
+                         list(Receipt.objects.order_by("pk").values_list("pk", flat=True)))
+        first = content["receipts"][0]
+        self.assertEqual((first["subtotal"], first["total"], first["paid"], first["status"]),
+                         ("7.98", "8.93", "8.93", "Paid"))
+        self.assertEqual(self.post(ImportReceiptsTest.receipts[1])[1]["receipts"][0]["total"], "2.59")
+
+    def test_batched_queries(self):
+        """Once its related rows exist, a batch costs the same queries however many receipts it holds, but for
+        the receipt inserts of databases that cannot bulk insert them"""
+        self.post(ImportReceiptsTest.receipts)
+        with QueryRecorder() as small:
+            self.post(ImportReceiptsTest.receipts)
+        with QueryRecorder() as large:
+            self.post(ImportReceiptsTest.receipts * 10)
+        inserts = 0 if connection.features.can_return_ids_from_bulk_insert else 18
+        self.assertEqual(large.count, small.count + inserts)
+
+    def test_invalid(self):
+        """Nothing is written when a receipt is invalid"""
+        (status, content) = self.post([ImportReceiptsTest.receipts[0], {"supplier": "Corner Store"}])
+        self.assertEqual((status, content), (400, {"error": "invalid date: None", "index": 1}))
+        self.assertEqual(self.post("{")[0], 400)
+        self.assertEqual(self.post([])[0], 400)
+        with override_settings(MIZER_BULK_RECEIPTS_LIMIT=1):
+            self.assertEqual(self.post(ImportReceiptsTest.receipts)[0], 400)
+        self.assertEqual(Receipt.objects.count(), 0)
+        with self.assertRaises(PermissionDenied):
+            self.post(ImportReceiptsTest.receipts, User.objects.create(username="other"))
+
+    def test_malformed(self):
+        """Well formed JSON of the wrong shape or with values that do not fit the columns is rejected"""
+        item = {"product": "Milk", "unit_price": "2.50"}
+        for (change, error) in ((dict(items=["x"]), "invalid items: ['x']"),
+                                (dict(items="abc"), "invalid items: 'abc'"),
+                                (dict(gratuities=["5"]), "invalid gratuities: ['5']"),
+                                (dict(date=20200101), "invalid date: 20200101"),
+                                (dict(items=[dict(item, unit_price="123456789012")]),
+                                 "invalid unit_price: '123456789012'"),
+                                (dict(items=[dict(item, unit_price="NaN")]), "invalid unit_price: 'NaN'"),
+                                (dict(items=[dict(item, product={"name": "Milk", "types": "Dairy"})]),
+                                 "invalid types: 'Dairy'"),
+                                (dict(supplier="x" * 300), "invalid name: '%s'" % ("x" * 300)),
+                                (dict(fees=[{"name": "Bag", "amount": "0.10", "quantity": "9" * 30}]),
+                                 "invalid quantity: '%s'" % ("9" * 30)),
+                                (dict(fees=[{"name": "Bag", "amount": "0.10", "quantity": 0}]),
+                                 "invalid quantity: 0")):
+            receipt = dict({"supplier": "Corner Store", "date": "2016-01-02", "items": [item]}, **change)
+            self.assertEqual(self.post([receipt]), (400, {"error": error, "index": 0}))
+        self.assertFalse(Receipt.objects.exists())
+        self.assertFalse(ProductType.objects.exists())
+
+
+class ExportReceiptsTest(TestCase):
+    def setUp(self):
+        ImportReceiptsTest.import_file(
+            "\n".join(json.dumps(receipt) for receipt in ImportReceiptsTest.receipts), ".jsonl")
+        Receipt.objects.create(date=date(2016, 3, 1), supplier=Supplier.objects.get())
+
+    def export(self, **options):
+        out = StringIO()
+        call_command("export_receipts", stdout=out, **options)
+        return out.getvalue()
+
+    def test_round_trip(self):
+        """Exported files import back into the same receipts, in both formats"""
+        for format in ("jsonl", "csv"):
+            exported = self.export(format=format)
+            totals = list(Receipt.objects.order_by("pk").values_list("date", "total_cache"))
+            Receipt.objects.all().delete()
+            ImportReceiptsTest.import_file(exported, "." + format)
+            self.assertEqual(list(Receipt.objects.order_by("pk").values_list("date", "total_cache")), totals)
+
+    def test_filters(self):
+        self.assertEqual(len(self.export(start="2016-02-02").splitlines()), 2)
+        self.assertEqual(len(self.export(end="2016-02-02").splitlines()), 1)
+        self.assertEqual(len(self.export(product_type=ProductType.objects.get().pk).splitlines()), 2)
+        self.assertEqual(len(self.export(supplier=Supplier.objects.get().pk + 1).splitlines()), 0)
+        with self.assertRaisesRegexp(CommandError, "Invalid start date"):
+            self.export(start="yesterday")
+
+    def test_queries(self):
+        """Queries depend on the number of chunks, not the number of receipts"""
+        with self.assertNumQueries(12):
+            self.export()
+        receipt = Receipt.objects.create(date=date(2016, 3, 2), supplier=Supplier.objects.get())
+        Item.objects.create(receipt=receipt, product=Product.objects.get(code="0001"), unit_price=1)
+        with self.assertNumQueries(12):
+            self.export()
+
+    def test_view(self):
+        request = RequestFactory().get("/export", {"format": "jsonl", "start": "2016-02-02"})
+        request.user = User.objects.create_user("user")
+        response = ExportView.as_view()(request)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual(len(b"".join(response.streaming_content).splitlines()), 2)
+        request = RequestFactory().get("/export", {"format": "xml"})
+        request.user = User.objects.get()
+        self.assertEqual(ExportView.as_view()(request).status_code, 400)
+
+
+class BenchmarkTest(TestCase):
+    def test_generator(self):
+        """The same seed generates the same receipts, and their payments add up to the receipt totals"""
+        self.assertEqual(list(ReceiptGenerator(seed=3).receipts(20)), list(ReceiptGenerator(seed=3).receipts(20)))
+        self.assertNotEqual(list(ReceiptGenerator(seed=3).receipts(5)), list(ReceiptGenerator(seed=4).receipts(5)))
+        sum(ReceiptGenerator(seed=3, suppliers=5, products=20).write(50, chunk_size=20))
+        self.assertEqual(Receipt.objects.count(), 50)
+        self.assertGreater(Receipt.objects.filter(payments__isnull=False).count(), 40)
+        paid = [receipt for receipt in Receipt.objects.all() if receipt.status() == "Paid"]
+        self.assertGreater(len(paid), 35)
+
+    def test_benchmark(self):
+        with NamedTemporaryFile("r", suffix=".json") as output:
+            with self.assertRaises(CommandError):
+                call_command("benchmark", sizes="10", repeat=1, output=output.name)
+            self.assertFalse(Receipt.objects.exists())
+            call_command("benchmark", sizes="10,20", write_synthetic=True, repeat=1, output=output.name)
+            report = json.load(output)
+        self.assertEqual([benchmark_round["receipts"] for benchmark_round in report["rounds"]], [10, 20])
+        self.assertEqual([result["benchmark"] for result in report["rounds"][0]["results"]], list(Benchmarks.names))
+        self.assertTrue(all(result["queries"] > 0 for result in report["rounds"][1]["results"]
+                            if not result["benchmark"].endswith("_warm")))
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        supplier = Supplier.objects.create(name="Store")
+        for day in (1, 2, 3):
+            Receipt.objects.create(supplier=supplier, date=date(2016, 1, day))
+
+    def test_full_query_log(self):
+        """Queries are counted once the connection's capped query log is full"""
+        self.addCleanup(reset_queries)
+        connection.queries_log.extend({"sql": "SELECT 1", "time": "0.000"} for i in range(connection.queries_limit))
+        with QueryRecorder() as outer:
+            with QueryRecorder() as inner:
+                Supplier.objects.count()
+        self.assertEqual((outer.count, inner.count), (1, 1))
+        self.assertIn("COUNT", connection.queries_log[-1]["sql"])
+
+    def test_duplicates(self):
+        """The same statement run per row is reported once, with its count"""
+        with QueryRecorder() as recorder:
+            for receipt in Receipt.objects.all():
+                "%s" % receipt.supplier
+        self.assertEqual(recorder.count, 4)
+        [(signature, count)] = recorder.duplicates()
+        self.assertEqual(count, 3)
+        self.assertIn('"mizer_supplier"."id" = ?', signature)
+        self.assertIn("3x", recorder.report())
+
+    def test_query_budget(self):
+        with query_budget(1):
+            list(Receipt.objects.select_related("supplier"))
+        with self.assertRaisesRegexp(AssertionError, "Query budget of 2 exceeded: 4 queries"):
+            with query_budget(2):
+                [receipt.supplier for receipt in Receipt.objects.all()]
+
+    def test_middleware(self):
+        def view(request):
+            [receipt.supplier for receipt in Receipt.objects.all()]
+            return http.HttpResponse()
+        with self.settings(MIZER_QUERY_BUDGETS={"/year": 3}), self.assertLogs("mizer.queries", "WARNING"):
+            response = QueryCountMiddleware(view)(RequestFactory().get("/year"))
+        self.assertEqual(response["X-Mizer-Queries"], "4")
+        self.assertEqual(response["X-Mizer-Duplicate-Queries"], "2")
+        self.assertEqual(response["X-Mizer-Query-Budget"], "3 exceeded")
+        response = QueryCountMiddleware(view)(RequestFactory().get("/"))
+        self.assertFalse(response.has_header("X-Mizer-Query-Budget"))
+
+
+class PaymentStatusTest(TestCase):
+    def setUp(self):
+        supplier = Supplier.objects.create(name="Store")
+        product = Product.objects.create(name="Milk")
+        method = PaymentMethod.objects.create(bank="Bank", type=PaymentMethodType.objects.create(name="Card"))
+        self.receipts = {}
+        for (status, price, paid) in (("Underpaid", "4.00", ["1.00", "2.00"]), ("Overpaid", "4.00", ["5.00"]),
+                                      ("Paid", "4.00", ["4.00"]), ("", "4.00", []), ("Refunded", "-4.00", ["-4.00"])):
+            receipt = Receipt.objects.create(supplier=supplier)
+            Item.objects.create(receipt=receipt, product=product, unit_price=Decimal(price))
+            for amount in paid:
+                Payment.objects.create(receipt=receipt, payment_method=method, amount=Decimal(amount))
+            self.receipts[status] = receipt.pk
+
+    def test_annotation_matches_status(self):
+        with self.assertNumQueries(1):
+            statuses = dict((receipt.pk, receipt.status()) for receipt in Receipt.objects.with_status())
+        self.assertEqual(statuses, dict((pk, status) for (status, pk) in self.receipts.items()))
+        self.assertEqual(statuses, dict((receipt.pk, receipt.status()) for receipt in Receipt.objects.all()))
+
+    def test_filters(self):
+        """Each status is one query on the stored balance, kept current as payments change"""
+        with self.assertNumQueries(1):
+            self.assertEqual([receipt.pk for receipt in Receipt.objects.underpaid()], [self.receipts["Underpaid"]])
+        self.assertEqual(list(Receipt.objects.overpaid().values_list("pk", flat=True)), [self.receipts["Overpaid"]])
+        self.assertEqual(Receipt.objects.payment_status("Unpaid").get().pk, self.receipts[""])
+        Payment.objects.filter(receipt=self.receipts["Underpaid"]).delete()
+        self.assertFalse(Receipt.objects.underpaid().exists())
+        self.assertIn('"balance_cache" < ', "%s" % Receipt.objects.underpaid().query)
+
+    def test_admin_filter(self):
+        admin = ReceiptAdmin(Receipt, site)
+        request = RequestFactory().get("/", {"payment_status": "Overpaid"})
+        request.user = User(is_superuser=True, is_staff=True, is_active=True)
+        changelist = admin.changelist_view(request).context_data["cl"]
+        self.assertEqual([receipt.pk for receipt in changelist.result_list], [self.receipts["Overpaid"]])
+
+
+class StatementReconcilerTest(TestCase):
+    def setUp(self):
+        self.card = PaymentMethod.objects.create(bank="Test Bank", last4="1234",
+                                                 type=PaymentMethodType.objects.create(name="Card"))
+        self.payments = {}
+        for (name, day, amount) in (("Corner Store", 1, "12.50"), ("Mini Mart", 3, "12.50"),
+                                    ("Mini Mart", 10, "4.00"), ("Corner Store", 20, "7.25"),
+                                    ("Mini Mart", 20, "7.25")):
+            receipt = Receipt.objects.create(supplier=Supplier.objects.get_or_create(name=name)[0],
+                                             date=date(2016, 3, day))
+            payment = Payment.objects.create(receipt=receipt, payment_method=self.card, amount=Decimal(amount))
+            self.payments.setdefault(name, []).append(payment.pk)
+
+    @staticmethod
+    def line(number, day, amount, description=""):
+        return StatementLine(number, date(2016, 3, day), Money.from_number(amount), description)
+
+    def test_reconcile(self):
+        """Lines match by amount and date window, preferring the named supplier, then the closest date"""
+        lines = [self.line(2, 2, "12.50", "MINI MART #42"), self.line(3, 2, "12.50", "POS PURCHASE"),
+                 self.line(4, 15, "4.00"), self.line(5, 10, "9.99"), self.line(6, 20, "7.25", "CARD PURCHASE")]
+        with self.assertNumQueries(1):
+            reconciliation = StatementReconciler(self.card).reconcile(lines)
+        self.assertEqual([(line.number, pk) for (line, pk) in reconciliation.matched],
+                         [(2, self.payments["Mini Mart"][0]), (3, self.payments["Corner Store"][0])])
+        self.assertEqual([line.number for line in reconciliation.unmatched], [4, 5])
+        self.assertEqual([(line.number, sorted(pks)) for (line, pks) in reconciliation.ambiguous],
+                         [(6, sorted([self.payments["Corner Store"][1], self.payments["Mini Mart"][2]]))])
+        with self.assertNumQueries(1):  # no amount changes, so no totals to refresh
+            StatementReconciler.apply(reconciliation)
+        self.assertEqual(Payment.objects.filter(reconciled=True).count(), 2)
+        self.assertEqual(StatementReconciler(self.card).reconcile(lines[:2]).matched, [])
+
+    def test_command(self):
+        statement = ("date,amount,description\n2016-03-03,-12.50,Mini Mart\n2016-03-20,\"-7,25\",Corner Store\n"
+                     "2016-03-22,-1.00,Unknown\n")
+        with NamedTemporaryFile("w", suffix=".csv") as stream:
+            stream.write(statement)
+            stream.flush()
+            out = StringIO()
+            call_command("reconcile_statement", stream.name, self.card.pk, charges_negative=True, apply=True,
+                         stdout=out)
+        self.assertIn("line 4: unmatched 2016-03-22 $1.00 Unknown", out.getvalue())
+        self.assertIn("Reconciled 1 of 3 lines, 2 unmatched, 0 ambiguous", out.getvalue())
+        self.assertEqual(list(Payment.objects.filter(reconciled=True).values_list("pk", flat=True)),
+                         [self.payments["Mini Mart"][0]])
+        with self.assertRaisesRegexp(StatementError, "line 2: invalid date"):
+            self.assertIsNone(list(read_statement(StringIO("date,amount\n2016-02-30,1\n"))))
+
+
+class ReceiptAdminTest(TestCase):
+    def setUp(self):
+        self.admin = ReceiptAdmin(Receipt, site)
+        self.request = RequestFactory().get("/")
+        self.request.user = User(is_superuser=True, is_staff=True)
+        product = Product.objects.create(name="Test Product")
+        for i in range(5):
+            receipt = Receipt.objects.create(supplier=Supplier.objects.create(name="Supplier %i" % i, city="City"))
+            Item.objects.create(receipt=receipt, product=product, unit_price=Decimal("1.50") * i)
+
+    def test_changelist_rows_query_count(self):
+        """Rendering every list_display column of a page costs one query regardless of row count"""
+        with self.assertNumQueries(1):
+            for receipt in self.admin.get_queryset(self.request).select_related(*self.admin.list_select_related):
+                for column in self.admin.list_display:
+                    value = getattr(receipt, column)
+                    "%s" % (value() if callable(value) else value)
+
+    def test_changelist_query_budget(self):
+        with query_budget(5):
+            list(results(self.admin.changelist_view(self.request).context_data["cl"]))
+
+    def test_tax_charge_inline_rates(self):
+        """The tax charge inline labels every charge with its rate without a query per charge"""
+        tax = Tax.objects.create(name="Test Tax")
+        receipt = Receipt.objects.last()
+        for amount in ("0.10", "0.20"):
+            TaxCharge.objects.create(receipt=receipt, tax=tax, amount=Decimal(amount))
+        inline = TaxChargeTabularAdmin(Receipt, site)
+        with self.assertNumQueries(1):
+            labels = ["%s" % charge for charge in inline.get_queryset(self.request).filter(receipt=receipt)]
+        self.assertEqual(labels, ["%s" % charge for charge in TaxCharge.objects.filter(receipt=receipt)])
+
+    def test_sortable_money_columns(self):
+        """Total, tax and status columns sort on indexed columns or annotations"""
+        queryset = self.admin.get_queryset(self.request)
+        for column in ("total_usd", "tax_usd", "status"):
+            order_field = getattr(Receipt, column).admin_order_field
+            self.assertEqual(len(queryset.order_by(order_field)), Receipt.objects.count())
+        totals = [receipt.total for receipt in queryset.order_by("-total_cache")]
+        self.assertEqual(totals, sorted(totals, reverse=True))
+
+
+class YearListViewTest(TestCase):
+    year = 2015
+
+    def setUp(self):
+        supplier = Supplier.objects.create(name="Test Supplier")
+        product = Product.objects.create(name="Test Product")
+        for (month, price) in ((1, "2.50"), (1, "3.00"), (3, "4.25"), (12, "1.00")):
+            receipt = Receipt.objects.create(supplier=supplier, date=date(self.year, month, 10))
+            Item.objects.create(receipt=receipt, product=product, quantity=2, unit_price=Decimal(price))
+            Fee.objects.create(receipt=receipt, name="Bag", amount=Decimal("0.10"))
+        Receipt.objects.create(supplier=supplier, date=date(self.year + 1, 1, 1))
+
+    def get_context(self):
+        view = YearListView(kwargs={"year": str(self.year)})
+        view.request = RequestFactory().get("/")
+        view.object_list = view.get_queryset()
+        return view.get_context_data()
+
+    def test_totals(self):
+        """Year totals match the per-receipt totals of the receipts in that year"""
+        context = self.get_context()
+        receipts = Receipt.objects.filter(date__year=self.year)
+        self.assertEqual(context["total"]["purchases"], sum(receipt.subtotal for receipt in receipts))
+        self.assertEqual(context["total"]["fees"], sum(receipt.fee for receipt in receipts))
+        self.assertEqual(context["total"]["final"], sum(receipt.total for receipt in receipts))
+
+    def test_monthly_breakdown(self):
+        """Only months with receipts are listed, in order, with their sums"""
+        months = self.get_context()["months"]
+        self.assertEqual([month["period"] for month in months],
+                         [date(self.year, 1, 1), date(self.year, 3, 1), date(self.year, 12, 1)])
+        self.assertEqual(months[0]["purchases"], Decimal("11.00"))
+        self.assertEqual(months[0]["fees"], Decimal("0.20"))
+
+    def test_summary_query_count(self):
+        """The summary is computed by a single query"""
+        with self.assertNumQueries(1):
+            Receipt.objects.filter(date__year=self.year).summarize()
+
+    def test_keyset_pages(self):
+        """Pages follow the receipt ordering, receipts without a time after those with one on the same day"""
+        supplier = Supplier.objects.get()
+        for when in (time(9), None, time(18), time(9), None):
+            Receipt.objects.create(supplier=supplier, date=date(self.year, 3, 10), time=when)
+        expected = [receipt.pk for receipt in Receipt.objects.filter(date__year=self.year).order_by(
+            "-date", models.F("time").desc(nulls_last=True), "-pk")]
+        (pks, cursor) = ([], None)
+        while True:
+            request = RequestFactory().get("/", {"after": cursor} if cursor else {})
+            with self.assertNumQueries(1):
+                content = json.loads(YearReceiptsView.as_view(page_size=2)(request, year=str(self.year))
+                                     .content.decode("utf-8"))
+            pks += [receipt["id"] for receipt in content["receipts"]]
+            cursor = content["next"]
+            if cursor is None:
+                break
+        self.assertEqual(pks, expected)
+        for cursor in ("x", "%s-01-10,noon,1" % self.year):
+            with self.assertRaises(http.Http404):
+                YearReceiptsView.as_view()(RequestFactory().get("/", {"after": cursor}), year=str(self.year))
+
+    def test_first_page_bounded(self):
+        view = YearListView(kwargs={"year": str(self.year)}, page_size=3)
+        view.request = RequestFactory().get("/")
+        view.object_list = view.get_queryset()
+        context = view.get_context_data()
+        self.assertEqual(len(context["receipts"]), 3)
+        self.assertEqual(context["next_cursor"], Receipt.objects.keyset_cursor(context["receipts"][2]))
+
+
+class PageCacheTest(TestCase):
+    def setUp(self):
+        self.supplier = Supplier.objects.create(name="Test Supplier")
+        self.product = Product.objects.create(name="Test Product")
+        self.receipts = {}
+        for year in (2014, 2015):
+            self.receipts[year] = Receipt.objects.create(supplier=self.supplier, date=date(year, 6, 1))
+            Item.objects.create(receipt=self.receipts[year], product=self.product, unit_price=Decimal("2.00"))
+
+    def get_context(self, year):
+        view = YearListView(kwargs={"year": str(year)}, request=RequestFactory().get("/"))
+        view.object_list = view.get_queryset()
+        return view.get_context_data()
+
+    def assertCached(self, year, cached=True):
+        with QueryRecorder() as recorder:
+            self.get_context(year)
+        self.assertEqual(recorder.count == 0, cached)
+
+    def test_year_versions(self):
+        """Changing a receipt or its components recomputes its year only"""
+        for year in (2014, 2015):
+            self.get_context(year)
+        self.assertCached(2014)
+        Item.objects.create(receipt=self.receipts[2015], product=self.product, unit_price=Decimal("1.00"))
+        self.assertCached(2014)
+        self.assertCached(2015, False)
+        self.assertEqual(self.get_context(2015)["total"]["purchases"], Money(300))
+        Payment.objects.create(receipt=Receipt.objects.get(pk=self.receipts[2015].pk), amount=Decimal("3.00"),
+                               payment_method=PaymentMethod.objects.create(
+                                   bank="Test Bank", type=PaymentMethodType.objects.create(name="Card")))
+        self.assertCached(2014)
+        self.assertCached(2015, False)
+        self.assertEqual(self.get_context(2015)["receipts"][0].status(), "Paid")
+        self.receipts[2015].date = date(2014, 7, 1)
+        self.receipts[2015].save()
+        self.assertCached(2014, False)
+        self.assertCached(2015, False)
+        self.supplier.name = "Renamed Supplier"
+        self.supplier.save()
+        self.assertIn("Renamed Supplier", "%s" % self.get_context(2014)["receipts"][0])
+
+    def test_json_pages(self):
+        request = RequestFactory().get("/")
+        YearReceiptsView.as_view()(request, year="2014")
+        with self.assertNumQueries(0):
+            content = json.loads(YearReceiptsView.as_view()(request, year="2014").content.decode("utf-8"))
+        self.assertEqual([receipt["id"] for receipt in content["receipts"]], [self.receipts[2014].pk])
+        self.receipts[2014].delete()
+        self.assertEqual(json.loads(YearReceiptsView.as_view()(request, year="2014").content.decode("utf-8")),
+                         {"receipts": [], "next": None})
+
+    def test_dashboard(self):
+        today = date.today()
+        Receipt.objects.create(supplier=self.supplier, date=today)
+        view = DashboardView(request=RequestFactory().get("/"))
+        view.get_context_data()
+        with self.assertNumQueries(0):
+            view.get_context_data()
+        page_cache.bump("year:%i" % (today.year - 1))
+        with self.assertNumQueries(1):
+            view.get_context_data()
+
+
 class ItemTest(TestCase):
     product_type_name = "Test Product Type"
     product_name = "Test Product"
@@ -326,6 +1686,12 @@ class ItemTest(TestCase):
         item = Item.objects.first()
         self.assertEqual(item.cost_usd(), utils.to_usd(item.cost))
 
+    def test_representation_selected(self):
+        """The item string reads a selected product without querying"""
+        item = Item.objects.select_related("product").first()
+        with self.assertNumQueries(0):
+            self.assertRegexpMatches("%s" % item, r"\b%s\b" % self.product_name)
+
     def test_representation(self):
         item = Item.objects.first()
         self.assertRegexpMatches("%s" % item, r"\b%d\b" % self.quantity)
@@ -450,6 +1816,32 @@ class TaxChargeTest(TestCase):
         self.assertRegexpMatches("%s" % tax, r"\b%s\b" % self.tax_name)
         self.assertRegexpMatches("%s" % tax, r"\b%d\b" % tax.percentage())
 
+    def test_batched_rates(self):
+        """Annotated rates match the computed ones and need no query per charge"""
+        receipt = Receipt.objects.create(supplier=Supplier.objects.first())
+        TaxCharge.objects.create(tax=Tax.objects.first(), receipt=receipt, amount=0)
+        with self.assertNumQueries(1):
+            charges = ["%s" % charge for charge in TaxCharge.objects.with_rates().select_related("tax").order_by("pk")]
+        self.assertEqual(charges, ["%s" % TaxCharge.objects.first(), "%s (n/a)" % self.tax_name])
+        self.assertAlmostEqual(TaxCharge.objects.with_rates().first().rate(), TaxCharge.objects.first().rate(), 6)
+
+    def test_report(self):
+        """Charges, amounts and effective rates are summed per tax and month"""
+        receipt = Receipt.objects.create(supplier=Supplier.objects.first(), date=self.receipt_date)
+        Item.objects.create(product=Product.objects.first(), receipt=receipt, unit_price=Decimal("10.00"))
+        TaxCharge.objects.create(tax=Tax.objects.first(), receipt=receipt, amount=Decimal("1.50"))
+        TaxCharge.objects.create(tax=Tax.objects.first(), receipt=receipt, amount=Decimal("0.50"))
+        Receipt.objects.create(supplier=Supplier.objects.first(), date=date(2016, 1, 1))
+        with self.assertNumQueries(1):
+            [row] = TaxCharge.objects.report()
+        # the receipt charged the tax twice counts once towards the receipts total
+        self.assertEqual((row["tax__name"], row["period"], row["charges"], row["charged"], row["receipts_total"]),
+                         (self.tax_name, self.receipt_date.replace(day=1), 3, Decimal("3.25"), Decimal("20.99")))
+        self.assertEqual(row["rate"], (Decimal("3.25") / Decimal("20.99")).quantize(Decimal("0.000001")))
+        out = StringIO()
+        call_command("tax_report", period="year", stdout=out)
+        self.assertIn("%i-01-01,%s,3,3.25,20.99,0.154836" % (self.receipt_date.year, self.tax_name), out.getvalue())
+
     def test_verbose_name(self):
         """Taxcharge object verbose name and plural version are defined as expected"""
         self.assertEqual(TaxCharge._meta.verbose_name, "tax charged")
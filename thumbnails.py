@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from logging import getLogger
+from threading import Lock
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image
+
+from .cache import thumbnail_cache
+from .models import utils
+
+
+logger = getLogger(__name__)
+
+
+class ThumbnailWorker(object):
+    """Write the ``utils.thumbnail_sizes()`` thumbnails of stored images from a pool of background threads
+
+    ``MIZER_THUMBNAIL_WORKERS`` threads (2 unless set) are started on first use; with 0 thumbnails are
+    written before ``submit`` returns. Thumbnails that already exist are left alone, so submitting the same
+    image again is cheap.
+    """
+
+    def __init__(self, workers=2):
+        self.default_workers = workers
+        self.lock = Lock()
+        self.executor = None
+
+    @property
+    def workers(self):
+        return getattr(settings, "MIZER_THUMBNAIL_WORKERS", self.default_workers)
+
+    def submit(self, image):
+        """Queue thumbnails for the given ``ImageField`` file; returns a future, or None when run inline"""
+        if not image:
+            return None
+        if not self.workers:
+            self.generate(image.storage, image.name)
+            return None
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self.executor.submit(self.generate, image.storage, image.name)
+
+    @staticmethod
+    def generate(storage, name):
+        """Write any missing thumbnail of the stored image ``name``, returning the names written"""
+        missing = [(utils.thumbnail_path(name, size), dimensions)
+                   for (size, dimensions) in utils.thumbnail_sizes().items()
+                   if not storage.exists(utils.thumbnail_path(name, size))]
+        if not missing:
+            thumbnail_cache.set(thumbnail_cache.key("ready", name), True)
+            return []
+        try:
+            with storage.open(name) as stream:
+                original = Image.open(stream)
+                original.load()
+        except (IOError, OSError):
+            logger.exception("Cannot read image %s", name)
+            return []
+        if original.mode != "RGB":
+            original = original.convert("RGB")
+        written = []
+        for (thumbnail_name, dimensions) in missing:
+            thumbnail = original.copy()
+            thumbnail.thumbnail(dimensions, Image.LANCZOS)
+            content = BytesIO()
+            thumbnail.save(content, "JPEG", quality=85)
+            written.append(storage.save(thumbnail_name, ContentFile(content.getvalue())))
+        thumbnail_cache.set(thumbnail_cache.key("ready", name), True)  # spares image_html asking the storage
+        return written
+
+
+thumbnails = ThumbnailWorker()
@@ -6,6 +6,11 @@ from . import views
 urlpatterns = [
     url(r'^search/supplier', views.SupplierAutocompleteView.as_view(), name='mizer_supplier_search'),
     url(r'^search/product', views.ProductAutocompleteView.as_view(), name='mizer_product_search'),
+    url(r'^export', views.ExportView.as_view(), name='mizer_export'),
+    url(r'^receipts', views.ReceiptBulkView.as_view(), name='mizer_receipts'),
+    url(r'^report/compare', views.ComparisonView.as_view(), name='mizer_comparison'),
+    url(r'^report/types', views.SpendingPivotView.as_view(), name='mizer_spending_pivot'),
+    url(r'^year/(?P<year>\d+)/receipts', views.YearReceiptsView.as_view(), name='mizer_year_receipts'),
     url(r'^year/(?P<year>\d+)', views.YearListView.as_view(), name='mizer_year'),
     url(r'^year', views.YearListView.as_view(), name='mizer_year'),
     url(r'^', views.DashboardView.as_view(), name='mizer_home'),
@@ -1,8 +1,18 @@
 from datetime import date
+import json
 
+from django import http
+from django.conf import settings
+from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
+from django.db.models import Q
+from django.utils.dateparse import parse_date
 from django.views import generic
 
-from .models import Supplier, Product, Receipt
+from .cache import autocomplete_cache, page_cache
+from .exporter import ReceiptExporter, filter_receipts
+from .importer import ReceiptImporter, ReceiptImportError
+from .models import utils, Supplier, Product, Receipt, SpendingRollup
+from .reports import SpendingPivot, compare_periods, same_period_years
 from dal import autocomplete
 
 
@@ -11,10 +21,15 @@ base_context = {
 }
 
 
-class YearListView(generic.ListView):
-    template_name = 'mizer/year.html'
-    context_object_name = 'receipts'
-    
+class YearReceiptsMixin(object):
+    """Receipts of the year named in the URL (the current one by default), a keyset page at a time
+
+    Pages follow ``ReceiptQuerySet.keyset_ordering``; the ``after`` query parameter holds the cursor
+    returned with the previous page. Computed pages are kept in ``page_cache`` until a receipt of the
+    year, or one of its components, changes, so past years are served without queries.
+    """
+    page_size = 50
+
     def get_year(self):
         year = date.today().year
         if self.kwargs and self.kwargs['year']:
@@ -23,12 +38,39 @@ class YearListView(generic.ListView):
 
     def get_queryset(self):
         """Return all receipts from the current year."""
-        return Receipt.objects.filter(date__gt=date(self.get_year() - 1, 12, 31),
-                                      date__lt=date(self.get_year() + 1, 1, 1))
+        return (Receipt.objects
+                .filter(date__gt=date(self.get_year() - 1, 12, 31),
+                        date__lt=date(self.get_year() + 1, 1, 1))
+                .select_related("supplier"))
+
+    def get_page(self, receipts):
+        """Return ``(receipts, next cursor)`` for the requested page"""
+        try:
+            return receipts.keyset_page(self.request.GET.get('after'), self.page_size)
+        except ValueError:
+            raise http.Http404('Invalid page cursor')
+
+    def cached_page(self, name, compute):
+        """``compute()`` for the requested page, from the cache of the year when it is current"""
+        key = page_cache.key("year:%i" % self.get_year(), name, self.request.GET.get('after', ''), self.page_size)
+        value = page_cache.get(key)
+        if value is None:
+            value = compute()
+            page_cache.set(key, value)
+        return value
+
+
+class YearListView(YearReceiptsMixin, generic.ListView):
+    template_name = 'mizer/year.html'
+    context_object_name = 'receipts'
 
     def get_context_data(self, **kwargs):
+        (page, summary) = self.cached_page('list', lambda: (
+            self.get_page(self.object_list), SpendingRollup.objects.filter(year=self.get_year()).summarize()))
+        (kwargs['object_list'], next_cursor) = page
         context = super(YearListView, self).get_context_data(**kwargs)
         context.update(base_context)
+        context['next_cursor'] = next_cursor
 
         context['year'] = self.get_year()
         if context['year'] != date.today().year:
@@ -36,63 +78,233 @@ class YearListView(generic.ListView):
         else:
             context['page_title'] = '%i Year-to-Date Summary' % context['year']
 
-        context['total'] = {
-            'purchases': 0,
-            'fees': 0,
-            'discounts': 0,
-            'taxes': 0,
-            'tips': 0,
-            'final': 0
-            }
-
-        for receipt in self.get_queryset():
-            context['total']['purchases'] += receipt.subtotal
-            context['total']['fees'] += receipt.fee
-            context['total']['discounts'] += receipt.discount
-            context['total']['taxes'] += receipt.tax
-            context['total']['tips'] += receipt.tip
-            context['total']['final'] += receipt.total
+        (context['total'], context['months']) = summary
 
         return context
 
 
+class YearReceiptsView(YearReceiptsMixin, generic.View):
+    """Further pages of the year list as JSON, for infinite scrolling: ``{"receipts": [...], "next": cursor}``"""
+
+    def get(self, request, *args, **kwargs):
+        return http.JsonResponse(self.cached_page('receipts', self.get_content))
+
+    def get_content(self):
+        (receipts, next_cursor) = self.get_page(self.get_queryset())
+        return {
+            'receipts': [{'id': receipt.pk, 'date': receipt.date.isoformat(), 'when': receipt.when,
+                          'supplier': '%s' % receipt.supplier, 'total': '%s' % receipt.total,
+                          'status': receipt.status(), 'label': '%s' % receipt}
+                         for receipt in receipts],
+            'next': next_cursor,
+        }
+
+
 class DashboardView(generic.TemplateView):
+    """Spending of the last ``months_shown`` months, cached until a receipt of one of their years changes"""
     template_name = 'mizer/home.html'
+    months_shown = 12
 
     def get_context_data(self, **kwargs):
         context = super(DashboardView, self).get_context_data(**kwargs)
         context.update(base_context)
         context['page_title'] = 'Dashboard'
+
+        today = date.today()
+        first = today.year * 12 + today.month - self.months_shown  # months since year 0, exclusive
+        (first_year, first_month) = (first // 12, first % 12 + 1)
+        # keyed by the versions of the earlier years too, so a change to any of them is seen
+        key = page_cache.key("year:%i" % today.year, "dashboard", today, self.months_shown,
+                             *[page_cache.version("year:%i" % year) for year in range(first_year, today.year)])
+        summary = page_cache.get(key)
+        if summary is None:
+            rollups = SpendingRollup.objects.filter(Q(year__gt=first_year) | Q(year=first_year, month__gte=first_month))
+            summary = rollups.summarize()
+            page_cache.set(key, summary)
+        (context['total'], context['months']) = summary
         return context
 
 
+class ExportView(LoginRequiredMixin, generic.View):
+    """Stream receipts as CSV or JSON lines, filtered by start/end date, supplier and product type"""
+    content_types = {
+        'csv': 'text/csv',
+        'jsonl': 'application/x-ndjson',
+    }
+
+    def get(self, request, *args, **kwargs):
+        format = request.GET.get('format', 'csv')
+        if format not in self.content_types:
+            return http.HttpResponseBadRequest('Unknown format')
+        try:
+            receipts = filter_receipts(start=parse_date(request.GET.get('start', '')),
+                                       end=parse_date(request.GET.get('end', '')),
+                                       supplier=int(request.GET.get('supplier') or 0),
+                                       product_type=int(request.GET.get('product_type') or 0))
+        except ValueError:
+            return http.HttpResponseBadRequest('Invalid filter')
+        response = http.StreamingHttpResponse(ReceiptExporter(receipts).lines(format),
+                                              content_type=self.content_types[format])
+        response['Content-Disposition'] = 'attachment; filename="receipts.%s"' % format
+        return response
+
+
+class ReceiptBulkView(PermissionRequiredMixin, generic.View):
+    """Create receipts posted as JSON with their components in one transaction; see ``importer.ReceiptImporter``
+
+    The body is a receipt object, a list of them or ``{"receipts": [...]}``, of at most
+    ``MIZER_BULK_RECEIPTS_LIMIT`` receipts. Answers 201 with the id and stored totals of every receipt, in
+    the posted order, or 400 with the error and the index of the first invalid receipt, writing nothing.
+    """
+    permission_required = 'mizer.add_receipt'
+    raise_exception = True
+
+    def post(self, request, *args, **kwargs):
+        try:
+            receipts = json.loads(request.body.decode(request.encoding or 'utf-8'))
+        except ValueError as error:
+            return http.JsonResponse({'error': 'Invalid JSON: %s' % error}, status=400)
+        if isinstance(receipts, dict):
+            receipts = receipts['receipts'] if 'receipts' in receipts else [receipts]
+        if not isinstance(receipts, list) or not receipts:
+            return http.JsonResponse({'error': 'Expected one or more receipts'}, status=400)
+        limit = getattr(settings, 'MIZER_BULK_RECEIPTS_LIMIT', 500)
+        if len(receipts) > limit:
+            return http.JsonResponse({'error': 'At most %i receipts per request' % limit}, status=400)
+        try:
+            (instances, rows) = ReceiptImporter().write(receipts)
+        except ReceiptImportError as error:
+            return http.JsonResponse({'error': '%s' % error, 'index': error.index}, status=400)
+        return http.JsonResponse({
+            'rows': rows,
+            'receipts': [{'id': receipt.pk, 'subtotal': '%s' % receipt.subtotal, 'fees': '%s' % receipt.fee,
+                          'discounts': '%s' % receipt.discount, 'taxes': '%s' % receipt.tax,
+                          'tips': '%s' % receipt.tip, 'total': '%s' % receipt.total,
+                          'paid': None if receipt.paid is None else '%s' % receipt.paid, 'status': receipt.status()}
+                         for receipt in instances],
+        }, status=201)
+
+
+class SpendingPivotView(LoginRequiredMixin, generic.View):
+    """Item spending per product type and period as JSON; see ``reports.SpendingPivot``"""
+
+    def get(self, request, *args, **kwargs):
+        today = date.today()
+        try:
+            start = parse_date(request.GET.get('start', '')) or date(today.year, 1, 1)
+            end = parse_date(request.GET.get('end', '')) or today
+            pivot = SpendingPivot(request.GET.get('period', 'month'), request.GET.get('allocation', 'full'))
+        except ValueError as error:
+            return http.HttpResponseBadRequest('%s' % error)
+        report = pivot.build(start, end)
+        return http.JsonResponse({
+            'periods': [period.isoformat() for period in report['periods']],
+            'rows': [{'product_type': row['product_type'], 'name': row['name'],
+                      'spend': ['%s' % spend for spend in row['spend']], 'total': '%s' % row['total']}
+                     for row in report['rows']],
+            'totals': ['%s' % total for total in report['totals']],
+        })
+
+
+class ComparisonView(LoginRequiredMixin, generic.View):
+    """Receipt totals of several date ranges side by side, with their changes, as JSON; see ``reports.compare_periods``
+
+    Ranges are given as ``ranges=2015-01-01:2015-12-31,2016-01-01:2016-12-31``, or as ``start`` and ``end``
+    (default: this year to date) compared with the same dates of the ``years - 1`` years before (default:
+    2 years). All of them are summed by one query.
+    """
+    max_periods = 25
+
+    def get_ranges(self, request):
+        if request.GET.get('ranges'):
+            ranges = [tuple(parse_date(day) for day in text.split(':'))
+                      for text in request.GET['ranges'].split(',')]
+            if any(len(dates) != 2 or None in dates for dates in ranges):
+                raise ValueError('Invalid ranges')
+            return ranges
+        today = date.today()
+        start = parse_date(request.GET.get('start', '')) or date(today.year, 1, 1)
+        end = parse_date(request.GET.get('end', '')) or today
+        years = int(request.GET.get('years') or 2)
+        if years > self.max_periods:
+            raise ValueError('Compare 1 to %i periods' % self.max_periods)
+        return same_period_years(start, end, years)
+
+    def get(self, request, *args, **kwargs):
+        try:
+            ranges = self.get_ranges(request)
+        except ValueError as error:
+            return http.HttpResponseBadRequest('%s' % error)
+        if not 0 < len(ranges) <= self.max_periods:
+            return http.HttpResponseBadRequest('Compare 1 to %i periods' % self.max_periods)
+        periods = []
+        for period in compare_periods(ranges):
+            period = dict((key, value.isoformat() if isinstance(value, date) else
+                           value if isinstance(value, (int, dict)) else '%s' % value)
+                          for (key, value) in period.items())
+            if 'change' in period:
+                period['change'] = dict((name, change if isinstance(change, int) else '%s' % change)
+                                        for (name, change) in period['change'].items())
+            periods.append(period)
+        return http.JsonResponse({'periods': periods})
+
+
 class BaseAutocompleteView(autocomplete.Select2QuerySetView):
+    cache_group = None
+
+    def get(self, request, *args, **kwargs):
+        """Serve rendered results from the autocomplete cache, keyed by normalized query and page"""
+        if not self.cache_group or not request.user.is_authenticated():
+            return super(BaseAutocompleteView, self).get(request, *args, **kwargs)
+        query = (self.q or "").strip()
+        normalized = utils.normalize_search(query)
+        key = autocomplete_cache.key(self.cache_group,
+                                     normalized if normalized == query else "%s\0%s" % (normalized, query),
+                                     request.GET.get(self.page_kwarg, 1))
+        content = autocomplete_cache.get(key)
+        if content is None:
+            response = super(BaseAutocompleteView, self).get(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            content = response.content
+            autocomplete_cache.set(key, content)
+        return http.HttpResponse(content, content_type="application/json")
+
     def get_queryset_by_model(self, model):
         results = model.objects.none()
         if self.request.user.is_authenticated():
             results = model.objects.all()
             if self.q:
-                results = results.filter(name__icontains=self.q)
+                results = results.search(self.q)
         return results
 
 
 class SupplierAutocompleteView(BaseAutocompleteView):
+    cache_group = "supplier"
+
     def get_result_label(self, item):
+        stats = item.statistics
+        visits = "%i visit%s" % (stats.visits, "" if stats.visits == 1 else "s")
+        if stats.last_visit:
+            visits = "%s, last %s" % (visits, stats.last_visit)
         return """
-        <strong>%s</strong><br>%s
-        """ % (item.name, item.locality())
+        <strong>%s</strong><br>%s<br>%s
+        """ % (item.name, item.locality(), visits)
 
     def get_queryset(self):
-        return self.get_queryset_by_model(Supplier)
+        results = self.get_queryset_by_model(Supplier).select_related("stats")
+        return results if self.q else results.frequent_first()
 
 
 class ProductAutocompleteView(BaseAutocompleteView):
+    cache_group = "product"
+
     def get_result_label(self, item):
         return "%s<strong>%s</strong><br>%s%s" % (
             item.image_html(),
             item.name,
             "%s<br>" % item.code if item.code else "",
-            ", ".join([product_type.name for product_type in item.types.all()]))
+            item.type_names())
 
     def get_queryset(self):
-        return self.get_queryset_by_model(Product)
\ No newline at end of file
+        return self.get_queryset_by_model(Product).prefetch_related("types")
\ No newline at end of file